@@ -0,0 +1,316 @@
+import sqlite3
+import hashlib
+import argparse
+import json
+import time
+import os
+from contextlib import closing
+
+import junkdrawer
+import thumbnails
+import encoders
+
+
+class CursorError(ValueError):
+    """
+    Raised for a gallery cursor that page_animations didn't hand out.
+    """
+    pass
+
+
+sIndexFile = 'animations.sqlite3'
+
+sSchema = """
+CREATE TABLE IF NOT EXISTS animations (
+    filename    TEXT PRIMARY KEY,
+    makerkey    TEXT,
+    rules_hash  TEXT,
+    frames      INTEGER,
+    size        INTEGER,
+    width       INTEGER,
+    height      INTEGER,
+    mtime       REAL,
+    added       REAL,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS animations_added ON animations (added);
+CREATE INDEX IF NOT EXISTS animations_rules_hash ON animations (rules_hash);
+CREATE TABLE IF NOT EXISTS render_metrics (
+    filename    TEXT PRIMARY KEY,
+    metrics     TEXT
+);
+CREATE TABLE IF NOT EXISTS blueprints (
+    id          TEXT PRIMARY KEY,
+    json        TEXT,
+    added       REAL
+);
+"""
+
+
+# Absolute paths of the index files whose schema this process has already brought up to date
+setPrepared = set()
+
+
+def connect(sIndex=None):
+    """
+    Open a connection to the animation index. The first connection a process opens to an index file creates its
+    tables if needed (see prepare); later ones only open it.
+    Connections are cheap, so every caller opens its own; that keeps them out of the way of threads and forked
+    render workers.
+    :param sIndex: String. Path of the sqlite file. Defaults to sIndexFile.
+    :return: sqlite3.Connection. Rows come back as sqlite3.Row.
+    """
+    sPath = os.path.abspath(sIndex or sIndexFile)
+    con = sqlite3.connect(sPath, timeout=30)
+    con.row_factory = sqlite3.Row
+    if sPath not in setPrepared:
+        prepare(con)
+        setPrepared.add(sPath)
+    return con
+
+
+def prepare(con):
+    """
+    Create the index's tables and bring older indexes up to date. Idempotent.
+    """
+    # WAL mode sticks to the file once set
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript(sSchema)
+    # Indexes made before animations had a content hash; their entries are hashed by the next reconcile
+    if "content_hash" not in [row["name"] for row in con.execute("PRAGMA table_info(animations)")]:
+        con.execute("ALTER TABLE animations ADD COLUMN content_hash TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS animations_content_hash ON animations (content_hash)")
+
+
+def rules_hash(liRules):
+    """
+    Stable hash of a rule set, so renders of the same rules can be found together.
+    :param liRules: List. Stochastic Lindenmayer rules, as in a makerkey.
+    :return: String. Hex digest.
+    """
+    sRules = json.dumps(liRules, sort_keys=True, cls=junkdrawer.JeffSONEncoder)
+    return hashlib.sha256(sRules.encode('utf-8')).hexdigest()
+
+
+def file_hash(sFileName, lChunk=1 << 20):
+    """
+    Hash of a file's bytes, read lChunk at a time. Used as the ETag of a saved animation and in its immutable urls.
+    :return: String. Hex digest.
+    """
+    objHash = hashlib.sha256()
+    with open(sFileName, 'rb') as f:
+        for bChunk in iter(lambda: f.read(lChunk), b""):
+            objHash.update(bChunk)
+    return objHash.hexdigest()
+
+
+def describe_animation(sFileName):
+    """
+    Read the makerkey, frame count and dimensions of a saved animation, without decoding its frames where the format
+    allows (gifs are walked block by block).
+    :param sFileName: String. Path of the animation, in any of the formats of encoders.
+    :return: Tuple. (makerkey json or None, frame count, (width, height))
+    """
+    return encoders.describe(sFileName)
+
+
+def add_animation(sFileName, sMakerKey=None, lFrames=None, tDimensions=None, sIndex=None, sContentHash=None):
+    """
+    Add (or refresh) a gif's entry in the index. Anything not supplied is read from the file itself.
+    :param sFileName: String. Path of the gif, which must already be in its final location.
+    :param sMakerKey: String. Makerkey json embedded in the gif. When lFrames and tDimensions are given too, None
+        means the gif has no makerkey.
+    :param lFrames: Integer. Number of frames in the gif.
+    :param tDimensions: Tuple. (width, height) of the gif.
+    :param sIndex: String. Path of the sqlite file.
+    :param sContentHash: String. file_hash of the gif, if the caller has already hashed it.
+    :return: String. The name under which the gif was indexed.
+    """
+    if lFrames is None or tDimensions is None:
+        sReadKey, lReadFrames, tReadDimensions = describe_animation(sFileName)
+        sMakerKey = sReadKey if sMakerKey is None else sMakerKey
+        lFrames = lReadFrames if lFrames is None else lFrames
+        tDimensions = tReadDimensions if tDimensions is None else tDimensions
+    sRulesHash = None
+    if sMakerKey:
+        try:
+            sRulesHash = rules_hash(json.loads(sMakerKey)["liRules"])
+        except (ValueError, KeyError, TypeError):
+            pass
+    objStat = os.stat(sFileName)
+    sBaseName = os.path.basename(sFileName)
+    with closing(connect(sIndex)) as con, con:
+        con.execute("INSERT OR REPLACE INTO animations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (sBaseName, sMakerKey, sRulesHash, lFrames, objStat.st_size,
+                     tDimensions[0], tDimensions[1], objStat.st_mtime, time.time(),
+                     sContentHash or file_hash(sFileName)))
+    return sBaseName
+
+
+def remove_animation(sBaseName, sIndex=None):
+    """
+    Drop a gif from the index. The file itself is left alone.
+    """
+    with closing(connect(sIndex)) as con, con:
+        con.execute("DELETE FROM animations WHERE filename = ?", (sBaseName,))
+        con.execute("DELETE FROM render_metrics WHERE filename = ?", (sBaseName,))
+
+
+def get_animation(sBaseName, sIndex=None):
+    """
+    :return: Dictionary. The index entry for a gif, or None if it isn't indexed.
+    """
+    with closing(connect(sIndex)) as con:
+        rowOut = con.execute("SELECT * FROM animations WHERE filename = ?", (sBaseName,)).fetchone()
+    return None if rowOut is None else dict(rowOut)
+
+
+def list_animations(sIndex=None):
+    """
+    :return: List. Names of all indexed gifs, oldest first.
+    """
+    with closing(connect(sIndex)) as con:
+        return [row["filename"] for row in con.execute("SELECT filename FROM animations ORDER BY added, filename")]
+
+
+def page_animations(sCursor=None, lPerPage=24, sIndex=None):
+    """
+    One page of indexed gifs, newest first. Pages are addressed by a cursor rather than an offset, so each page costs
+    the same no matter how deep into the gallery it is, and new renders don't shift later pages around.
+    :param sCursor: String. Cursor returned with the previous page, or None for the first page. Raises CursorError
+        for anything else.
+    :param lPerPage: Integer. Maximum number of gifs on the page.
+    :param sIndex: String. Path of the sqlite file.
+    :return: Tuple. (list of index entry dictionaries, cursor of the next page or None if this is the last page)
+    """
+    sQuery = "SELECT * FROM animations"
+    tParams = ()
+    if sCursor:
+        try:
+            sAdded, sFileName = sCursor.split(':', 1)
+            tParams = (float(sAdded), sFileName)
+        except ValueError:
+            raise CursorError("Malformed gallery cursor")
+        sQuery += " WHERE (added, filename) < (?, ?)"
+    sQuery += " ORDER BY added DESC, filename DESC LIMIT ?"
+    with closing(connect(sIndex)) as con:
+        liRows = [dict(row) for row in con.execute(sQuery, tParams + (lPerPage + 1,))]
+    sNextCursor = None
+    if len(liRows) > lPerPage:
+        liRows = liRows[:lPerPage]
+        sNextCursor = "{!r}:{}".format(liRows[-1]["added"], liRows[-1]["filename"])
+    return liRows, sNextCursor
+
+
+def find_by_hash(sContentHash, sIndex=None):
+    """
+    :param sContentHash: String. file_hash of an animation.
+    :return: List. Names of the indexed animations with exactly those bytes, oldest first.
+    """
+    with closing(connect(sIndex)) as con:
+        return [row["filename"] for row in con.execute("SELECT filename FROM animations WHERE content_hash = ? "
+                                                       "ORDER BY added", (sContentHash,))]
+
+
+def random_animation(sIndex=None):
+    """
+    Pick a random indexed gif without scanning the whole table.
+    :return: String. Name of the gif, or None if the index is empty.
+    """
+    with closing(connect(sIndex)) as con:
+        rowOut = con.execute("SELECT filename FROM animations "
+                             "WHERE rowid >= (ABS(RANDOM()) % (SELECT MAX(rowid) FROM animations) + 1) "
+                             "ORDER BY rowid LIMIT 1").fetchone()
+    return None if rowOut is None else rowOut["filename"]
+
+
+def add_metrics(sBaseName, sMetrics, sIndex=None):
+    """
+    Store the measurements taken while rendering a gif (metrics.RenderMetrics.as_dict, as json).
+    """
+    with closing(connect(sIndex)) as con, con:
+        con.execute("INSERT OR REPLACE INTO render_metrics VALUES (?, ?)", (sBaseName, sMetrics))
+
+
+def get_metrics(sBaseName, sIndex=None):
+    """
+    :return: Dictionary. The measurements stored for a gif, or None if it has none (e.g. it was uploaded).
+    """
+    with closing(connect(sIndex)) as con:
+        rowOut = con.execute("SELECT metrics FROM render_metrics WHERE filename = ?", (sBaseName,)).fetchone()
+    return None if rowOut is None else json.loads(rowOut["metrics"])
+
+
+def add_blueprint(sId, sJson, sIndex=None):
+    """
+    Persist a blueprint under its id. Blueprints are content-addressed, so an existing id is left as it is.
+    """
+    with closing(connect(sIndex)) as con, con:
+        con.execute("INSERT OR IGNORE INTO blueprints VALUES (?, ?, ?)", (sId, sJson, time.time()))
+
+
+def get_blueprint(sId, sIndex=None):
+    """
+    :return: String. Json of the blueprint with this id, or None if there isn't one.
+    """
+    with closing(connect(sIndex)) as con:
+        rowOut = con.execute("SELECT json FROM blueprints WHERE id = ?", (sId,)).fetchone()
+    return None if rowOut is None else rowOut["json"]
+
+
+def reconcile(sFolder=None, sIndex=None):
+    """
+    Bring the index in line with the animations on disk. New or modified animations are (re)read and get fresh
+    thumbnails, and entries whose file has disappeared are dropped along with their thumbnails and checkpoints.
+    Unchanged animations are only stat'ed.
+    :param sFolder: String. Folder of animations. Defaults to junkdrawer.sSavedAnimationsFolder.
+    :param sIndex: String. Path of the sqlite file.
+    :return: Tuple. (number of animations added or refreshed, number of entries removed)
+    """
+    # checkpoints brings in the generation cache and the kernels, which the web tier otherwise doesn't need
+    import checkpoints
+    sFolder = sFolder or junkdrawer.sSavedAnimationsFolder
+    with closing(connect(sIndex)) as con:
+        dctIndexed = {row["filename"]: (row["size"], row["mtime"], row["content_hash"] is not None)
+                      for row in con.execute("SELECT filename, size, mtime, content_hash FROM animations")}
+    lAdded = 0
+    setOnDisk = set()
+    for objEntry in os.scandir(sFolder):
+        if not objEntry.is_file() or not objEntry.name.lower().endswith(encoders.tExtensions):
+            continue
+        setOnDisk.add(objEntry.name)
+        objStat = objEntry.stat()
+        # Vector animations are shown as they are, without thumbnails
+        bVector = encoders.encoder_for_file(objEntry.name).bVector
+        if (dctIndexed.get(objEntry.name) == (objStat.st_size, objStat.st_mtime, True)
+                and (bVector or thumbnails.has_thumbnails(objEntry.name))):
+            continue
+        try:
+            add_animation(objEntry.path, sIndex=sIndex)
+            if not bVector:
+                thumbnails.make_thumbnails(objEntry.path)
+        except (OSError, SyntaxError, ValueError) as e:
+            print("Skipping unreadable animation {}: {}".format(objEntry.name, e))
+            continue
+        lAdded += 1
+    liMissing = [sBaseName for sBaseName in dctIndexed if sBaseName not in setOnDisk]
+    for sBaseName in liMissing:
+        remove_animation(sBaseName, sIndex)
+        thumbnails.remove_thumbnails(sBaseName)
+        checkpoints.remove_checkpoint(sBaseName)
+    return lAdded, len(liMissing)
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Maintain the index of saved fractal animations.")
+    objParser.add_argument("command", choices=["reconcile"], help="reconcile: rebuild the index from disk")
+    objParser.add_argument("--folder", default=None, help="folder of animations to index")
+    objParser.add_argument("--index", default=None, help="sqlite file holding the index")
+    objArgs = objParser.parse_args()
+    if objArgs.command == "reconcile":
+        lAdded, lRemoved = reconcile(objArgs.folder, objArgs.index)
+        print("{} animations indexed, {} stale entries removed".format(lAdded, lRemoved))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,64 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, make_response, Markup
+from flask import Flask, Request, render_template, redirect, url_for, request, flash, make_response, Markup, \
+    jsonify, send_file, stream_with_context
 from werkzeug.utils import secure_filename
+import json
+import time
 import sys
 import io
 import os
 from pathlib import Path
-import json
-import random
 # import requests
 # import time
 
-from PIL import Image
-
-import renderer
+# Rendering code (matplotlib, PIL, pygifsicle) is only ever imported by the render workers started by jobs
+import jobs
+import jobtable
+import animationindex
+import assetcache
+import thumbnails
+import blueprints
 import junkdrawer
+import encoders
+import metrics
+import uploads
 
 buffer = io.StringIO()
+# With a shared job table, renders run on the nodes started by `python jobtable.py work` rather than in this process
+sJobTable = os.environ.get('FRACTAL_JOB_TABLE')
+supervisor = jobtable.TableSupervisor(sJobTable) if sJobTable else jobs.JobSupervisor(fncLog=buffer.write)
+metrics.registry.fncRunningJobs = supervisor.running_count
+blueprintStore = blueprints.BlueprintStore()
+assets = assetcache.AssetCache()
+sDefaultBlueprintId = None
+# Urls with a content hash in them never change what they point to
+lImmutableMaxAge = 365 * 24 * 60 * 60
+# Seconds between checks of the event streams served here; asgiapp's are woken by the supervisor instead
+fEventPollInterval = .5
+# Seconds between comment lines keeping idle event streams open through proxies, and finding out when the viewer has
+# gone away, and seconds after which a stream served here ends to free its thread (EventSource reconnects by itself)
+fEventKeepAlive = 15.
+fEventMaxSeconds = 3600.
+
+
+
+class FractalRequest(Request):
+    """
+    Streams animations posted to submit_gif straight into an uploads.UploadWriter, which hashes them and reads their
+    makerkey on the way to disk, rather than into werkzeug's spooled temporary file.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'submit_gif':
+            return uploads.UploadWriter(secure_filename(filename or ""))
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 
 app = Flask(__name__)
+app.request_class = FractalRequest
 app.secret_key = 'Fractals'
 # APP_ROOT = os.path.dirname(os.path.realpath(__file__))
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'Saved_Animations')
+# Room for the form fields around the largest upload; bigger requests are refused before they're read
+app.config['MAX_CONTENT_LENGTH'] = uploads.lMaxUploadBytes + 64 * 1024
 
 
 @app.route('/')
@@ -34,6 +73,7 @@ def home():
         'Grab Json From Gif': url_for('submit_gif', askfor='json'),
         'Make From Json': url_for('update_blueprint_json', goto='making'),
         'View Random Gif': url_for('random_gif'),
+        'Deep Zooms': url_for('deep_zooms'),
         'View Console Logs': url_for('printing')
 
     }
@@ -47,65 +87,230 @@ def home():
 @app.route('/static/gif/<filename>')
 def gif_page(filename):
     """
-    Interactive page for viewing a fractal in Saved_Animations
+    Interactive page for viewing a fractal in Saved_Animations. The fractal itself is linked by its immutable url.
     """
+    dctEntry = assets.lookup(secure_filename(filename))
+    if dctEntry is None:
+        flash('No such gif: ' + filename)
+        return redirect(url_for('home'))
     dctLinks = {
         'Home': url_for('home'),
-        'View Json': url_for('json_page', filename=filename),
+        'View Json': url_for('json_page', filename=filename, v=assetcache.digest(dctEntry)),
         'Generate Gif': url_for('making'),
         'View Random Gif': url_for('random_gif'),
     }
-    full_filename = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    return render_template('main.html',
-                           title="Gif: " + filename,
-                           dctLinks=dctLinks,
-                           images=[full_filename])
+    sPyramid = junkdrawer.pyramid_name(filename)
+    if os.path.isfile(os.path.join(Path(__file__).parent, 'static', 'Deep_Zoom', sPyramid, 'pyramid.json')):
+        dctLinks['Deep Zoom'] = url_for('deep_zoom_page', name=sPyramid)
+    response = make_response(render_template('main.html',
+                                             title="Gif: " + filename,
+                                             dctLinks=dctLinks,
+                                             images=[render_url(filename, dctEntry["hash"])]))
+    # The page changes whenever the file does, so it is revalidated rather than cached outright
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route('/static/json/<filename>')
 def json_page(filename):
     """
-    Retrieve makerkey json file from comment of a given fractal in Saved_Animations
+    Retrieve makerkey json file from comment of a given fractal in Saved_Animations.
+    The json is cached in memory by the fractal's content hash, which is also its ETag.
+    Query string params:
+    v: content hash as linked from the gif page; the response can then be cached for good
+    """
+    if filename.rsplit('.', 1)[-1].lower() not in encoders.tExtensions:
+        flash('File Chosen Not A Fractal Animation')
+        return redirect(url_for('home'))
+    # Files not indexed yet, e.g. copied in by hand since the last reconcile, are indexed on the way
+    dctEntry = assets.lookup(secure_filename(filename))
+    if dctEntry is None:
+        flash('No such gif: ' + filename)
+        return redirect(url_for('home'))
+    response = make_response(str(assets.makerkey(dctEntry)))
+    response.set_etag(dctEntry["hash"])
+    set_cache_control(response, request.args.get('v') == assetcache.digest(dctEntry))
+    return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+
+
+@app.route('/renders/<digest>/<filename>')
+@app.route('/renders/<digest>/<filename>/<kind>')
+def render_asset(digest, filename, kind=None):
+    """
+    Serve a fractal in Saved_Animations, or its gallery poster or preview, at a url holding its content hash.
+    The url can only ever mean these bytes, so responses are cacheable for good; conditional and range requests are
+    answered from the hash without reading the file.
+    kind: omitted for the fractal itself, or 'poster' or 'preview'
+    """
+    sBaseName = secure_filename(filename)
+    dctEntry = assets.lookup(sBaseName)
+    if dctEntry is None or assetcache.digest(dctEntry) != digest:
+        # Gone, or replaced by different content since the url was handed out
+        return make_response("No such render " + digest + "/" + filename, 404)
+    if kind is None:
+        sPath = os.path.join(Path(__file__).parent, dctEntry["path"])
+    elif kind in ('poster', 'preview'):
+        sThumbnail = (thumbnails.poster_name if kind == 'poster' else thumbnails.preview_name)(sBaseName)
+        sPath = os.path.join(Path(__file__).parent, 'static', 'Thumbnails', sThumbnail)
+        if not os.path.isfile(sPath):
+            return make_response("No " + kind + " for " + filename, 404)
+    else:
+        return make_response("Unknown kind " + kind, 404)
+    response = send_file(sPath, conditional=True, etag=dctEntry["hash"] + ("" if kind is None else "-" + kind))
+    set_cache_control(response, True)
+    return response
+
+
+def render_url(sBaseName, sContentHash, sKind=None):
+    """
+    :return: String. Immutable url of a fractal, or of its poster or preview, from its content hash.
+    """
+    return url_for('render_asset', digest=sContentHash[:assetcache.lDigestLength], filename=sBaseName, kind=sKind)
+
+
+def set_cache_control(response, bImmutable):
+    """
+    Content-hashed responses are cached for good. Anything else carries a validator and is revalidated on every use,
+    which costs a 304 at most.
+    """
+    if bImmutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = lImmutableMaxAge
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+
+@app.route('/deep_zoom')
+def deep_zooms():
+    """
+    List the deep zoom pyramids made by `python deepzoom.py`, newest first.
+    """
+    dctLinks = {'Home': url_for('home')}
+    for dctPyramid in junkdrawer.list_pyramids():
+        dctLinks["{name} (generation {generation}, {tiles} tiles)".format(**dctPyramid)] = \
+            url_for('deep_zoom_page', name=dctPyramid["name"])
+    return render_template('main.html',
+                           title="Deep Zooms",
+                           dctLinks=dctLinks,
+                           body2="" if len(dctLinks) > 1 else "No deep zooms made yet.")
+
+
+@app.route('/deep_zoom/<name>')
+def deep_zoom_page(name):
+    """
+    Pan and zoom around a deep zoom pyramid. The viewer fetches only the tiles in view, straight from static.
     """
-    if filename.rsplit('.', 1)[1].lower() != "gif":
-        flash('File Chosen Not Gif')
-        return redirect(url_for('Home'))
-    sFileFullName = os.path.join(Path(__file__).parent, 'static', 'Saved_Animations', filename)
-    with Image.open(sFileFullName) as imgGif:
-        jsonBlueprint = imgGif.info["comment"].decode('ASCII')
-    return Markup.escape(jsonBlueprint)
+    sName = secure_filename(name)
+    sDescription = os.path.join(Path(__file__).parent, 'static', 'Deep_Zoom', sName, 'pyramid.json')
+    if not os.path.isfile(sDescription):
+        flash('No such deep zoom: ' + name)
+        return redirect(url_for('deep_zooms'))
+    with open(sDescription, 'r') as f:
+        dctPyramid = json.load(f)
+    # The viewer doesn't need the makerkey
+    dctPyramid.pop("makerkey", None)
+    dctLinks = {'Home': url_for('home'), 'Deep Zooms': url_for('deep_zooms')}
+    return render_template('deepzoom.html',
+                           title="Deep Zoom: " + sName,
+                           dctLinks=dctLinks,
+                           dctPyramid=dctPyramid,
+                           tileUrl=url_for('static', filename='Deep_Zoom/' + sName))
 
 
 @app.route('/gallery')
 def gallery():
     """
-    Display all fractals stored in Saved_Animations.
+    Display fractals stored in Saved_Animations a page at a time, as thumbnails linking to their gif pages.
+    Query string params:
+    cursor: cursor of the page to show, as linked from the previous page
+    per_page: number of fractals on a page
     """
     dctLinks = {
         'Home': url_for('home'),
     }
-    liImages = os.listdir(os.path.join('static', 'Saved_Animations'))
-    liImages = [os.path.join(app.config['UPLOAD_FOLDER'], filename) for filename in liImages]
-    return render_template('main.html',
+    try:
+        liItems, sNextCursor = gallery_items()
+    except animationindex.CursorError as e:
+        return make_response(str(e), 400)
+    if sNextCursor:
+        dctLinks['Next Page'] = url_for('gallery', cursor=sNextCursor, per_page=request.args.get('per_page'))
+    return render_template('gallery.html',
                            title="Gallery",
                            dctLinks=dctLinks,
-                           images=liImages
+                           liItems=liItems
                            )
 
 
+@app.route('/gallery_page')
+def gallery_page():
+    """
+    Json version of the gallery, taking the same query string params.
+    Returns the page's items and the cursor of the next page, which is null on the last page.
+    """
+    try:
+        liItems, sNextCursor = gallery_items()
+    except animationindex.CursorError as e:
+        return make_response(str(e), 400)
+    return jsonify({"items": liItems, "next_cursor": sNextCursor})
+
+
+def gallery_items():
+    """
+    Look up the gallery page asked for by the request's cursor and per_page params. Raises
+    animationindex.CursorError for a malformed cursor.
+    :return: Tuple. (list of dictionaries of filename and urls for each fractal, cursor of the next page)
+    """
+    try:
+        lPerPage = min(max(int(request.args.get('per_page', 24)), 1), 200)
+    except ValueError:
+        lPerPage = 24
+    liRows, sNextCursor = animationindex.page_animations(request.args.get('cursor'), lPerPage)
+    liItems = []
+    for dctRow in liRows:
+        if dctRow["content_hash"] is None:
+            # Not hashed until the next reconcile
+            sUrl = url_for('static', filename='Saved_Animations/' + dctRow["filename"])
+            sPoster = url_for('static', filename='Thumbnails/' + thumbnails.poster_name(dctRow["filename"]))
+            sPreview = url_for('static', filename='Thumbnails/' + thumbnails.preview_name(dctRow["filename"]))
+        else:
+            sUrl = render_url(dctRow["filename"], dctRow["content_hash"])
+            sPoster = render_url(dctRow["filename"], dctRow["content_hash"], 'poster')
+            sPreview = render_url(dctRow["filename"], dctRow["content_hash"], 'preview')
+        if encoders.encoder_for_file(dctRow["filename"]).bVector:
+            # Vector animations are small enough, and scale well enough, to be their own thumbnails
+            sPoster = sPreview = sUrl
+        liItems.append({"filename": dctRow["filename"],
+                        "url": sUrl,
+                        "poster": sPoster,
+                        "preview": sPreview,
+                        "page": url_for('gif_page', filename=dctRow["filename"]),
+                        "width": dctRow["width"],
+                        "height": dctRow["height"],
+                        "frames": dctRow["frames"]
+                        })
+    return liItems, sNextCursor
+
+
 @app.route('/random')
 def random_gif():
     """
     Redirect to a random gif_page.
     """
-    fRandomGif = random.choice(os.listdir(os.path.join(Path(__file__).parent, 'static', 'Saved_Animations')))
+    fRandomGif = animationindex.random_animation()
+    if fRandomGif is None:
+        flash("No gifs saved yet")
+        return redirect(url_for('home'))
     return redirect(url_for('gif_page', filename=fRandomGif))
 
 
 @app.route('/submit_gif', methods=['POST', 'GET'])
 def submit_gif():
     """
-    Save gif supplied to Saved_Animations.
+    Save gif supplied to Saved_Animations. Uploads are stored by content: re-uploading an animation that is already
+    saved stores nothing and uses the saved one, and a different animation with a taken name is saved as name_1 etc.
     Can return json data or use that json data to create new fractal.
     """
     # if a file is specified, post to that file and start cloning
@@ -119,25 +324,42 @@ def submit_gif():
             flash("No selected file")
             return redirect(request.url)
         sFileName = secure_filename(fileChosen.filename)
-        if fileChosen and sFileName.rsplit('.', 1)[1].lower() == "gif":
-            sFileFullName = os.path.join(Path(__file__).parent, 'static', 'Saved_Animations', sFileName)
-            fileChosen.save(sFileFullName)
-            if sAskFor == 'nothing':
-                flash(sFileName + " uploaded")
-                return redirect(url_for('home'))
-            with Image.open(sFileFullName) as imgGif:
-                jsonBlueprint = imgGif.info["comment"].decode('ASCII')
-            if sAskFor == 'json':
-                return Markup.escape(jsonBlueprint)
-            # Default behavior is to clone the gif
-            with open(os.path.join(Path(__file__).parent, 'static', 'blueprint.json'), 'w+') as f:
-                f.truncate(0)
-                f.seek(0)
-                f.write(jsonBlueprint)
-            return redirect(url_for('making'))
-        else:
-            flash("Unexpected File Type")
+        try:
+            if isinstance(fileChosen.stream, uploads.UploadWriter):
+                sFileName, bNew = fileChosen.stream.commit()
+            else:
+                sFileName, bNew = uploads.store_upload(fileChosen.stream, sFileName)
+        except uploads.UploadTooLarge as e:
+            return str(e), 413
+        except uploads.UploadError as e:
+            flash(str(e))
+            return redirect(request.url)
+        if not encoders.encoder_for_file(sFileName).bVector and (bNew or not thumbnails.has_thumbnails(sFileName)):
+            try:
+                thumbnails.make_thumbnails(os.path.join(Path(__file__).parent, 'static', 'Saved_Animations',
+                                                        sFileName))
+            except (OSError, SyntaxError, ValueError) as e:
+                # Its blocks were readable but its images aren't
+                if bNew:
+                    uploads.discard_upload(sFileName)
+                flash("Not a readable animation: {}".format(e))
+                return redirect(request.url)
+        if sAskFor == 'nothing':
+            flash(sFileName + (" uploaded" if bNew else " was already uploaded"))
+            return redirect(url_for('home'))
+        jsonBlueprint = animationindex.get_animation(sFileName)["makerkey"]
+        if jsonBlueprint is None:
+            flash(sFileName + " has no makerkey")
             return redirect(request.url)
+        if sAskFor == 'json':
+            return Markup.escape(jsonBlueprint)
+        # Default behavior is to clone the gif
+        try:
+            sBlueprintId = blueprintStore.add(jsonBlueprint)
+        except blueprints.BlueprintError as e:
+            flash(str(e))
+            return redirect(url_for('home'))
+        return redirect(url_for('making', blueprint=sBlueprintId))
     else:
         return render_template('fileupload.html', postto=request.url)
 
@@ -145,7 +367,7 @@ def submit_gif():
 @app.route('/update_blueprint', methods=['POST', 'GET'])
 def update_blueprint_json():
     """
-    Update the blueprint.json used to supply the maker function.
+    Store an uploaded blueprint, which can then be made by passing its id to the maker function.
     """
     if request.method == 'POST':
         if 'myfile' not in request.files:
@@ -160,11 +382,14 @@ def update_blueprint_json():
             flash("Invalid file submitted")
             flash((sFileName.rsplit('.', 1)[1].lower()))
         else:
-            sFileFullName = os.path.join(Path(__file__).parent, 'static', 'blueprint.json')
-            fileChosen.save(sFileFullName)
+            try:
+                sBlueprintId = blueprintStore.add(fileChosen.read().decode('utf-8'))
+            except (blueprints.BlueprintError, UnicodeDecodeError) as e:
+                flash(str(e))
+                return redirect(url_for('home'))
             flash(sFileName + " set to blueprint")
             if request.args.get('goto'):
-                return redirect(url_for(request.args.get('goto')))
+                return redirect(url_for(request.args.get('goto'), blueprint=sBlueprintId))
         return redirect(url_for('home'))
     else:
         return render_template('fileupload.html', postto=request.url)
@@ -173,30 +398,184 @@ def update_blueprint_json():
 @app.route('/making', methods=['GET'])
 def making():
     """
-    Generate a new fractal based on the blueprint.json.
+    Generate a new fractal based on the blueprint given by id in the query string, or static/blueprint.json if none is.
     loading.html contains javascript to show console logs while fractal generates. Redirects when finished.
     """
+    sBlueprintId = request.args.get('blueprint') or default_blueprint_id()
+    if blueprintStore.get(sBlueprintId) is None:
+        flash("Unknown blueprint " + sBlueprintId)
+        return redirect(url_for('home'))
+    sFormat = request.args.get('format')
+    if sFormat is not None and sFormat not in encoders.dctEncoders:
+        flash("Unknown format " + sFormat)
+        return redirect(url_for('home'))
+    sFormatData = "" if sFormat is None else ", 'format' : '" + sFormat + "'"
     return render_template('loading.html',
                            ajaxType='POST',
                            ajaxUrl=request.url_root + url_for('make_a_gif')[1:],
-                           ajaxData="{ 'blueprint' : 'blueprint.json' }",
-                           ajaxSuccess="window.location.replace('" +
-                                       url_for('gif_page', filename='') +
-                                       "' + response);"
+                           ajaxData="{ 'blueprint' : '" + sBlueprintId + "'" + sFormatData + " }",
+                           ajaxSuccess="followJob(response);",
+                           jobStatusUrl=url_for('job_status', job_id=''),
+                           jobEventsUrl=url_for('job_events', job_id=''),
+                           jobCancelUrl=url_for('cancel_job', job_id=''),
+                           gifUrl=url_for('gif_page', filename='')
                            )
 
 
 @app.route('/maker_script', methods=['POST'])
 def make_a_gif():
     """
-    Script to generate a fractal based on the supplied .json filename.
+    Start a render job for a fractal based on the supplied blueprint id.
+    Returns the id of the job, which can be followed through /job_status and stopped through /cancel_job.
+    Passing any value as 'profile' runs the render under cProfile; the dump is served by /job_profile.
+    Passing 'format' (gif, webp, apng or svg) overrides the output format chosen by the blueprint.
+    """
+    sBlueprintId = request.form['blueprint']
+    dctMakerKey = blueprintStore.get(sBlueprintId)
+    if dctMakerKey is None:
+        return make_response("Unknown blueprint " + sBlueprintId, 404)
+    sFormat = request.form.get('format')
+    if sFormat:
+        if sFormat not in encoders.dctEncoders:
+            return make_response("Unknown format " + sFormat, 400)
+        dctMakerKey = dict(dctMakerKey, sFormat=sFormat)
+    sJobId = supervisor.submit(dctMakerKey, sBlueprintId=sBlueprintId, bProfile=bool(request.form.get('profile')))
+    return make_response(sJobId, 202)
+
+
+def default_blueprint_id():
+    """
+    Id of the example blueprint shipped in static/blueprint.json. It is only read and parsed the first time.
+    """
+    global sDefaultBlueprintId
+    if sDefaultBlueprintId is None:
+        with open(os.path.join(Path(__file__).parent, 'static', 'blueprint.json'), 'r') as f:
+            sDefaultBlueprintId = blueprintStore.add(f.read())
+    return sDefaultBlueprintId
+
+
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Report the state of a render job as json. Finished jobs include the gif filename as 'result'. Running jobs that
+    have drawn a generation already include the url of its frame as 'preview_url'.
+    """
+    dctStatus = job_status_dict(job_id)
+    if dctStatus["status"] == "unknown":
+        return make_response(jsonify(dctStatus), 404)
+    return jsonify(dctStatus)
+
+
+def job_status_dict(sJobId):
+    """
+    :return: Dictionary. The status of a job as job_status reports it, with status 'unknown' for unknown jobs.
+    """
+    dctStatus = supervisor.status(sJobId)
+    if dctStatus is None:
+        return {"id": sJobId, "status": "unknown"}
+    if dctStatus["result"]:
+        dctStatus["result"] = dctStatus["result"].rsplit('/', 1)[1]
+    dctStatus["preview_url"] = None
+    if dctStatus["preview"] is not None and dctStatus["status"] == "running":
+        dctStatus["preview_url"] = url_for('job_preview', job_id=sJobId, generation=dctStatus["preview"])
+    return dctStatus
+
+
+def is_settled(dctStatus):
+    """
+    :return: Boolean. Whether a job's status will never change again: it finished, or is unknown.
+    """
+    return dctStatus["status"] not in ("queued", "running")
+
+
+def server_sent_event(sData):
+    """
+    :return: String. sData as one server-sent event, a data line per line of it.
+    """
+    return "".join("data: " + sLine + "\n" for sLine in sData.split("\n")) + "\n"
+
+
+def poll_events(fncRead, fncIsLast):
+    """
+    Server-sent events of whatever fncRead returns, checked every fEventPollInterval seconds and sent each time it
+    changes, with a keep-alive comment after fEventKeepAlive seconds without one. Writing the comment is what tells a
+    threaded server the viewer has gone, so the thread isn't held until the next change. Ends after the event
+    fncIsLast is true of, or fEventMaxSeconds.
+    :param fncRead: Function. Returns the event data as a string.
+    :param fncIsLast: Function. Whether event data is the last the stream sends.
+    """
+    fStart = fSent = time.monotonic()
+    sLast = None
+    while True:
+        sData = fncRead()
+        if sData != sLast:
+            yield server_sent_event(sData)
+            if fncIsLast(sData):
+                return
+            sLast, fSent = sData, time.monotonic()
+        elif time.monotonic() - fSent >= fEventKeepAlive:
+            yield ": keep-alive\n\n"
+            fSent = time.monotonic()
+        if time.monotonic() - fStart >= fEventMaxSeconds:
+            return
+        time.sleep(fEventPollInterval)
+
+
+@app.route('/job_events/<job_id>', methods=['GET'])
+def job_events(job_id):
     """
-    with open(os.path.join(Path(__file__).parent, 'static', request.form['blueprint']), 'r') as f:
-        jsonBlueprint = f.read()
-    dctMakerKey = json.loads(jsonBlueprint, cls=junkdrawer.JeffSONDecoder)
-    sResponse = renderer.render_2d_frame_by_frame_animation(**dctMakerKey)
-    sResponse = sResponse.rsplit('/', 1)[1]
-    return make_response(sResponse, 200)
+    Stream a render job's status as server-sent events, each the json job_status would give, one whenever it changes.
+    The stream ends once the job has finished. This one polls (see poll_events) and holds a thread while it waits;
+    asgiapp serves the same stream waiting on the supervisor instead.
+    """
+    itEvents = poll_events(lambda: json.dumps(job_status_dict(job_id)), lambda sData: is_settled(json.loads(sData)))
+    return app.response_class(stream_with_context(itEvents), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/job_preview/<job_id>/<int:generation>', methods=['GET'])
+def job_preview(job_id, generation):
+    """
+    The frame of one generation of a running job, as a png, for the loading page to show until the gif is done.
+    Previews disappear with the job's work directory once it finishes.
+    """
+    sWorkDir = supervisor.work_dir(job_id)
+    if sWorkDir is None:
+        return make_response("No job " + job_id, 404)
+    sPath = os.path.join(Path(__file__).parent, jobs.preview_path(sWorkDir, generation))
+    if not os.path.isfile(sPath):
+        return make_response("No preview of generation {} for job {}".format(generation, job_id), 404)
+    # A generation's frame never changes while the job runs, and its url dies with the job
+    return send_file(sPath, mimetype='image/png', max_age=60)
+
+
+@app.route('/job_profile/<job_id>', methods=['GET'])
+def job_profile(job_id):
+    """
+    Download the cProfile stats of a finished job that was started with profiling on.
+    """
+    dctStatus = supervisor.status(job_id)
+    if dctStatus is None or dctStatus["profile"] is None:
+        return make_response("No profile for job " + job_id, 404)
+    return send_file(os.path.join(Path(__file__).parent, dctStatus["profile"]), as_attachment=True)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Render metrics in the Prometheus text format. Covers the jobs run by this process.
+    """
+    return make_response(metrics.registry.exposition(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@app.route('/cancel_job/<job_id>', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Stop a render job. Any partially written gif is discarded.
+    """
+    if not supervisor.cancel(job_id):
+        return make_response("No running job " + job_id, 404)
+    return make_response("Cancelling " + job_id, 202)
 
 
 @app.route('/test_printing')
@@ -221,25 +600,47 @@ def get_console():
     escape: any value will prep logs for html insertion
     lines: returns the last x lines
     """
-    global buffer
-    lines = request.args.get('lines')
-    escape = request.args.get('escape')
+    try:
+        return console_text(request.args.get('lines'), request.args.get('escape'))
+    except ValueError:
+        return "unknown lines parameter passed"
+
+
+def console_text(lines=None, escape=None):
+    """
+    The console logs as get_console returns them, taking its query string params. Raises ValueError for a lines
+    param that isn't a number.
+    """
     strOut = buffer.getvalue()
     if lines:
-        try:
-            lines = int(lines)
-            liOut = strOut.splitlines()
-            if len(liOut) < lines:
-                liOut += [''] * (lines - len(liOut))
-            strOut = "\n".join(liOut[-lines:])
-        except Exception as e:
-            return "unknown lines parameter passed"
+        lines = int(lines)
+        liOut = strOut.splitlines()
+        if len(liOut) < lines:
+            liOut += [''] * (lines - len(liOut))
+        strOut = "\n".join(liOut[-lines:])
     if escape:
         strOut = str(Markup.escape(strOut))
         strOut = strOut.replace("\n", "<br>")
     return strOut
 
 
+@app.route('/console_events', methods=['GET'])
+def console_events():
+    """
+    Stream the console logs as server-sent events, each what get_console would give, one whenever they change.
+    Takes get_console's query string params. Like job_events, asgiapp serves this without holding a thread.
+    """
+    try:
+        console_text(request.args.get('lines'))
+    except ValueError:
+        return make_response("unknown lines parameter passed", 400)
+
+    itEvents = poll_events(lambda: console_text(request.args.get('lines'), request.args.get('escape')),
+                           lambda sData: False)
+    return app.response_class(stream_with_context(itEvents), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/reset_logs', methods=['GET'])
 def reset_logs():
     """
@@ -252,11 +653,17 @@ def reset_logs():
 
 
 def main():
+    bDebug = True
     old_stdout = sys.stdout
     sys.stdout = buffer
     try:
-        app.run(debug=True)
+        animationindex.reconcile()
+        # With the debug reloader, only the child process that actually serves requests should fork render workers
+        if not bDebug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            supervisor.start()
+        app.run(debug=bDebug)
     finally:
+        supervisor.shutdown()
         sys.stdout = old_stdout
 
 
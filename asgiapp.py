@@ -0,0 +1,357 @@
+from urllib.parse import unquote, parse_qs
+from werkzeug.wsgi import FileWrapper
+import tempfile
+import io
+import argparse
+import asyncio
+import json
+import sys
+import re
+
+# The web app, its supervisor and console logs, all shared with the Flask routes served through the bridge
+import app as webapp
+import animationindex
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+# Bytes per read of files streamed to clients, and of request bodies held in memory before spilling to disk
+lChunk = 1 << 16
+lSpool = 1 << 20
+# Seconds between comment lines keeping idle event streams open through proxies, as the Flask app's
+fKeepAlive = webapp.fEventKeepAlive
+# Seconds between checks of an event stream when the supervisor can't say when things change (jobtable's)
+fPollInterval = .5
+
+
+class Notifier:
+    """
+    Wakes coroutines waiting for news of a key, e.g. a job id, from whatever thread has the news, as
+    jobs.JobSupervisor's monitor thread does. Every coroutine waiting on a key shares one asyncio.Event, so thousands
+    of viewers of a job cost one wake-up between them, and none holds a thread while it waits.
+    """
+    def __init__(self):
+        self.objLoop = None
+        self.dctEvents = {}
+
+    def bind(self, objLoop):
+        self.objLoop = objLoop
+
+    def notify(self, objKey):
+        """
+        Wake everything waiting on objKey. Safe to call from any thread.
+        """
+        if self.objLoop is not None and not self.objLoop.is_closed():
+            self.objLoop.call_soon_threadsafe(self._wake, objKey)
+
+    def _wake(self, objKey):
+        evtNews = self.dctEvents.pop(objKey, None)
+        if evtNews is not None:
+            evtNews.set()
+
+    def news(self, objKey):
+        """
+        :return: asyncio.Event. Set at the next news of objKey. Taken before reading what the news would be of, so
+            news arriving during the read isn't missed.
+        """
+        evtNews = self.dctEvents.get(objKey)
+        if evtNews is None:
+            evtNews = self.dctEvents[objKey] = asyncio.Event()
+        return evtNews
+
+
+def wsgi_environ(scope, fBody, lLength):
+    """
+    :return: Dictionary. The WSGI environ of an ASGI http request, with its body read into fBody. Files the app sends
+        are wrapped to be read lChunk at a time.
+    """
+    sPath = scope["path"].encode('utf-8').decode('latin-1')
+    tServer = scope.get("server") or ("localhost", 80)
+    dctEnviron = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode('utf-8').decode('latin-1'),
+        "PATH_INFO": sPath,
+        "QUERY_STRING": scope["query_string"].decode('latin-1'),
+        "SERVER_NAME": tServer[0],
+        "SERVER_PORT": str(tServer[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "CONTENT_LENGTH": str(lLength),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": fBody,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": lambda f, lBlockSize=lChunk: FileWrapper(f, max(lBlockSize, lChunk)),
+    }
+    if scope.get("client"):
+        dctEnviron["REMOTE_ADDR"] = scope["client"][0]
+    for bName, bValue in scope["headers"]:
+        sName = bName.decode('latin-1').upper().replace("-", "_")
+        sValue = bValue.decode('latin-1')
+        if sName == "CONTENT_TYPE":
+            dctEnviron["CONTENT_TYPE"] = sValue
+            continue
+        if sName == "CONTENT_LENGTH":
+            continue
+        sKey = "HTTP_" + sName
+        dctEnviron[sKey] = dctEnviron[sKey] + "," + sValue if sKey in dctEnviron else sValue
+    return dctEnviron
+
+
+class AsgiApp:
+    """
+    The web app as an ASGI application, for a server like uvicorn to hold thousands of viewers in one process while
+    renders run in the supervisor's workers.
+    Progress is streamed natively: job_events and console_events wait on the supervisor's news (see
+    jobs.JobSupervisor.add_listener) rather than polling, and get_console is answered without leaving the event loop.
+    Every other route, the gallery, random and gif and json pages among them, is the Flask app's, called through a
+    WSGI bridge on the event loop's thread pool. Responses are streamed from there a chunk at a time, so a large
+    animation's file is read off the event loop and no thread is held between its chunks.
+    """
+    def __init__(self, objFlask=None, objSupervisor=None):
+        self.objFlask = objFlask or webapp.app
+        self.objSupervisor = objSupervisor or webapp.supervisor
+        self.objNotifier = Notifier()
+        self.bListening = False
+        self.liRoutes = [(re.compile(r"/job_events/(?P<job_id>[^/]+)"), self.job_events),
+                         (re.compile(r"/console_events"), self.console_events),
+                         (re.compile(r"/get_console"), self.get_console)]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        self.listen()
+        if scope["method"] == "GET":
+            for objPattern, fncRoute in self.liRoutes:
+                objMatch = objPattern.fullmatch(scope["path"])
+                if objMatch is not None:
+                    await fncRoute(scope, receive, send, **{sKey: unquote(sValue)
+                                                            for sKey, sValue in objMatch.groupdict().items()})
+                    return
+        await self.bridge(scope, receive, send)
+
+    def listen(self):
+        """
+        Start taking the supervisor's news on the running event loop.
+        """
+        if self.bListening:
+            return
+        self.bListening = True
+        self.objNotifier.bind(asyncio.get_running_loop())
+        # jobtable.TableSupervisor has no news to give, and is polled instead
+        if hasattr(self.objSupervisor, "add_listener"):
+            self.objSupervisor.add_listener(self.objNotifier.notify)
+
+    async def lifespan(self, receive, send):
+        """
+        Start up and shut down as app.main does around the Flask development server.
+        """
+        objLoop = asyncio.get_running_loop()
+        while True:
+            dctMessage = await receive()
+            if dctMessage["type"] == "lifespan.startup":
+                self.listen()
+                await objLoop.run_in_executor(None, animationindex.reconcile)
+                self.objSupervisor.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif dctMessage["type"] == "lifespan.shutdown":
+                await objLoop.run_in_executor(None, self.objSupervisor.shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def wait(self, evtNews, evtDisconnected, fTimeout):
+        """
+        Wait for evtNews, the client going away, or fTimeout seconds, whichever comes first.
+        """
+        fTimeout = fTimeout if hasattr(self.objSupervisor, "add_listener") else min(fTimeout, fPollInterval)
+        liWaits = [asyncio.ensure_future(evtNews.wait()), asyncio.ensure_future(evtDisconnected.wait())]
+        await asyncio.wait(liWaits, timeout=fTimeout, return_when=asyncio.FIRST_COMPLETED)
+        for tsk in liWaits:
+            tsk.cancel()
+
+    async def event_stream(self, receive, send, objKey, fncRead, fncIsLast, fMaxWait=fKeepAlive):
+        """
+        Send server-sent events of something each time it changes, reading it again whenever there is news of objKey,
+        until the client goes away, fncIsLast says it's the last of it, or app.fEventMaxSeconds have passed as in the
+        Flask app's streams.
+        :param fncRead: Coroutine function. Returns the event data as a string.
+        :param fncIsLast: Function. Whether event data is the last the stream sends.
+        :param fMaxWait: Float. Seconds it is left at most without reading it again, for changes no news is given of.
+        """
+        objLoop = asyncio.get_running_loop()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")]})
+        evtDisconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            evtDisconnected.set()
+        tskWatch = asyncio.ensure_future(watch())
+        try:
+            sLast = None
+            fStart = fSent = objLoop.time()
+            while True:
+                evtNews = self.objNotifier.news(objKey)
+                sData = await fncRead()
+                if sData != sLast:
+                    bLast = fncIsLast(sData)
+                    await send({"type": "http.response.body", "body": webapp.server_sent_event(sData).encode('utf-8'),
+                                "more_body": not bLast})
+                    if bLast:
+                        return
+                    sLast, fSent = sData, objLoop.time()
+                elif objLoop.time() - fSent >= fKeepAlive:
+                    await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+                    fSent = objLoop.time()
+                if objLoop.time() - fStart >= webapp.fEventMaxSeconds:
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+                fNow = objLoop.time()
+                fWait = min(fMaxWait, fSent + fKeepAlive - fNow, fStart + webapp.fEventMaxSeconds - fNow)
+                await self.wait(evtNews, evtDisconnected, max(fWait, 0))
+                if evtDisconnected.is_set():
+                    return
+        finally:
+            tskWatch.cancel()
+
+    async def job_events(self, scope, receive, send, job_id):
+        """
+        app.job_events, woken by the supervisor whenever the job changes.
+        """
+        dctEnviron = wsgi_environ(scope, io.BytesIO(), 0)
+        objLoop = asyncio.get_running_loop()
+
+        def status():
+            # Preview urls are built for the request, as job_status builds them
+            with self.objFlask.request_context(dctEnviron):
+                return json.dumps(webapp.job_status_dict(job_id))
+
+        await self.event_stream(receive, send, job_id, lambda: objLoop.run_in_executor(None, status),
+                                lambda sData: webapp.is_settled(json.loads(sData)))
+
+    async def console_events(self, scope, receive, send):
+        """
+        app.console_events, woken whenever the workers write to the console. Output from the web process itself
+        isn't announced, and is picked up within fPollInterval.
+        """
+        dctArgs = query_args(scope)
+        try:
+            webapp.console_text(dctArgs.get("lines"))
+        except ValueError:
+            await respond(send, 400, b"unknown lines parameter passed")
+            return
+
+        async def read():
+            return webapp.console_text(dctArgs.get("lines"), dctArgs.get("escape"))
+
+        await self.event_stream(receive, send, None, read, lambda sData: False, fPollInterval)
+
+    async def get_console(self, scope, receive, send):
+        """
+        app.get_console, straight from the in-memory logs.
+        """
+        dctArgs = query_args(scope)
+        try:
+            sText = webapp.console_text(dctArgs.get("lines"), dctArgs.get("escape"))
+        except ValueError:
+            sText = "unknown lines parameter passed"
+        await respond(send, 200, sText.encode('utf-8'), b"text/html; charset=utf-8")
+
+    async def bridge(self, scope, receive, send):
+        """
+        Serve a request with the Flask app. Its body is read in first, spilling to disk past lSpool bytes, and
+        refused with a 413 past the app's MAX_CONTENT_LENGTH, as the Flask development server would.
+        """
+        objLoop = asyncio.get_running_loop()
+        lMaxLength = self.objFlask.config.get('MAX_CONTENT_LENGTH')
+        fBody = tempfile.SpooledTemporaryFile(lSpool)
+        try:
+            lLength = 0
+            while True:
+                dctMessage = await receive()
+                if dctMessage["type"] == "http.disconnect":
+                    return
+                bChunk = dctMessage.get("body", b"")
+                lLength += len(bChunk)
+                if lMaxLength is not None and lLength > lMaxLength:
+                    await respond(send, 413, b"Request Entity Too Large")
+                    return
+                if bChunk:
+                    if lLength > lSpool:
+                        await objLoop.run_in_executor(None, fBody.write, bChunk)
+                    else:
+                        fBody.write(bChunk)
+                if not dctMessage.get("more_body", False):
+                    break
+            fBody.seek(0)
+            dctEnviron = wsgi_environ(scope, fBody, lLength)
+            liStart = []
+
+            def start_response(sStatus, liHeaders, tExcInfo=None):
+                liStart[:] = [sStatus, liHeaders]
+
+            itBody = await objLoop.run_in_executor(None, self.objFlask.wsgi_app, dctEnviron, start_response)
+            try:
+                itChunks = iter(itBody)
+                bChunk = await objLoop.run_in_executor(None, next, itChunks, None)
+                sStatus, liHeaders = liStart
+                await send({"type": "http.response.start", "status": int(sStatus.split(" ", 1)[0]),
+                            "headers": [(sName.lower().encode('latin-1'), sValue.encode('latin-1'))
+                                        for sName, sValue in liHeaders]})
+                while bChunk is not None:
+                    bNext = await objLoop.run_in_executor(None, next, itChunks, None)
+                    if bChunk:
+                        await send({"type": "http.response.body", "body": bChunk, "more_body": bNext is not None})
+                    bChunk = bNext
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(itBody, "close"):
+                    await objLoop.run_in_executor(None, itBody.close)
+        finally:
+            fBody.close()
+
+
+def query_args(scope):
+    """
+    :return: Dictionary. The first value of each of an ASGI request's query string params.
+    """
+    return {sKey: liValues[0] for sKey, liValues in parse_qs(scope["query_string"].decode('latin-1')).items()}
+
+
+async def respond(send, lStatus, bBody, bContentType=b"text/plain; charset=utf-8"):
+    await send({"type": "http.response.start", "status": lStatus,
+                "headers": [(b"content-type", bContentType), (b"content-length", str(len(bBody)).encode('ascii'))]})
+    await send({"type": "http.response.body", "body": bBody})
+
+
+application = AsgiApp()
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Serve the web app on an ASGI server.")
+    objParser.add_argument("--host", default="127.0.0.1")
+    objParser.add_argument("--port", type=int, default=5000)
+    objArgs = objParser.parse_args()
+    if uvicorn is None:
+        sys.exit("uvicorn isn't installed; `pip install uvicorn`, or serve asgiapp:application with another ASGI "
+                 "server")
+    old_stdout = sys.stdout
+    # The console logs the loading page shows, as app.main collects them
+    sys.stdout = webapp.buffer
+    try:
+        uvicorn.run(application, host=objArgs.host, port=objArgs.port, lifespan="on")
+    finally:
+        sys.stdout = old_stdout
+
+
+if __name__ == "__main__":
+    main()
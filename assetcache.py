@@ -0,0 +1,93 @@
+import collections as col
+import threading
+import os
+
+from markupsafe import Markup
+
+import junkdrawer
+import animationindex
+
+lDigestLength = 16
+
+
+class AssetCache:
+    """
+    Content hashes and makerkeys of saved animations, kept in memory for the web tier so that serving an animation's
+    validators, immutable urls or makerkey json costs a stat rather than a trip to the index or the file.
+    An entry is trusted as long as the file's size and mtime haven't changed, the same test reconcile uses. Makerkeys
+    are cached by content hash, so copies of an animation under other names share theirs.
+    """
+    def __init__(self, lCapacity=1024, sFolder=None, sIndex=None):
+        """
+        :param lCapacity: Integer. Number of animations, and of makerkeys, kept in memory.
+        :param sFolder: String. Folder of animations. Defaults to junkdrawer.sSavedAnimationsFolder.
+        :param sIndex: String. Path of the animation index sqlite file.
+        """
+        self.lCapacity = lCapacity
+        self.sFolder = sFolder or junkdrawer.sSavedAnimationsFolder
+        self.sIndex = sIndex
+        self.odEntries = col.OrderedDict()
+        self.odMakerKeys = col.OrderedDict()
+        self.objLock = threading.Lock()
+
+    def _remember(self, odCache, sKey, objValue):
+        with self.objLock:
+            odCache[sKey] = objValue
+            odCache.move_to_end(sKey)
+            while len(odCache) > self.lCapacity:
+                odCache.popitem(last=False)
+
+    def lookup(self, sBaseName):
+        """
+        :param sBaseName: String. File name of an animation in the folder, already passed through secure_filename.
+        :return: Dictionary. path, size, mtime and hash (hex digest of the file's bytes) of the animation, or None if
+            there is no such file or it can't be read as an animation. Files not indexed yet, or changed since, are
+            (re)indexed.
+        """
+        sPath = os.path.join(self.sFolder, sBaseName)
+        try:
+            objStat = os.stat(sPath)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        with self.objLock:
+            dctEntry = self.odEntries.get(sBaseName)
+            if dctEntry is not None and (dctEntry["size"], dctEntry["mtime"]) == (objStat.st_size, objStat.st_mtime):
+                self.odEntries.move_to_end(sBaseName)
+                return dctEntry
+        dctRow = animationindex.get_animation(sBaseName, self.sIndex)
+        if (dctRow is None or dctRow["content_hash"] is None
+                or (dctRow["size"], dctRow["mtime"]) != (objStat.st_size, objStat.st_mtime)):
+            try:
+                animationindex.add_animation(sPath, sIndex=self.sIndex)
+            except (OSError, SyntaxError, ValueError) as e:
+                # Not an animation that can be read, e.g. empty or truncated: served as though it weren't there
+                print("Couldn't index {}: {}".format(sPath, e))
+                return None
+            dctRow = animationindex.get_animation(sBaseName, self.sIndex)
+        dctEntry = {"path": sPath, "size": dctRow["size"], "mtime": dctRow["mtime"], "hash": dctRow["content_hash"]}
+        self._remember(self.odEntries, sBaseName, dctEntry)
+        if dctRow["content_hash"] not in self.odMakerKeys:
+            self._remember(self.odMakerKeys, dctRow["content_hash"], Markup.escape(dctRow["makerkey"] or ""))
+        return dctEntry
+
+    def makerkey(self, dctEntry):
+        """
+        :param dctEntry: Dictionary. As returned by lookup.
+        :return: Markup. The animation's makerkey json, escaped for the page.
+        """
+        with self.objLock:
+            mkMakerKey = self.odMakerKeys.get(dctEntry["hash"])
+            if mkMakerKey is not None:
+                self.odMakerKeys.move_to_end(dctEntry["hash"])
+                return mkMakerKey
+        dctRow = animationindex.get_animation(os.path.basename(dctEntry["path"]), self.sIndex)
+        mkMakerKey = Markup.escape(dctRow["makerkey"] or "") if dctRow is not None else Markup("")
+        self._remember(self.odMakerKeys, dctEntry["hash"], mkMakerKey)
+        return mkMakerKey
+
+
+def digest(dctEntry):
+    """
+    :return: String. The short form of an animation's content hash used in its immutable urls.
+    """
+    return dctEntry["hash"][:lDigestLength]
@@ -0,0 +1,242 @@
+import multiprocessing
+import argparse
+import copy
+import json
+import os
+
+import numpy as np
+
+import junkdrawer
+import generationcache
+import rulesandinstructions
+import animationindex
+import blueprints
+import encoders
+import jobs
+
+sStateFile = 'batch_state.jsonl'
+
+
+def load_makerkey(sFileName):
+    """
+    Read one makerkey from a .json file or from the metadata of a fractal animation (e.g. the comment of a .gif).
+    :param sFileName: String. Path of the file.
+    :return: Dictionary. Validated makerkey.
+    """
+    if sFileName.lower().endswith(encoders.tExtensions):
+        sMakerKey = encoders.read_makerkey(sFileName)
+        if sMakerKey is None:
+            raise blueprints.BlueprintError(sFileName + " has no makerkey")
+        return blueprints.parse_blueprint(sMakerKey)
+    with open(sFileName, 'r') as f:
+        return blueprints.parse_blueprint(f.read())
+
+
+def expand_angles(objAngles):
+    """
+    :param objAngles: List of angles in degrees, or a dictionary with start, stop and step (stop included).
+    :return: List. Angles in degrees.
+    """
+    if isinstance(objAngles, dict):
+        return [float(f) for f in np.arange(objAngles["start"], objAngles["stop"] + objAngles["step"] / 2,
+                                            objAngles["step"])]
+    return [float(f) for f in objAngles]
+
+
+def expand_sweep(dctSweep):
+    """
+    Every combination of the angles, seeds and iteration counts of a sweep spec, applied to its base makerkey.
+    The angle replaces the rotations of std_2d_instructions in the base instructions; other instructions are kept.
+    :param dctSweep: Dictionary. {"base": makerkey or path of a .json or animation, "angles": [...] or {"start", "stop",
+        "step"}, "seeds": [...], "iterations": [...]}. Every key but base is optional.
+    :return: List. Validated makerkeys.
+    """
+    objBase = dctSweep["base"]
+    if isinstance(objBase, str):
+        dctBase = load_makerkey(objBase)
+    else:
+        dctBase = blueprints.parse_blueprint(json.dumps(objBase))
+    liAngles = expand_angles(dctSweep["angles"]) if "angles" in dctSweep else [None]
+    liSeeds = dctSweep.get("seeds", [dctBase.get("lSeed")])
+    liIterations = dctSweep.get("iterations", [dctBase["lItPerLoop"]])
+    liOut = []
+    for fAngle in liAngles:
+        for lSeed in liSeeds:
+            for lIterations in liIterations:
+                dctMakerKey = copy.deepcopy(dctBase)
+                liSuffix = []
+                if fAngle is not None:
+                    dctMakerKey["dctInstructions"].update(rulesandinstructions.std_2d_instructions(np.radians(fAngle)))
+                    liSuffix.append("a" + "{:g}".format(fAngle).replace('.', 'p').replace('-', 'm'))
+                if lSeed is not None:
+                    dctMakerKey["lSeed"] = lSeed
+                    liSuffix.append("s{}".format(lSeed))
+                dctMakerKey["lItPerLoop"] = lIterations
+                liSuffix.append("i{}".format(lIterations))
+                dctMakerKey["sName"] = "_".join([dctBase["sName"]] + liSuffix)
+                blueprints.validate_blueprint(dctMakerKey)
+                liOut.append(dctMakerKey)
+    return liOut
+
+
+def load_items(sSource):
+    """
+    Makerkeys to render, from a folder of .json files and fractal animations, a .jsonl file with one makerkey per
+    line, a .json sweep spec (see expand_sweep) or a single .json makerkey.
+    :param sSource: String. Path.
+    :return: List. Validated makerkeys.
+    """
+    if os.path.isdir(sSource):
+        return [load_makerkey(os.path.join(sSource, sBaseName)) for sBaseName in sorted(os.listdir(sSource))
+                if sBaseName.lower().endswith(('.json',) + encoders.tExtensions)]
+    with open(sSource, 'r') as f:
+        if sSource.lower().endswith('.jsonl'):
+            return [blueprints.parse_blueprint(sLine) for sLine in f if sLine.strip()]
+        dctSpec = json.load(f)
+    if isinstance(dctSpec, dict) and "base" in dctSpec:
+        return expand_sweep(dctSpec)
+    return [blueprints.parse_blueprint(json.dumps(dctSpec))]
+
+
+def generation_key(dctMakerKey):
+    """
+    Renders with the same rules, axiom and seed rewrite to the same strings, whatever their instructions; and a render
+    of fewer iterations sees a prefix of the generations of one with more.
+    """
+    return animationindex.rules_hash(dctMakerKey["liRules"]), dctMakerKey["sStartingString"], dctMakerKey.get("lSeed")
+
+
+def generate(tTask):
+    """
+    Pool task computing the generation strings shared by a group of renders, through the generation cache.
+    :param tTask: Tuple. (generation key, rules, number of generations)
+    :return: Tuple. (generation key, list of strings or None, error message or None)
+    """
+    tKey, liRules, lGenerations = tTask
+    try:
+        return tKey, list(generationcache.lindenator(liRules, tKey[1], tKey[2], lMaxReturns=lGenerations)), None
+    except Exception as e:
+        return tKey, None, "{}: {}".format(type(e).__name__, e)
+
+
+def render(tTask):
+    """
+    Pool task rendering one makerkey from its precomputed generations.
+    :param tTask: Tuple. (item id, makerkey, generation strings or None to rewrite them out of core)
+    :return: Dictionary. State record of the item.
+    """
+    import renderer
+    sId, dctMakerKey, liGenerations = tTask
+    try:
+        if dctMakerKey.get("lDimensions", 2) == 3:
+            # 3D renders have no out-of-core path, and rewrite in memory what wasn't precomputed
+            sFileName = renderer.render_animation(**dctMakerKey, liGenerations=liGenerations)
+        else:
+            sFileName = renderer.render_animation(**dctMakerKey, liGenerations=liGenerations,
+                                                  bOutOfCore=liGenerations is None)
+        return {"id": sId, "name": dctMakerKey["sName"], "status": "done", "file": sFileName}
+    except Exception as e:
+        return {"id": sId, "name": dctMakerKey["sName"], "status": "failed",
+                "error": "{}: {}".format(type(e).__name__, e)}
+
+
+def read_state(sState):
+    """
+    :return: Dictionary. Latest state record of each item id in the state file.
+    """
+    dctState = {}
+    if os.path.exists(sState):
+        with open(sState, 'r') as f:
+            for sLine in f:
+                if sLine.strip():
+                    dctRecord = json.loads(sLine)
+                    dctState[dctRecord["id"]] = dctRecord
+    return dctState
+
+
+def run(liMakerKeys, sState=None, lProcesses=None, fncReport=print, bOutOfCore=False):
+    """
+    Render makerkeys in parallel, rewriting each distinct (rules, axiom, seed) only once.
+    Progress is appended to a state file as each item finishes, and items already recorded as done there are skipped,
+    so rerunning the same batch after a crash or failures only renders what is left.
+    :param liMakerKeys: List. Validated makerkeys.
+    :param sState: String. Path of the state file. Defaults to sStateFile.
+    :param lProcesses: Integer. Worker processes. Defaults to the number of cores.
+    :param fncReport: Function. Called with each state record.
+    :param bOutOfCore: Boolean. Render out of core (see outofcore). Generations are then shared through the
+        generation cache instead of being handed to the renders.
+    :return: List. State records of the items rendered or failed in this run.
+    """
+    sState = sState or sStateFile
+    setDone = {sId for sId, dctRecord in read_state(sState).items() if dctRecord["status"] == "done"}
+    dctItems = {}
+    for dctMakerKey in liMakerKeys:
+        sId = blueprints.blueprint_id(dctMakerKey)
+        if sId not in setDone:
+            dctItems[sId] = dctMakerKey
+    dctGroups = {}
+    for sId, dctMakerKey in dctItems.items():
+        tKey = generation_key(dctMakerKey)
+        liRules, lGenerations = dctGroups.get(tKey, (dctMakerKey["liRules"], 0))
+        dctGroups[tKey] = (liRules, max(lGenerations, dctMakerKey["lItPerLoop"]))
+
+    liRecords = []
+    with open(sState, 'a') as fState, \
+            multiprocessing.Pool(lProcesses, initializer=jobs.warm_worker) as objPool:
+        def record(dctRecord):
+            fState.write(json.dumps(dctRecord) + "\n")
+            fState.flush()
+            liRecords.append(dctRecord)
+            fncReport(dctRecord)
+
+        dctGenerations = {}
+        dctErrors = {}
+        if bOutOfCore:
+            dctErrors = dict.fromkeys(dctGroups)
+        else:
+            for tKey, liGenerations, sError in objPool.imap_unordered(
+                    generate, [(tKey, liRules, lGenerations) for tKey, (liRules, lGenerations) in dctGroups.items()]):
+                dctGenerations[tKey] = liGenerations
+                dctErrors[tKey] = sError
+        liTasks = []
+        for sId, dctMakerKey in dctItems.items():
+            tKey = generation_key(dctMakerKey)
+            if dctErrors[tKey] is not None:
+                record({"id": sId, "name": dctMakerKey["sName"], "status": "failed", "error": dctErrors[tKey]})
+            else:
+                liTasks.append((sId, dctMakerKey,
+                                None if bOutOfCore else dctGenerations[tKey][:dctMakerKey["lItPerLoop"]]))
+        for dctRecord in objPool.imap_unordered(render, liTasks):
+            record(dctRecord)
+    return liRecords
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Render many makerkeys, or a parameter sweep, in parallel.")
+    objParser.add_argument("source",
+                           help="folder of .json makerkeys or animations, .jsonl of makerkeys, or .json sweep spec")
+    objParser.add_argument("--processes", type=int, help="worker processes (default: number of cores)")
+    objParser.add_argument("--state", default=sStateFile, help="progress file; done items in it are skipped")
+    objParser.add_argument("--list", action="store_true", help="print the items of the batch without rendering")
+    objParser.add_argument("--out-of-core", action="store_true",
+                           help="keep generations and line segments in memory mapped files, for very large renders")
+    objArgs = objParser.parse_args()
+
+    liMakerKeys = load_items(objArgs.source)
+    if objArgs.list:
+        for dctMakerKey in liMakerKeys:
+            print(blueprints.blueprint_id(dctMakerKey), dctMakerKey["sName"])
+        return
+    os.makedirs(junkdrawer.sSavedAnimationsFolder, exist_ok=True)
+    liRecords = run(liMakerKeys, objArgs.state, objArgs.processes,
+                    lambda dctRecord: print("{status}: {name} {}".format(dctRecord.get("file", dctRecord.get("error")),
+                                                                         **dctRecord)),
+                    objArgs.out_of_core)
+    lFailed = sum(dctRecord["status"] == "failed" for dctRecord in liRecords)
+    print("{} rendered, {} failed".format(len(liRecords) - lFailed, lFailed))
+    if lFailed:
+        print("Run again with the same --state to retry the failed items.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from collections import namedtuple
+from contextlib import redirect_stdout
+from datetime import datetime
+import tracemalloc
+import platform
+import argparse
+import random
+import json
+import time
+import sys
+import io
+import os
+
+import lindenmayer
+import rulesandinstructions
+import kernels
+import renderer
+import junkdrawer
+import gifblocks
+import lineart
+
+
+sResultsFolder = 'benchmark_results'
+
+
+def blueprint_case():
+    with open(os.path.join('static', 'blueprint.json'), 'r') as f:
+        dctMakerKey = json.load(f, cls=junkdrawer.JeffSONDecoder)
+    return {"name": "blueprint",
+            "liRules": dctMakerKey["liRules"],
+            "dctInstructions": dctMakerKey["dctInstructions"],
+            "sAxiom": dctMakerKey["sStartingString"],
+            "npaStartPos": dctMakerKey["npaStartPos"],
+            "npaStartFac": dctMakerKey["npaStartFac"],
+            "tAspectRatio": tuple(dctMakerKey["tAspectRatio"]),
+            "liGenerations": [2, 4, 6]}
+
+
+def std_cases():
+    """
+    The shipped rule sets, each with the axiom and instructions it is normally drawn with and the generation counts
+    to benchmark it at. Koch grows fourteen-fold a generation, so it stops earlier than the plants.
+    """
+    dctPlantInstructions = rulesandinstructions.std_2d_instructions(np.pi * 0.125)
+    return [
+        {"name": "koch",
+         "liRules": rulesandinstructions.liKochCurveRules,
+         "dctInstructions": rulesandinstructions.dct2dStdInstructions,
+         "sAxiom": "",
+         "npaStartPos": None,
+         "npaStartFac": np.array([1, 0]),
+         "tAspectRatio": (1, 1),
+         "liGenerations": [2, 3, 4]},
+        {"name": "plant1",
+         "liRules": rulesandinstructions.liPlant1Rules,
+         "dctInstructions": dctPlantInstructions,
+         "sAxiom": "X",
+         "npaStartPos": np.array([.5, 0]),
+         "npaStartFac": np.array([0, 1]),
+         "tAspectRatio": (1, 1),
+         "liGenerations": [2, 4, 6]},
+        {"name": "plant2",
+         "liRules": rulesandinstructions.LiPlant2Rules,
+         "dctInstructions": dctPlantInstructions,
+         "sAxiom": "[+X][X][-X]",
+         "npaStartPos": np.array([.5, 0]),
+         "npaStartFac": np.array([0, 1]),
+         "tAspectRatio": (1, 1),
+         "liGenerations": [2, 4, 6]},
+        {"name": "tree",
+         "liRules": rulesandinstructions.liTreeRules,
+         "dctInstructions": dctPlantInstructions,
+         "sAxiom": "[Z][X][C]",
+         "npaStartPos": np.array([.5, 0]),
+         "npaStartFac": np.array([0, 1]),
+         "tAspectRatio": (1, 1),
+         "liGenerations": [2, 3, 4]},
+        blueprint_case(),
+    ]
+
+
+def measure(fncStage, lRepeats):
+    """
+    Time a stage and record its peak traced memory.
+    The timing runs (best of lRepeats) happen without tracemalloc, which would slow them down; one further run is
+    traced for memory. Traced memory covers Python and numpy allocations, not matplotlib's own rasteriser buffers.
+    :return: Tuple. (result of the stage, best seconds, peak bytes)
+    """
+    fBest = None
+    for _i in range(lRepeats):
+        fStart = time.perf_counter()
+        objResult = fncStage()
+        fElapsed = time.perf_counter() - fStart
+        fBest = fElapsed if fBest is None else min(fBest, fElapsed)
+    tracemalloc.start()
+    try:
+        fncStage()
+        _lCurrent, lPeak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return objResult, fBest, lPeak
+
+
+def new_artists(tAspectRatio):
+    """
+    A figure set up the same way render_2d_frame_by_frame_animation sets up its own.
+    """
+    objFig, objAx = plt.subplots(figsize=(9, 9))
+    objAx.set_xlim(-0.1, 1*tAspectRatio[0] + 0.1)
+    objAx.set_ylim(-0.1, 1*tAspectRatio[1] + 0.1)
+    plt.axis('off')
+    clsArtists = namedtuple("Artists", ("lcCoords", "objText"))
+    ntArtists = clsArtists(objAx.add_collection(LineCollection([],
+                                                               linewidths=0.5,
+                                                               linestyles='solid',
+                                                               colors=(0, 0, 0, 1),
+                                                               antialiaseds=False)),
+                           objAx.text(x=.05, y=.05, s=""))
+    return objFig, ntArtists
+
+
+def canvas_frame(objFig):
+    """
+    The figure as a PIL image, as renderer.FrameWriter grabs it.
+    """
+    objFig.canvas.draw()
+    return lineart.palettise(objFig.canvas.buffer_rgba())
+
+
+def run_case(dctCase, lGenerations, lSeed=0, lRepeats=3):
+    """
+    Benchmark every stage of the pipeline for one rule set at one generation count, rewriting and interpreting on the
+    selected kernels backend.
+    Stages are: rewrite (lindenate from the axiom), interpret (string_to_collection of the final generation),
+    update (update_artists_2d), draw (matplotlib rasterising the final generation) and encode (writing all generations
+    as a gif with gifblocks). Each rewrite run reseeds random with lSeed, so stochastic rule sets produce the same
+    string every time.
+    :return: List. One result dictionary per stage.
+    """
+    def rewrite():
+        random.seed(lSeed)
+        return kernels.lindenate(dctCase["liRules"], dctCase["sAxiom"], lGenerations)
+
+    def interpret(sText):
+        return kernels.string_to_collection(sText, dctCase["dctInstructions"], 2,
+                                            npaPos=dctCase["npaStartPos"], npaFac=dctCase["npaStartFac"])
+
+    dctBase = {"case": dctCase["name"], "generations": lGenerations, "seed": lSeed}
+    liOut = []
+    sText, fSeconds, lPeak = measure(rewrite, lRepeats)
+    liOut.append(dict(dctBase, stage="rewrite", seconds=fSeconds, peak_bytes=lPeak, string_length=len(sText)))
+    liData, fSeconds, lPeak = measure(lambda: interpret(sText), lRepeats)
+    liOut.append(dict(dctBase, stage="interpret", seconds=fSeconds, peak_bytes=lPeak, segments=len(liData)))
+
+    objFig, ntArtists = new_artists(dctCase["tAspectRatio"])
+    try:
+        tFrame = (liData, "Generation {}".format(lGenerations))
+        _objResult, fSeconds, lPeak = measure(
+            lambda: renderer.update_artists_2d(tFrame, ntArtists, dctCase["tAspectRatio"]), lRepeats)
+        liOut.append(dict(dctBase, stage="update", seconds=fSeconds, peak_bytes=lPeak))
+        _objResult, fSeconds, lPeak = measure(lambda: objFig.canvas.draw(), lRepeats)
+        liOut.append(dict(dctBase, stage="draw", seconds=fSeconds, peak_bytes=lPeak))
+
+        random.seed(lSeed)
+        liFrames = []
+        for i, sGeneration in enumerate(lindenmayer.lindenator(dctCase["liRules"], dctCase["sAxiom"],
+                                                               lMaxReturns=lGenerations + 1,
+                                                               fncLindenate=kernels.lindenate)):
+            renderer.update_artists_2d((interpret(sGeneration), "Generation {}".format(i)), ntArtists,
+                                       dctCase["tAspectRatio"])
+            liFrames.append(canvas_frame(objFig))
+    finally:
+        plt.close(objFig)
+
+    def encode():
+        objBuffer = io.BytesIO()
+        gifblocks.write_animation(objBuffer, liFrames[-1:] + liFrames[:-1], [500] * len(liFrames), b"{}")
+        return objBuffer.tell()
+
+    lBytes, fSeconds, lPeak = measure(encode, lRepeats)
+    liOut.append(dict(dctBase, stage="encode", seconds=fSeconds, peak_bytes=lPeak, frames=len(liFrames),
+                      output_bytes=lBytes))
+    return liOut
+
+
+def run(liCaseNames=None, lSeed=0, lRepeats=3, liGenerations=None):
+    """
+    Run the benchmark over the standard cases.
+    :param liCaseNames: List. Names of the cases to run. Defaults to all of them.
+    :param lSeed: Integer. Seed for the stochastic rules.
+    :param lRepeats: Integer. Timing runs per stage; the fastest is kept.
+    :param liGenerations: List. Generation counts to use instead of each case's own.
+    :return: Dictionary. Metadata about the run and its list of results.
+    """
+    liResults = []
+    for dctCase in std_cases():
+        if liCaseNames and dctCase["name"] not in liCaseNames:
+            continue
+        for lGenerations in liGenerations or dctCase["liGenerations"]:
+            with open(os.devnull, 'w') as fNull, redirect_stdout(fNull):
+                liCaseResults = run_case(dctCase, lGenerations, lSeed, lRepeats)
+            for dctResult in liCaseResults:
+                print("{case:>10} gen {generations:>2} {stage:>10}: {seconds:9.4f}s {peak_bytes:>12} bytes peak"
+                      .format(**dctResult))
+            liResults.extend(liCaseResults)
+    return {"meta": {"timestamp": datetime.now().isoformat(),
+                     "python": platform.python_version(),
+                     "numpy": np.__version__,
+                     "matplotlib": matplotlib.__version__,
+                     "platform": platform.platform(),
+                     "backend": kernels.backend.sName,
+                     "seed": lSeed,
+                     "repeats": lRepeats},
+            "results": liResults}
+
+
+def result_key(dctResult):
+    return dctResult["case"], dctResult["generations"], dctResult["stage"]
+
+
+def compare(dctBaseline, dctCurrent, fThreshold=1.25, fMinSeconds=.005):
+    """
+    Compare two benchmark runs stage by stage.
+    :param fThreshold: Float. A stage counts as a regression if it got slower by more than this factor.
+    :param fMinSeconds: Float. Stages faster than this in the baseline are too noisy to judge and are skipped.
+    :return: List. (case, generations, stage, baseline seconds, current seconds, ratio) for every regression.
+    """
+    dctOld = {result_key(dctResult): dctResult for dctResult in dctBaseline["results"]}
+    liRegressions = []
+    for dctResult in dctCurrent["results"]:
+        dctOldResult = dctOld.get(result_key(dctResult))
+        if dctOldResult is None or dctOldResult["seconds"] < fMinSeconds:
+            continue
+        fRatio = dctResult["seconds"] / dctOldResult["seconds"]
+        print("{:>10} gen {:>2} {:>10}: {:9.4f}s -> {:9.4f}s ({:.2f}x)".format(
+            *result_key(dctResult), dctOldResult["seconds"], dctResult["seconds"], fRatio))
+        if fRatio > fThreshold:
+            liRegressions.append(result_key(dctResult) + (dctOldResult["seconds"], dctResult["seconds"], fRatio))
+    return liRegressions
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Benchmark the generate, interpret, render and encode pipeline.")
+    objSubparsers = objParser.add_subparsers(dest="command", required=True)
+    objRun = objSubparsers.add_parser("run", help="run the benchmark and save its results as json")
+    objRun.add_argument("--cases", nargs="*", help="cases to run (default: all)")
+    objRun.add_argument("--generations", nargs="*", type=int, help="generation counts (default: per case)")
+    objRun.add_argument("--seed", type=int, default=0)
+    objRun.add_argument("--repeats", type=int, default=3)
+    objRun.add_argument("--output", help="results file (default: benchmark_results/<timestamp>.json)")
+    objCompare = objSubparsers.add_parser("compare", help="compare two results files, failing on regressions")
+    objCompare.add_argument("baseline")
+    objCompare.add_argument("current")
+    objCompare.add_argument("--threshold", type=float, default=1.25)
+    objArgs = objParser.parse_args()
+
+    if objArgs.command == "run":
+        dctRun = run(objArgs.cases, objArgs.seed, objArgs.repeats, objArgs.generations)
+        sOutput = objArgs.output
+        if sOutput is None:
+            os.makedirs(sResultsFolder, exist_ok=True)
+            sOutput = os.path.join(sResultsFolder, datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + '.json')
+        with open(sOutput, 'w') as f:
+            json.dump(dctRun, f, indent=1)
+        print("Results saved to " + sOutput)
+    else:
+        with open(objArgs.baseline, 'r') as f:
+            dctBaseline = json.load(f)
+        with open(objArgs.current, 'r') as f:
+            dctCurrent = json.load(f)
+        liRegressions = compare(dctBaseline, dctCurrent, objArgs.threshold)
+        for tRegression in liRegressions:
+            print("REGRESSION {} gen {} {}: {:.4f}s -> {:.4f}s ({:.2f}x)".format(*tRegression))
+        sys.exit(1 if liRegressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import collections as col
+import threading
+import hashlib
+import json
+import re
+
+import numpy as np
+
+import junkdrawer
+import animationindex
+import encoders
+
+
+class BlueprintError(ValueError):
+    """
+    Raised when a blueprint can't be parsed or isn't a valid makerkey.
+    """
+    pass
+
+
+tRequiredKeys = ("sName", "liRules", "dctInstructions", "sStartingString", "lItPerLoop")
+tOptionalKeys = ("npaStartPos", "npaStartFac", "tAspectRatio", "lLastFrameHang", "lSeed", "sFormat",
+                 "bAntialias", "lDimensions", "lOrbitFrames", "fElevation")
+# Keys only 3D renders take
+t3dKeys = ("lOrbitFrames", "fElevation")
+tRuleKeys = ("name", "enabled", "protected", "predecessor", "successor")
+tInstructionKeys = ("draw", "pop-push", "rotation", "movement")
+
+
+def parse_blueprint(sJson):
+    """
+    Decode and validate a blueprint.
+    :param sJson: String. Makerkey json, as embedded in a fractal gif or uploaded by a user.
+    :return: Dictionary. Keyword arguments for renderer.render_animation.
+    """
+    try:
+        dctMakerKey = json.loads(sJson, cls=junkdrawer.JeffSONDecoder)
+    except (ValueError, KeyError, TypeError) as e:
+        raise BlueprintError("Blueprint is not valid json: {}".format(e))
+    validate_blueprint(dctMakerKey)
+    return dctMakerKey
+
+
+def is_number(obj):
+    """
+    :return: Boolean. Whether obj is a finite int or float, numpy's included, and not a boolean.
+    """
+    return isinstance(obj, (int, float, np.integer, np.floating)) and not isinstance(obj, (bool, np.bool_)) and \
+        bool(np.isfinite(obj))
+
+
+def is_numeric_array(obj, tShape):
+    """
+    :return: Boolean. Whether obj is a list or numpy array of finite numbers of shape tShape.
+    """
+    if not isinstance(obj, (list, tuple, np.ndarray)):
+        return False
+    try:
+        npaObj = np.asarray(obj, dtype=np.float64)
+    except (ValueError, TypeError):
+        return False
+    return npaObj.shape == tShape and bool(np.isfinite(npaObj).all())
+
+
+def validate_blueprint(dctMakerKey):
+    """
+    Check that a decoded blueprint has everything the renderer needs, raising BlueprintError if not.
+    """
+    if not isinstance(dctMakerKey, dict):
+        raise BlueprintError("Blueprint must be a json object")
+    liMissing = [sKey for sKey in tRequiredKeys if sKey not in dctMakerKey]
+    if liMissing:
+        raise BlueprintError("Blueprint is missing " + ", ".join(liMissing))
+    liUnknown = [sKey for sKey in dctMakerKey if sKey not in tRequiredKeys + tOptionalKeys]
+    if liUnknown:
+        raise BlueprintError("Blueprint has unknown keys " + ", ".join(liUnknown))
+    if not isinstance(dctMakerKey["sName"], str) or not re.fullmatch(r"[\w\- ]+", dctMakerKey["sName"]):
+        raise BlueprintError("sName must be letters, digits, spaces, dashes or underscores")
+    if not isinstance(dctMakerKey["sStartingString"], str):
+        raise BlueprintError("sStartingString must be a string")
+    if not isinstance(dctMakerKey["lItPerLoop"], int) or dctMakerKey["lItPerLoop"] < 1:
+        raise BlueprintError("lItPerLoop must be a positive integer")
+    if not isinstance(dctMakerKey.get("lLastFrameHang", 1), int) or dctMakerKey.get("lLastFrameHang", 1) < 0:
+        raise BlueprintError("lLastFrameHang must be a non-negative integer")
+    if dctMakerKey.get("lSeed") is not None and not isinstance(dctMakerKey["lSeed"], int):
+        raise BlueprintError("lSeed must be an integer")
+    if dctMakerKey.get("sFormat", "gif") not in encoders.dctEncoders:
+        raise BlueprintError("sFormat must be one of " + ", ".join(encoders.dctEncoders))
+    if not isinstance(dctMakerKey.get("bAntialias", False), bool):
+        raise BlueprintError("bAntialias must be true or false")
+    lDimensions = dctMakerKey.get("lDimensions", 2)
+    if lDimensions not in (2, 3) or isinstance(lDimensions, bool):
+        raise BlueprintError("lDimensions must be 2 or 3")
+    if lDimensions == 2:
+        liUnknown = [sKey for sKey in t3dKeys if sKey in dctMakerKey]
+        if liUnknown:
+            raise BlueprintError("Only 3D blueprints take " + ", ".join(liUnknown))
+    else:
+        if encoders.dctEncoders[dctMakerKey.get("sFormat", "gif")].bVector:
+            raise BlueprintError("3D blueprints must have a raster sFormat")
+        if not isinstance(dctMakerKey.get("lOrbitFrames", 0), int) or dctMakerKey.get("lOrbitFrames", 0) < 0:
+            raise BlueprintError("lOrbitFrames must be a non-negative integer")
+        if not isinstance(dctMakerKey.get("fElevation", 0.), (int, float)) or \
+                isinstance(dctMakerKey.get("fElevation", 0.), bool):
+            raise BlueprintError("fElevation must be a number")
+    tAspectRatio = dctMakerKey.get("tAspectRatio", (1, 1))
+    if not is_numeric_array(tAspectRatio, (2,)) or min(tAspectRatio) <= 0:
+        raise BlueprintError("tAspectRatio must be two positive numbers")
+    for sKey in ("npaStartPos", "npaStartFac"):
+        if dctMakerKey.get(sKey) is not None and not is_numeric_array(dctMakerKey[sKey], (lDimensions,)):
+            raise BlueprintError("{} must be {} numbers".format(sKey, lDimensions))
+    if not isinstance(dctMakerKey["liRules"], list):
+        raise BlueprintError("liRules must be a list")
+    for dctRule in dctMakerKey["liRules"]:
+        if not isinstance(dctRule, dict) or any(sKey not in dctRule for sKey in tRuleKeys):
+            raise BlueprintError("Every rule needs " + ", ".join(tRuleKeys))
+        if not isinstance(dctRule["name"], str):
+            raise BlueprintError("Rule names must be strings")
+        if not isinstance(dctRule["enabled"], bool) or not isinstance(dctRule["protected"], bool):
+            raise BlueprintError("Rule {} enabled and protected must be true or false".format(dctRule["name"]))
+        try:
+            re.compile(dctRule["predecessor"])
+        except (re.error, TypeError) as e:
+            raise BlueprintError("Rule {} has a bad predecessor: {}".format(dctRule["name"], e))
+        if not isinstance(dctRule["successor"], (list, tuple)) or not dctRule["successor"]:
+            raise BlueprintError("Rule {} successor must be a list of [probability, string] pairs".format(
+                dctRule["name"]))
+        for tSuccessor in dctRule["successor"]:
+            if not isinstance(tSuccessor, (list, tuple)) or len(tSuccessor) != 2 or not is_number(tSuccessor[0]) \
+                    or not isinstance(tSuccessor[1], str):
+                raise BlueprintError("Rule {} successors must be [probability, string] pairs".format(dctRule["name"]))
+    if not isinstance(dctMakerKey["dctInstructions"], dict):
+        raise BlueprintError("dctInstructions must be an object")
+    for sChar, dctInstruction in dctMakerKey["dctInstructions"].items():
+        if not isinstance(dctInstruction, dict) or any(sKey not in dctInstruction for sKey in tInstructionKeys):
+            raise BlueprintError("Instruction {} needs {}".format(sChar, ", ".join(tInstructionKeys)))
+        if not isinstance(dctInstruction["draw"], bool):
+            raise BlueprintError("Instruction {} draw must be true or false".format(sChar))
+        if not is_number(dctInstruction["movement"]):
+            raise BlueprintError("Instruction {} movement must be a number".format(sChar))
+        liPopPush = dctInstruction["pop-push"]
+        if not isinstance(liPopPush, (list, tuple, np.ndarray)) or len(liPopPush) != 8 or \
+                any(lFlag not in (0, 1) or isinstance(lFlag, str) for lFlag in liPopPush):
+            raise BlueprintError("Instruction {} pop-push must have 8 flags of 0 or 1".format(sChar))
+        if not is_numeric_array(dctInstruction["rotation"], (lDimensions, lDimensions)):
+            raise BlueprintError("Instruction {} rotation must be a {}x{} matrix of numbers".format(
+                sChar, lDimensions, lDimensions))
+
+
+def blueprint_id(dctMakerKey):
+    """
+    Content hash of a blueprint, so the same blueprint always gets the same id.
+    :param dctMakerKey: Dictionary. A decoded blueprint.
+    :return: String. Hex digest.
+    """
+    sCanonical = json.dumps(dctMakerKey, sort_keys=True, cls=junkdrawer.JeffSONEncoder)
+    return hashlib.sha256(sCanonical.encode('utf-8')).hexdigest()[:32]
+
+
+class BlueprintStore:
+    """
+    Decoded blueprints by id. The most recently used are kept in memory, and all of them are persisted in the
+    animation index so an id stays valid across restarts and between processes.
+    """
+    def __init__(self, lCapacity=256, sIndex=None):
+        """
+        :param lCapacity: Integer. Number of decoded blueprints kept in memory.
+        :param sIndex: String. Path of the animation index sqlite file.
+        """
+        self.lCapacity = lCapacity
+        self.sIndex = sIndex
+        self.odBlueprints = col.OrderedDict()
+        self.objLock = threading.Lock()
+
+    def _remember(self, sId, dctMakerKey):
+        with self.objLock:
+            self.odBlueprints[sId] = dctMakerKey
+            self.odBlueprints.move_to_end(sId)
+            while len(self.odBlueprints) > self.lCapacity:
+                self.odBlueprints.popitem(last=False)
+
+    def add(self, sJson):
+        """
+        Parse, validate and store a blueprint.
+        :param sJson: String. Makerkey json.
+        :return: String. Id of the blueprint.
+        """
+        dctMakerKey = parse_blueprint(sJson)
+        sId = blueprint_id(dctMakerKey)
+        with self.objLock:
+            bKnown = sId in self.odBlueprints
+        if not bKnown:
+            animationindex.add_blueprint(sId, json.dumps(dctMakerKey, cls=junkdrawer.JeffSONEncoder), self.sIndex)
+        self._remember(sId, dctMakerKey)
+        return sId
+
+    def get(self, sId):
+        """
+        :param sId: String. Id returned by add.
+        :return: Dictionary. The decoded blueprint, or None if the id is unknown.
+        """
+        with self.objLock:
+            dctMakerKey = self.odBlueprints.get(sId)
+            if dctMakerKey is not None:
+                self.odBlueprints.move_to_end(sId)
+                return dctMakerKey
+        sJson = animationindex.get_blueprint(sId, self.sIndex)
+        if sJson is None:
+            return None
+        dctMakerKey = parse_blueprint(sJson)
+        self._remember(sId, dctMakerKey)
+        return dctMakerKey
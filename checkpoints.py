@@ -0,0 +1,141 @@
+import argparse
+import shutil
+import random
+import gzip
+import json
+import mmap
+import os
+
+import junkdrawer
+import generationcache
+
+lCompressLevel = 6
+lChunk = 1 << 20
+
+
+def checkpoint_name(sBaseName):
+    """
+    :param sBaseName: String. File name of an animation in Saved_Animations.
+    :return: String. File name of its checkpoint within junkdrawer.sCheckpointsFolder.
+    """
+    return sBaseName + '.ckpt'
+
+
+def checkpoint_path(sBaseName):
+    return os.path.join(junkdrawer.sCheckpointsFolder, checkpoint_name(sBaseName))
+
+
+def has_checkpoint(sBaseName):
+    return os.path.isfile(checkpoint_path(sBaseName))
+
+
+class GenerationRecorder:
+    """
+    Passes generations through from lindenmayer.lindenator, generationcache.lindenator or
+    outofcore.spilled_generations, holding on to the last one and the random state that rewriting it further starts
+    from, ready for write_checkpoint. Those generators leave random in that state whenever they yield.
+    """
+    def __init__(self, itGenerations, bDeterministic=False):
+        """
+        :param bDeterministic: Boolean. The rules don't use random (see generationcache.is_deterministic), so no state
+            is kept.
+        """
+        self.itGenerations = iter(itGenerations)
+        self.bDeterministic = bDeterministic
+        self.bufText = None
+        self.tState = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        bufText = next(self.itGenerations)
+        self.bufText = bufText
+        self.tState = None if self.bDeterministic else random.getstate()
+        return bufText
+
+
+def write_checkpoint(sPath, bufText, lGeneration, tState):
+    """
+    Store a generation and the random state to rewrite it with, gzipped: a line of json holding the generation number
+    and the state, then the text. The text is written lChunk at a time, so a memory mapped generation is never read
+    into memory whole. The file is written under a temporary name and renamed.
+    :param bufText: String, bytes or mmap. The generation's text.
+    :param lGeneration: Integer. Its generation number, 0 being the axiom.
+    :param tState: Tuple. random.getstate() to rewrite it with, or None for deterministic rules.
+    """
+    os.makedirs(os.path.dirname(sPath), exist_ok=True)
+    sTemp = sPath + ".{}.tmp".format(os.getpid())
+    try:
+        with gzip.open(sTemp, 'wb', compresslevel=lCompressLevel) as f:
+            f.write(json.dumps({"lGeneration": lGeneration, "tState": tState}).encode('utf-8') + b"\n")
+            for lStart in range(0, len(bufText), lChunk):
+                bufChunk = bufText[lStart:lStart + lChunk]
+                f.write(bufChunk.encode('utf-8') if isinstance(bufChunk, str) else bufChunk)
+        os.replace(sTemp, sPath)
+    finally:
+        if os.path.exists(sTemp):
+            os.remove(sTemp)
+
+
+def read_checkpoint(sPath):
+    """
+    :return: Tuple. (generation number, text, random state) of a checkpoint.
+    """
+    with gzip.open(sPath, 'rb') as f:
+        dctHeader = json.loads(f.readline())
+        sText = f.read().decode('utf-8')
+    return dctHeader["lGeneration"], sText, generationcache.state_from_json(dctHeader["tState"])
+
+
+def spill_checkpoint(sPath, sFileName):
+    """
+    read_checkpoint for generations too large to keep around: the text is decompressed into sFileName lChunk at a
+    time and memory mapped.
+    :return: Tuple. (generation number, mmap of the text or b"" if it is empty, random state)
+    """
+    with gzip.open(sPath, 'rb') as f:
+        dctHeader = json.loads(f.readline())
+        with open(sFileName, 'wb') as fOut:
+            shutil.copyfileobj(f, fOut, lChunk)
+    with open(sFileName, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            bufText = b""
+        else:
+            bufText = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return dctHeader["lGeneration"], bufText, generationcache.state_from_json(dctHeader["tState"])
+
+
+def read_generation(sPath):
+    """
+    :return: Integer. The generation number of a checkpoint, without decompressing its text.
+    """
+    with gzip.open(sPath, 'rb') as f:
+        return json.loads(f.readline())["lGeneration"]
+
+
+def remove_checkpoint(sBaseName):
+    """
+    Delete the checkpoint of an animation, if it has one.
+    """
+    try:
+        os.remove(checkpoint_path(sBaseName))
+    except FileNotFoundError:
+        pass
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Continue saved fractals from their checkpoints.")
+    objParser.add_argument("animation", help="animation in Saved_Animations rendered with bCheckpoint=True")
+    objParser.add_argument("generations", type=int, help="number of generations to add")
+    objParser.add_argument("--out-of-core", action="store_true", help="keep generations in memory mapped files")
+    objParser.add_argument("--no-checkpoint", action="store_true", help="don't checkpoint the extended animation")
+    objArgs = objParser.parse_args()
+    # The renderer pulls in matplotlib, so it's only imported to render
+    import renderer
+    print(renderer.extend_2d_animation(objArgs.animation, objArgs.generations, bCheckpoint=not objArgs.no_checkpoint,
+                                       bOutOfCore=objArgs.out_of_core))
+
+
+if __name__ == "__main__":
+    main()
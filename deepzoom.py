@@ -0,0 +1,308 @@
+import multiprocessing
+import argparse
+import tempfile
+import shutil
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+import junkdrawer
+import outofcore
+import kernels
+import batchrender
+import blueprints
+
+lTileSize = 256
+# Tile coordinates of the deepest level have to fit the 32 bit halves of a 64 bit Morton key
+lMaxLevels = 16
+# Worker-side state of draw_tile, set up once per pool process by init_worker
+dctWorker = {}
+
+
+def spread_bits(npaValues):
+    """
+    Spread the low 16 bits of each value out to the even bits, for interleaving into Morton keys.
+    """
+    npaValues = npaValues.astype(np.uint64) & np.uint64(0xFFFF)
+    for lShift, lMask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+        npaValues = (npaValues | (npaValues << np.uint64(lShift))) & np.uint64(lMask)
+    return npaValues
+
+
+def compact_bits(npaValues):
+    """
+    Inverse of spread_bits: gather the even bits of each value back into its low 16 bits.
+    """
+    npaValues = npaValues.astype(np.uint64) & np.uint64(0x55555555)
+    for lShift, lMask in ((1, 0x33333333), (2, 0x0F0F0F0F), (4, 0x00FF00FF), (8, 0x0000FFFF)):
+        npaValues = (npaValues | (npaValues >> np.uint64(lShift))) & np.uint64(lMask)
+    return npaValues
+
+
+def morton(npaX, npaY):
+    """
+    :return: numpy array. Morton (Z-order) keys of tile coordinates. The key of a tile, shifted left two bits per
+        level, is the smallest key of the tiles it covers on deeper levels, so every tile of every level is one
+        contiguous run of keys.
+    """
+    return spread_bits(npaX) | (spread_bits(npaY) << np.uint64(1))
+
+
+def world_square(tAspectRatio=(1, 1)):
+    """
+    The square the pyramid covers, in the coordinates frames are drawn in (see outofcore.frame_transform): the
+    frame, with the same 0.1 margin as the animations, anchored at its top left corner.
+    :return: Tuple. (left, top, side)
+    """
+    return -.1, tAspectRatio[1] + .1, max(tAspectRatio) + .2
+
+
+def tile_bounds(lLevel, lX, lY, tSquare):
+    """
+    :return: Tuple. (left, bottom, right, top) of a tile. Tile (0, 0) is top left, as in XYZ tiles.
+    """
+    fLeft, fTop, fSide = tSquare
+    fTile = fSide / 2 ** lLevel
+    return fLeft + lX * fTile, fTop - (lY + 1) * fTile, fLeft + (lX + 1) * fTile, fTop - lY * fTile
+
+
+def sort_segments(npaSegments, tAspectRatio, lMaxLevel, sFolder, lChunk=outofcore.lSegmentChunk):
+    """
+    Fit the segments of a generation to the frame, as the animations do, and sort them by the Morton key of the
+    deepest level tile their midpoint falls in. Both are written to memory mapped files, so afterwards the segments of
+    any tile on any level can be found by binary search without reading the rest.
+    This is the only step that holds anything per segment in memory: the keys and their sort order, 16 bytes each.
+    :param npaSegments: numpy array. (N, 2, 2) segments as drawn by the interpreter, e.g. outofcore.spill_segments.
+    :param sFolder: String. Folder for segments.bin and keys.bin.
+    :return: Tuple. (sorted segments memmap, sorted keys memmap, length of the longest segment)
+    """
+    npaTranslation, npaScale = outofcore.frame_transform(outofcore.segment_bounds(npaSegments, lChunk), tAspectRatio)
+    fLeft, fTop, fSide = world_square(tAspectRatio)
+    lTiles = 2 ** lMaxLevel
+    npaKeys = np.empty(len(npaSegments), dtype=np.uint64)
+    fMaxLength = 0.
+    for lStart in range(0, len(npaSegments), lChunk):
+        npaChunk = (npaSegments[lStart:lStart + lChunk] + npaTranslation).dot(npaScale)
+        fMaxLength = max(fMaxLength, np.linalg.norm(npaChunk[:, 1] - npaChunk[:, 0], axis=1).max())
+        npaMid = npaChunk.mean(axis=1)
+        npaX = np.clip(((npaMid[:, 0] - fLeft) / fSide * lTiles).astype(np.int64), 0, lTiles - 1)
+        npaY = np.clip(((fTop - npaMid[:, 1]) / fSide * lTiles).astype(np.int64), 0, lTiles - 1)
+        npaKeys[lStart:lStart + lChunk] = morton(npaX, npaY)
+    npaOrder = np.argsort(npaKeys, kind='stable')
+    mmKeys = np.memmap(os.path.join(sFolder, "keys.bin"), dtype=np.uint64, mode='w+', shape=npaKeys.shape)
+    mmKeys[:] = npaKeys[npaOrder]
+    del npaKeys
+    mmSegments = np.memmap(os.path.join(sFolder, "segments.bin"), dtype=np.float64, mode='w+',
+                           shape=(len(npaSegments), 2, 2))
+    for lStart in range(0, len(npaSegments), lChunk):
+        npaIndices = npaOrder[lStart:lStart + lChunk]
+        # Gathered in file order, which reads the unsorted segments far more sequentially
+        npaPositions = np.argsort(npaIndices)
+        npaChunk = np.empty((len(npaIndices), 2, 2))
+        npaChunk[npaPositions] = npaSegments[npaIndices[npaPositions]]
+        mmSegments[lStart:lStart + lChunk] = (npaChunk + npaTranslation).dot(npaScale)
+    mmSegments.flush()
+    mmKeys.flush()
+    return mmSegments, mmKeys, fMaxLength
+
+
+def tile_range(npaKeys, lLevel, lX, lY, lMaxLevel):
+    """
+    :return: Tuple. (start, end) of the segments whose midpoint is in a tile, within the sorted segments.
+    """
+    lShift = 2 * (lMaxLevel - lLevel)
+    lKey = int(morton(np.array([lX]), np.array([lY]))[0])
+    return (int(np.searchsorted(npaKeys, np.uint64(lKey << lShift))),
+            int(np.searchsorted(npaKeys, np.uint64((lKey + 1) << lShift))))
+
+
+def margin_tiles(lLevel, fMaxLength, tSquare):
+    """
+    :return: Integer. How many tiles away a segment can reach into from the tile its midpoint is in.
+    """
+    return int(np.ceil(fMaxLength / 2 / (tSquare[2] / 2 ** lLevel)))
+
+
+def level_tiles(npaKeys, lLevel, lMaxLevel, lMargin, lChunk=outofcore.lSegmentChunk):
+    """
+    Tiles of a level that may have something on them: those holding segment midpoints, and the ones around them
+    within reach of their segments.
+    :return: List. Sorted (x, y) of the tiles.
+    """
+    lShift = np.uint64(2 * (lMaxLevel - lLevel))
+    setPrefixes = set()
+    for lStart in range(0, len(npaKeys), lChunk):
+        setPrefixes.update(np.unique(npaKeys[lStart:lStart + lChunk] >> lShift).tolist())
+    npaPrefixes = np.array(sorted(setPrefixes), dtype=np.uint64)
+    lTiles = 2 ** lLevel
+    setTiles = set()
+    for lX, lY in zip(compact_bits(npaPrefixes).tolist(), compact_bits(npaPrefixes >> np.uint64(1)).tolist()):
+        for lDx in range(-lMargin, lMargin + 1):
+            for lDy in range(-lMargin, lMargin + 1):
+                if 0 <= lX + lDx < lTiles and 0 <= lY + lDy < lTiles:
+                    setTiles.add((lX + lDx, lY + lDy))
+    return sorted(setTiles)
+
+
+def init_worker(sWorkDir, sFolder, lSegments, lMaxLevel, tSquare, fMaxLength, lTile):
+    """
+    Pool initializer for draw_tile: map the sorted segments and set up one tile sized figure, reused for every tile.
+    :param sWorkDir: String. Folder of the sorted segments and keys.
+    :param sFolder: String. Folder the tiles are written to.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    objFig = plt.figure(figsize=(lTile / 100, lTile / 100), dpi=100)
+    objAx = objFig.add_axes((0, 0, 1, 1))
+    objAx.axis('off')
+    lcCoords = objAx.add_collection(LineCollection([], linewidths=0.5, linestyles='solid', colors=(0, 0, 0, 1)))
+    objFig.canvas.draw()
+    dctWorker.update(sFolder=sFolder, lMaxLevel=lMaxLevel, tSquare=tSquare, fMaxLength=fMaxLength, lTile=lTile,
+                     objFig=objFig, objAx=objAx, lcCoords=lcCoords,
+                     # Every tile starts from the same blank canvas, so it is restored rather than redrawn
+                     objBlank=objFig.canvas.copy_from_bbox(objFig.bbox),
+                     mmSegments=np.memmap(os.path.join(sWorkDir, "segments.bin"), dtype=np.float64, mode='r',
+                                          shape=(lSegments, 2, 2)),
+                     mmKeys=np.memmap(os.path.join(sWorkDir, "keys.bin"), dtype=np.uint64, mode='r',
+                                      shape=(lSegments,)))
+
+
+def draw_tile(tTile, lChunk=outofcore.lSegmentChunk):
+    """
+    Pool task rasterising one tile from the segments that reach into it, lChunk at a time, so memory is bounded by
+    the tile and the chunk whatever the level. Tiles nothing reaches into aren't written; the viewer shows them blank.
+    :param tTile: Tuple. (level, x, y)
+    :return: Tuple. (level, x, y, whether the tile was written)
+    """
+    from PIL import Image
+    lLevel, lX, lY = tTile
+    objAx, lcCoords = dctWorker["objAx"], dctWorker["lcCoords"]
+    mmSegments, mmKeys, lMaxLevel = dctWorker["mmSegments"], dctWorker["mmKeys"], dctWorker["lMaxLevel"]
+    fLeft, fBottom, fRight, fTop = tile_bounds(lLevel, lX, lY, dctWorker["tSquare"])
+    objAx.set_xlim(fLeft, fRight)
+    objAx.set_ylim(fBottom, fTop)
+    dctWorker["objFig"].canvas.restore_region(dctWorker["objBlank"])
+    lMargin = margin_tiles(lLevel, dctWorker["fMaxLength"], dctWorker["tSquare"])
+    lTiles = 2 ** lLevel
+    bDrawn = False
+    for lNx in range(max(lX - lMargin, 0), min(lX + lMargin + 1, lTiles)):
+        for lNy in range(max(lY - lMargin, 0), min(lY + lMargin + 1, lTiles)):
+            lStart, lEnd = tile_range(mmKeys, lLevel, lNx, lNy, lMaxLevel)
+            for lChunkStart in range(lStart, lEnd, lChunk):
+                npaChunk = mmSegments[lChunkStart:min(lChunkStart + lChunk, lEnd)]
+                npaMin, npaMax = npaChunk.min(axis=1), npaChunk.max(axis=1)
+                npaChunk = npaChunk[(npaMax[:, 0] >= fLeft) & (npaMin[:, 0] <= fRight)
+                                    & (npaMax[:, 1] >= fBottom) & (npaMin[:, 1] <= fTop)]
+                if len(npaChunk):
+                    lcCoords.set_segments(npaChunk)
+                    objAx.draw_artist(lcCoords)
+                    bDrawn = True
+    if bDrawn:
+        objCanvas = dctWorker["objFig"].canvas
+        imgTile = Image.frombuffer('RGBA', objCanvas.get_width_height(), objCanvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+        sTile = os.path.join(dctWorker["sFolder"], str(lLevel), str(lX), "{}.png".format(lY))
+        os.makedirs(os.path.dirname(sTile), exist_ok=True)
+        imgTile.convert('L').save(sTile)
+    return lLevel, lX, lY, bDrawn
+
+
+def build_pyramid(dctMakerKey, sName=None, lMaxLevel=6, lGeneration=None, lProcesses=None, fncReport=print):
+    """
+    Render one generation of a makerkey as a deep zoom pyramid of lTileSize pixel png tiles, in XYZ layout:
+    level z is 2**z tiles square, and level lMaxLevel is lTileSize * 2**lMaxLevel pixels across. Every tile of every
+    level is drawn from the segments themselves on a process pool, so lines stay crisp at every zoom.
+    The generation is rewritten and interpreted out of core (see outofcore), and the pyramid is built in a work folder
+    and moved to junkdrawer.sDeepZoomFolder when complete, with a pyramid.json describing it for the viewer.
+    :param dctMakerKey: Dictionary. Validated makerkey.
+    :param sName: String. Name of the pyramid's folder. Defaults to the makerkey's name and a timestamp.
+    :param lMaxLevel: Integer. Deepest zoom level, up to lMaxLevels.
+    :param lGeneration: Integer. Generation to render. Defaults to the makerkey's last.
+    :param lProcesses: Integer. Worker processes. Defaults to the number of cores.
+    :param fncReport: Function. Called with a line of progress per level.
+    :return: String. Path of the pyramid's folder.
+    """
+    if not 0 <= lMaxLevel <= lMaxLevels:
+        raise ValueError("lMaxLevel must be between 0 and {}".format(lMaxLevels))
+    lGeneration = dctMakerKey["lItPerLoop"] - 1 if lGeneration is None else lGeneration
+    tAspectRatio = tuple(dctMakerKey.get("tAspectRatio", (1, 1)))
+    tSquare = world_square(tAspectRatio)
+    sName = sName or dctMakerKey["sName"] + datetime.now().strftime("_%Y-%m-%d_%H-%M-%S")
+    os.makedirs(junkdrawer.sPartialAnimationsFolder, exist_ok=True)
+    sWorkDir = tempfile.mkdtemp(dir=junkdrawer.sPartialAnimationsFolder)
+    sFolder = os.path.join(sWorkDir, "pyramid")
+    os.makedirs(sFolder)
+    try:
+        bufText = None
+        for bufText in outofcore.spilled_generations(dctMakerKey["liRules"], dctMakerKey["sStartingString"],
+                                                     dctMakerKey.get("lSeed"), lGeneration + 1, sWorkDir):
+            pass
+        npaSegments = outofcore.spill_segments(
+            kernels.segment_blocks(bufText, dctMakerKey["dctInstructions"], 2, dctMakerKey.get("npaStartPos"),
+                                   dctMakerKey.get("npaStartFac")),
+            os.path.join(sWorkDir, "raw_segments.bin"))
+        mmSegments, mmKeys, fMaxLength = sort_segments(npaSegments, tAspectRatio, lMaxLevel, sWorkDir)
+        lSegments = len(mmSegments)
+        del npaSegments, bufText
+        os.remove(os.path.join(sWorkDir, "raw_segments.bin"))
+        fncReport("{} segments in generation {}".format(lSegments, lGeneration))
+        lWritten = 0
+        with multiprocessing.Pool(lProcesses, initializer=init_worker,
+                                  initargs=(sWorkDir, sFolder, lSegments, lMaxLevel, tSquare, fMaxLength,
+                                            lTileSize)) as objPool:
+            for lLevel in range(lMaxLevel + 1):
+                liTiles = [(lLevel, lX, lY) for lX, lY in
+                           level_tiles(mmKeys, lLevel, lMaxLevel, margin_tiles(lLevel, fMaxLength, tSquare))]
+                lLevelWritten = sum(bDrawn for _l, _x, _y, bDrawn in
+                                    objPool.imap_unordered(draw_tile, liTiles, chunksize=8))
+                lWritten += lLevelWritten
+                fncReport("Level {}: {} tiles".format(lLevel, lLevelWritten))
+        del mmSegments, mmKeys
+        from PIL import Image
+        Image.new('L', (lTileSize, lTileSize), 255).save(os.path.join(sFolder, "blank.png"))
+        with open(os.path.join(sFolder, "pyramid.json"), 'w') as f:
+            json.dump({"name": sName,
+                       "tile_size": lTileSize,
+                       "max_level": lMaxLevel,
+                       "generation": lGeneration,
+                       "segments": lSegments,
+                       "tiles": lWritten,
+                       # Extent of the frame in level 0 pixels, from the top left corner
+                       "width": (tAspectRatio[0] + .2) / tSquare[2] * lTileSize,
+                       "height": (tAspectRatio[1] + .2) / tSquare[2] * lTileSize,
+                       "makerkey": json.dumps(dctMakerKey, cls=junkdrawer.JeffSONEncoder)
+                       }, f)
+        sOut = os.path.join(junkdrawer.sDeepZoomFolder, sName)
+        os.makedirs(junkdrawer.sDeepZoomFolder, exist_ok=True)
+        shutil.rmtree(sOut, ignore_errors=True)
+        os.replace(sFolder, sOut)
+    finally:
+        shutil.rmtree(sWorkDir, ignore_errors=True)
+    return sOut
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Render a fractal as a deep zoom pyramid of png tiles.")
+    objParser.add_argument("source", help=".json makerkey, or a saved animation whose makerkey to render")
+    objParser.add_argument("--levels", type=int, default=6,
+                           help="deepest zoom level; level n is {} * 2**n pixels across".format(lTileSize))
+    objParser.add_argument("--generation", type=int, help="generation to render (default: the last)")
+    objParser.add_argument("--processes", type=int, help="worker processes (default: number of cores)")
+    objArgs = objParser.parse_args()
+    dctMakerKey = batchrender.load_makerkey(objArgs.source)
+    sName = None
+    if not objArgs.source.lower().endswith('.json'):
+        # Named after the animation, so its page can link to it
+        sName = junkdrawer.pyramid_name(objArgs.source)
+    try:
+        sOut = build_pyramid(dctMakerKey, sName, objArgs.levels, objArgs.generation, objArgs.processes)
+    except (ValueError, blueprints.BlueprintError) as e:
+        objParser.error(str(e))
+    print("Pyramid written to " + sOut)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from collections import namedtuple
+import os
+
+import gifblocks
+
+sMakerKeyNamespace = "urn:lindenmayer-fractals:makerkey"
+lHeadPadding = 200
+
+# An output format of the renderer.
+# sExtension: file extension, without the dot.
+# bVector: vector formats are written straight from the generations (see write_svg) without rasterising; raster
+#     formats are written from the rendered frames by fncWrite(file name, PIL frames, durations in ms, makerkey json).
+# fncReadMakerKey: (file name) -> makerkey json or None.
+# fncDescribe: (file name) -> (makerkey json or None, frame count, (width, height)).
+# clsScanner: fncDescribe for a file arriving in chunks, e.g. an upload: a class whose instances are fed every chunk
+#     with feed(bytes) and then describe() as fncDescribe does. None if the format can only be described once whole.
+Encoder = namedtuple("Encoder", ("sExtension", "bVector", "fncWrite", "fncReadMakerKey", "fncDescribe", "clsScanner"))
+
+
+def write_gif(sFileName, liFrames, liDurations, sMakerKey):
+    with open(sFileName, 'wb') as f:
+        gifblocks.write_animation(f, liFrames, liDurations, sMakerKey.encode('utf-8'))
+
+
+def read_gif_makerkey(sFileName):
+    bComment = gifblocks.read_comment(sFileName)
+    return bComment.decode('utf-8') if bComment else None
+
+
+def describe_gif(sFileName):
+    bComment, lFrames, tDimensions = gifblocks.describe_gif_file(sFileName)
+    return (bComment.decode('utf-8') if bComment else None), lFrames, tDimensions
+
+
+class GifScanner:
+    """
+    describe_gif in a single pass over a gif fed to it in chunks (see gifblocks.GifScanner).
+    """
+    def __init__(self):
+        self.objScanner = gifblocks.GifScanner()
+
+    def feed(self, bChunk):
+        self.objScanner.feed(bChunk)
+
+    def describe(self):
+        bComment, lFrames, tDimensions = self.objScanner.result()
+        return (bComment.decode('utf-8') if bComment else None), lFrames, tDimensions
+
+
+def makerkey_xmp(sMakerKey):
+    """
+    :return: bytes. An XMP packet carrying the makerkey, for formats whose metadata is XMP.
+    """
+    return ('<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            '<rdf:Description xmlns:lf="{}"><lf:makerkey>{}</lf:makerkey></rdf:Description>'
+            '</rdf:RDF></x:xmpmeta><?xpacket end="w"?>').format(sMakerKeyNamespace, escape(sMakerKey)).encode('utf-8')
+
+
+def read_xmp_makerkey(bXmp):
+    if not bXmp:
+        return None
+    objMakerKey = ET.fromstring(bXmp).find(".//{%s}makerkey" % sMakerKeyNamespace)
+    return None if objMakerKey is None else objMakerKey.text
+
+
+def write_webp(sFileName, liFrames, liDurations, sMakerKey):
+    """
+    Animated WebP, lossless, with the makerkey in its XMP chunk.
+    """
+    liRgb = [imgFrame.convert('RGB') for imgFrame in liFrames]
+    liRgb[0].save(sFileName, format='WEBP', save_all=True, append_images=liRgb[1:], duration=liDurations, loop=0,
+                  lossless=True, method=4, xmp=makerkey_xmp(sMakerKey))
+
+
+def read_webp_makerkey(sFileName):
+    from PIL import Image
+    with Image.open(sFileName) as imgWebp:
+        return read_xmp_makerkey(imgWebp.info.get("xmp"))
+
+
+def write_apng(sFileName, liFrames, liDurations, sMakerKey):
+    """
+    Animated PNG, with the makerkey in an iTXt chunk named makerkey.
+    """
+    from PIL import PngImagePlugin
+    objInfo = PngImagePlugin.PngInfo()
+    objInfo.add_itxt("makerkey", sMakerKey, zip=True)
+    liGrey = [imgFrame.convert('L') for imgFrame in liFrames]
+    liGrey[0].save(sFileName, format='PNG', save_all=True, append_images=liGrey[1:], duration=liDurations, loop=0,
+                   optimize=True, pnginfo=objInfo)
+
+
+def read_apng_makerkey(sFileName):
+    from PIL import Image
+    with Image.open(sFileName) as imgPng:
+        return imgPng.info.get("makerkey")
+
+
+def describe_pil(fncReadMakerKey):
+    def describe(sFileName):
+        from PIL import Image
+        with Image.open(sFileName) as imgAnimation:
+            tDescription = getattr(imgAnimation, "n_frames", 1), imgAnimation.size
+        return (fncReadMakerKey(sFileName),) + tDescription
+    return describe
+
+
+def write_svg(sFileName, itGenerations, dctInstructions, sMakerKey, npaStartPos=None, npaStartFac=None,
+              tAspectRatio=(1, 1), lFrameDuration=500, lLastFrameHang=1, lWidth=900, sWorkDir=".",
+              fncCheckpoint=None, objMetrics=None):
+    """
+    Animated SVG, written straight from the generations without rasterising. Each generation is a group of paths,
+    shown in turn by SMIL animations; viewers without SMIL show the final generation. The segments of a generation
+    are streamed from the interpreter into a memory mapped file (see outofcore.spill_segments) and from there into
+    the svg, so no generation is held in memory as segments or as text. The makerkey is the svg's metadata element.
+    :param itGenerations: Iterable of generations, as strings or memory maps.
+    :param lFrameDuration: Integer. Milliseconds per generation.
+    :param lLastFrameHang: Integer. Extra frames' worth of time the final generation is shown for.
+    :param lWidth: Integer. Width in pixels the svg asks to be displayed at.
+    :return: Tuple. (number of frames, (width, height))
+    """
+    import kernels
+    import outofcore
+    import metrics
+    fXSpan, fYSpan = tAspectRatio[0] + .2, tAspectRatio[1] + .2
+    lHeight = int(round(lWidth * fYSpan / fXSpan))
+    # Matplotlib's 0.5pt lines on a 9 inch figure whose axes cover about 7 inches
+    fStroke = fXSpan * .5 / 72 / 7
+    sSegmentFile = os.path.join(sWorkDir, "segments.bin")
+    liOffsets = []
+    with open(sFileName, 'wb') as fOut:
+        def write(sText):
+            fOut.write(sText.encode('utf-8'))
+
+        write('<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" viewBox="-0.1 -0.1 {} {}">\n'
+              .format(lWidth, lHeight, fXSpan, fYSpan))
+        write('<metadata id="makerkey">{}</metadata>\n'.format(escape(sMakerKey)))
+        write('<rect x="-0.1" y="-0.1" width="{}" height="{}" fill="white"/>\n'.format(fXSpan, fYSpan))
+        for i, bufText in enumerate(itGenerations):
+            if fncCheckpoint is not None:
+                fncCheckpoint()
+            with metrics.timed(objMetrics, "interpret"):
+                npaSegments = outofcore.spill_segments(
+                    kernels.segment_blocks(bufText, dctInstructions, 2, npaStartPos, npaStartFac), sSegmentFile)
+            if objMetrics is not None:
+                objMetrics.add_generation(bufText, npaSegments)
+            with metrics.timed(objMetrics, "encode"):
+                npaTranslation, npaScale = outofcore.frame_transform(outofcore.segment_bounds(npaSegments),
+                                                                     tAspectRatio)
+                # Placeholder for the visibility animation, which needs the number of generations
+                liOffsets.append(fOut.tell())
+                write('<g id="g{}" visibility="hidden">{}\n'.format(i, ' ' * lHeadPadding))
+                write('<g transform="matrix(1 0 0 -1 0 {})" fill="none" stroke="black" stroke-width="{:.5f}" '
+                      'stroke-linecap="round">\n'.format(tAspectRatio[1], fStroke))
+                for lStart in range(0, len(npaSegments), outofcore.lSegmentChunk):
+                    npaChunk = (npaSegments[lStart:lStart + outofcore.lSegmentChunk] + npaTranslation).dot(npaScale)
+                    liPath = ['<path d="']
+                    npaPrevious = None
+                    for npaSegment in npaChunk:
+                        # Segments continuing from the end of the previous one need no move
+                        if npaPrevious is None or (npaSegment[0] != npaPrevious[1]).any():
+                            liPath.append('M{:.4f} {:.4f}'.format(*npaSegment[0]))
+                        liPath.append('L{:.4f} {:.4f}'.format(*npaSegment[1]))
+                        npaPrevious = npaSegment
+                    liPath.append('"/>\n')
+                    write("".join(liPath))
+                write('</g>\n<text x=".05" y="{}" font-size=".03" font-family="sans-serif">Generation {}</text>\n'
+                      '</g>\n'.format(tAspectRatio[1] - .05, i))
+            del npaSegments
+            os.remove(sSegmentFile)
+        write('</svg>\n')
+    lFrames = len(liOffsets)
+    fTotal = lFrameDuration * (lFrames + lLastFrameHang) / 1000
+    with open(sFileName, 'r+b') as f:
+        for i, lOffset in enumerate(liOffsets):
+            fStart, fEnd = lFrameDuration * i / 1000 / fTotal, lFrameDuration * (i + 1) / 1000 / fTotal
+            bLast = i == lFrames - 1
+            if bLast:
+                fEnd = 1
+            liValues, liTimes = [], []
+            if fStart > 0:
+                liValues, liTimes = ["hidden"], [0]
+            liValues.append("visible")
+            liTimes.append(fStart)
+            if fEnd < 1:
+                liValues.append("hidden")
+                liTimes.append(fEnd)
+            sHead = '<g id="g{}" visibility="{}">'.format(i, "visible" if bLast else "hidden")
+            if len(liValues) > 1:
+                sHead += ('<animate attributeName="visibility" calcMode="discrete" dur="{:g}s" repeatCount="indefinite"'
+                          ' values="{}" keyTimes="{}"/>').format(fTotal, ";".join(liValues),
+                                                                ";".join("{:.4f}".format(f) for f in liTimes))
+            lSlot = len('<g id="g{}" visibility="hidden">'.format(i)) + lHeadPadding
+            if len(sHead) > lSlot:
+                raise ValueError("Animation of generation {} doesn't fit its placeholder".format(i))
+            f.seek(lOffset)
+            f.write(sHead.ljust(lSlot).encode('utf-8'))
+    return lFrames, (lWidth, lHeight)
+
+
+def read_svg_makerkey(sFileName):
+    """
+    The makerkey is the first element of the svg, so only the start of the file is parsed.
+    """
+    for _sEvent, objElement in ET.iterparse(sFileName, events=("end",)):
+        if objElement.tag.endswith("metadata") and objElement.get("id") == "makerkey":
+            return objElement.text
+        if not objElement.tag.endswith(("metadata", "svg")):
+            break
+    return None
+
+
+class SvgScanner:
+    """
+    describe_svg in a single pass over an svg fed to it in chunks. Elements are dropped as soon as they have been
+    looked at, so only the one being parsed is held.
+    """
+    def __init__(self):
+        self.objParser = ET.XMLPullParser(events=("start", "end"))
+        self.sMakerKey = None
+        self.lFrames = 0
+        self.tDimensions = None
+
+    def _read_events(self):
+        for sEvent, objElement in self.objParser.read_events():
+            if sEvent == "start":
+                if self.tDimensions is None and objElement.tag.endswith("svg"):
+                    self.tDimensions = (int(objElement.get("width")), int(objElement.get("height")))
+                continue
+            if self.sMakerKey is None and objElement.tag.endswith("metadata") and objElement.get("id") == "makerkey":
+                self.sMakerKey = objElement.text
+            elif objElement.tag.endswith("}g") and (objElement.get("id") or "").startswith("g"):
+                self.lFrames += 1
+            objElement.clear()
+
+    def feed(self, bChunk):
+        self.objParser.feed(bChunk)
+        self._read_events()
+
+    def describe(self):
+        self.objParser.close()
+        self._read_events()
+        return self.sMakerKey, self.lFrames, self.tDimensions
+
+
+def describe_svg(sFileName):
+    sMakerKey = read_svg_makerkey(sFileName)
+    lFrames = 0
+    tDimensions = None
+    for sEvent, objElement in ET.iterparse(sFileName, events=("start", "end")):
+        if sEvent == "start" and tDimensions is None and objElement.tag.endswith("svg"):
+            tDimensions = (int(objElement.get("width")), int(objElement.get("height")))
+        elif sEvent == "end":
+            if objElement.tag.endswith("}g") and (objElement.get("id") or "").startswith("g"):
+                lFrames += 1
+            objElement.clear()
+    return sMakerKey, lFrames, tDimensions
+
+
+dctEncoders = {
+    "gif": Encoder("gif", False, write_gif, read_gif_makerkey, describe_gif, GifScanner),
+    "webp": Encoder("webp", False, write_webp, read_webp_makerkey, describe_pil(read_webp_makerkey), None),
+    "apng": Encoder("png", False, write_apng, read_apng_makerkey, describe_pil(read_apng_makerkey), None),
+    "svg": Encoder("svg", True, None, read_svg_makerkey, describe_svg, SvgScanner),
+}
+tExtensions = tuple(objEncoder.sExtension for objEncoder in dctEncoders.values())
+
+
+def encoder_for_file(sFileName):
+    """
+    :return: Encoder. The encoder of a saved animation, going by its extension.
+    """
+    sExtension = sFileName.rsplit('.', 1)[-1].lower()
+    for objEncoder in dctEncoders.values():
+        if objEncoder.sExtension == sExtension:
+            return objEncoder
+    raise ValueError("Not an animation format: " + sFileName)
+
+
+def read_makerkey(sFileName):
+    """
+    :return: String. The makerkey json embedded in a saved animation of any format, or None if it has none.
+    """
+    return encoder_for_file(sFileName).fncReadMakerKey(sFileName)
+
+
+def describe(sFileName):
+    """
+    :return: Tuple. (makerkey json or None, frame count, (width, height)) of a saved animation of any format.
+    """
+    return encoder_for_file(sFileName).fncDescribe(sFileName)
@@ -0,0 +1,394 @@
+import numpy as np
+from contextlib import redirect_stdout
+import argparse
+import random
+import json
+import sys
+import os
+
+import rulesandinstructions
+import stringparser
+import kernels
+import turtle3d
+
+# Backends must match the reference's rewrites character for character. Segments only have to match to rounding:
+# compiled kernels multiply facings out by hand where the reference calls numpy's dot, which may use BLAS and round
+# differently. Segment counts and order must still match exactly.
+fSegmentTolerance = 1e-9
+# The least a backend must speed each stage up by over the reference, summed across the benchmark cases. Stages a
+# backend doesn't speed up (e.g. interpretation on numpy, which is the reference's) aren't gated, only checked.
+dctMinSpeedups = {"numpy": {"rewrite": 1.5},
+                  "numba": {"rewrite": 1.5, "interpret": 5.}}
+# Reference stage timings below this are too noisy to gate
+fMinSeconds = .05
+sAlphabet = "FXY+-"
+
+
+def odd_cases():
+    """
+    Rule sets exercising the corners of lindenmayer.lindenate, as lindenmayer.main does: disabled rules, named groups
+    and backreferences, lookahead, protected and unprotected successors overlapping later matches, and ^$ axioms.
+    :return: List. (name, rules, axiom, iterations) tuples.
+    """
+    liMainRules = [
+        rulesandinstructions.new_rule(r"test", [(1, r"ans")], "Rule1", bEnabled=False, bProtected=False),
+        rulesandinstructions.new_rule(r"1", [(1, r"3")], "Rule2"),
+        rulesandinstructions.new_rule(r"(2(?P<middleLetter>[a-z])2)", [(1, r"Z\g<middleLetter>Z")], "Rule3"),
+        rulesandinstructions.new_rule(r"[a-zA-Z][\d]", [(.5, r"7"), (1, r"9")], "Rule4"),
+    ]
+    liOverlapRules = [
+        rulesandinstructions.new_rule(r"^$", [(1, "ABBAAAA")], "Axiom"),
+        rulesandinstructions.new_rule(r"(.)(?=AAA)", [(1, "Z")], "Rule One"),
+        rulesandinstructions.new_rule(r"AA", [(1, "CC")], "Rule Two"),
+        rulesandinstructions.new_rule(r"A", [(1, "B")], "Rule Three"),
+        rulesandinstructions.new_rule(r"B", [(1, "AAAA")], "Rule Four"),
+    ]
+    # The same rules with nothing protected, so later rules rewrite earlier successors
+    liExposedRules = [dict(dctRule, protected=False) for dctRule in liOverlapRules]
+    return [("main", liMainRules, "ttest8est82a22b2", 2),
+            ("overlap", liOverlapRules, "BBAAAA", 1),
+            ("overlap axiom", liOverlapRules, "", 8),
+            ("exposed axiom", liExposedRules, "", 8),
+            ("koch", rulesandinstructions.liKochCurveRules, "", 3),
+            ("plant1", rulesandinstructions.liPlant1Rules, "X", 5),
+            ("plant2", rulesandinstructions.LiPlant2Rules, "[+X][X][-X]", 5),
+            ("tree", rulesandinstructions.liTreeRules, "[Z][X][C]", 5),
+            ("hilbert 3d", rulesandinstructions.li3dHilbertRules, "", 3),
+            ("bush 3d", rulesandinstructions.li3dBushRules, "A", 5)]
+
+
+def random_text(objRandom, lMax):
+    """
+    :return: String. Up to lMax characters of sAlphabet, with balanced brackets mixed in.
+    """
+    liOut = []
+    for _i in range(objRandom.randint(0, lMax)):
+        liOut.append(objRandom.choice(sAlphabet))
+    if len(liOut) > 1 and objRandom.random() < .5:
+        lStart = objRandom.randrange(len(liOut))
+        liOut.insert(objRandom.randint(lStart, len(liOut)), "]")
+        liOut.insert(lStart, "[")
+    return "".join(liOut)
+
+
+def random_rule(objRandom, i):
+    """
+    A random rule in one of the predecessor shapes the web app's users write, with 1 to 3 successors, which may
+    leave some probability over for the empty string.
+    """
+    sChar = objRandom.choice(sAlphabet)
+    sOther = objRandom.choice(sAlphabet)
+    sLiteral = "\\" + sChar if sChar in "+-" else sChar
+    sOtherLiteral = "\\" + sOther if sOther in "+-" else sOther
+    sPredecessor, sReference = objRandom.choice([
+        (sLiteral, ""),
+        (sLiteral + sOtherLiteral, ""),
+        ("[XY]", ""),
+        (sLiteral + "(?=" + sOtherLiteral + ")", ""),
+        ("(?<=" + sOtherLiteral + ")" + sLiteral, ""),
+        ("(" + sLiteral + ")", r"\1"),
+        ("(?P<c>[" + sAlphabet.replace("-", r"\-") + "])", r"\g<c>"),
+        ("^$", ""),
+    ])
+    liThresholds = sorted(objRandom.random() for _j in range(objRandom.randint(1, 3)))
+    if objRandom.random() < .7:
+        liThresholds[-1] = 1
+    liSuccessors = []
+    for fThreshold in liThresholds:
+        sSuccessor = random_text(objRandom, 5)
+        if sReference:
+            lAt = objRandom.randint(0, len(sSuccessor))
+            sSuccessor = sSuccessor[:lAt] + sReference + sSuccessor[lAt:]
+        liSuccessors.append((fThreshold, sSuccessor))
+    return rulesandinstructions.new_rule(sPredecessor, liSuccessors, "Random {}".format(i),
+                                         bEnabled=objRandom.random() < .9, bProtected=objRandom.random() < .6)
+
+
+def random_cases(lCount, lSeed=0):
+    """
+    :return: List. lCount (name, rules, axiom, iterations) tuples of random rules, reproducible from lSeed.
+    """
+    objRandom = random.Random(lSeed)
+    liOut = []
+    for i in range(lCount):
+        liRules = [random_rule(objRandom, j) for j in range(objRandom.randint(1, 5))]
+        liOut.append(("random {}".format(i), liRules, random_text(objRandom, 8), objRandom.randint(1, 4)))
+    return liOut
+
+
+def outcome(fncCall):
+    """
+    Run a call for comparison: its result, or the type of the exception it raised, which backends must raise alike.
+    Progress bars are silenced.
+    """
+    try:
+        with open(os.devnull, 'w') as fNull, redirect_stdout(fNull):
+            return fncCall()
+    except Exception as e:
+        return type(e).__name__
+
+
+def check_rewrites(objBackend, liCases, liSeeds):
+    """
+    Rewrite every case with a backend and with the reference from the same seeds. Both the text and the random state
+    left afterwards must match, as the next generation is rewritten from that state.
+    :return: List. Descriptions of the mismatches.
+    """
+    liFailures = []
+    for sName, liRules, sAxiom, lIterations in liCases:
+        for lSeed in liSeeds:
+            random.seed(lSeed)
+            objExpected = outcome(lambda: kernels.reference.fncLindenate(liRules, sAxiom, lIterations))
+            tExpectedState = random.getstate()
+            random.seed(lSeed)
+            objActual = outcome(lambda: objBackend.fncLindenate(liRules, sAxiom, lIterations))
+            if objActual != objExpected:
+                liFailures.append("{} rewrite of {} (seed {}) differs: {!r} instead of {!r}".format(
+                    objBackend.sName, sName, lSeed, str(objActual)[:80], str(objExpected)[:80]))
+            elif random.getstate() != tExpectedState:
+                liFailures.append("{} rewrite of {} (seed {}) leaves random in another state".format(
+                    objBackend.sName, sName, lSeed))
+    return liFailures
+
+
+def compare_segments(sLabel, npaActual, npaExpected):
+    """
+    :return: String. Description of how two (N, 2, lDimensions) arrays of segments differ, or None if they match.
+    """
+    if npaActual.shape != npaExpected.shape:
+        return "{} has shape {} instead of {}".format(sLabel, npaActual.shape, npaExpected.shape)
+    fScale = max(1., np.abs(npaExpected).max()) if npaExpected.size else 1.
+    npaWrong = ~np.isclose(npaActual, npaExpected, rtol=fSegmentTolerance, atol=fSegmentTolerance * fScale)
+    if npaWrong.any():
+        lFirst = np.argwhere(npaWrong)[0][0]
+        return "{} differs from segment {}: {} instead of {}".format(sLabel, lFirst, npaActual[lFirst].tolist(),
+                                                                     npaExpected[lFirst].tolist())
+    return None
+
+
+def collect(itSegments, lDimensions):
+    """
+    :param itSegments: Iterable of segments, or of blocks of segments.
+    :return: Numpy array. (N, 2, lDimensions) segments.
+    """
+    return np.concatenate([np.empty((0, 2, lDimensions))] +
+                          [np.asarray(npa, dtype=np.float64).reshape(-1, 2, lDimensions) for npa in itSegments])
+
+
+def check_interpretations(objBackend, liTexts):
+    """
+    Interpret texts with a backend and with stringparser.iter_segments.
+    :param liTexts: List. (name, text, instructions, lDimensions, start position, start facing) tuples.
+    :return: List. Descriptions of the mismatches.
+    """
+    liFailures = []
+    for sName, sText, dctInstructions, lDimensions, npaPos, npaFac in liTexts:
+        if lDimensions != 2:
+            continue
+        objExpected = outcome(lambda: collect(stringparser.iter_segments(sText, dctInstructions, lDimensions,
+                                                                         npaPos, npaFac), lDimensions))
+        objActual = outcome(lambda: collect(objBackend.fncSegmentBlocks(sText, dctInstructions, lDimensions,
+                                                                        npaPos, npaFac), lDimensions))
+        sLabel = "{} interpretation of {}".format(objBackend.sName, sName)
+        if isinstance(objExpected, str) or isinstance(objActual, str):
+            if str(objActual) != str(objExpected):
+                liFailures.append("{} gives {} instead of {}".format(sLabel, str(objActual)[:80],
+                                                                     str(objExpected)[:80]))
+            continue
+        sFailure = compare_segments(sLabel, objActual, objExpected)
+        if sFailure is not None:
+            liFailures.append(sFailure)
+    return liFailures
+
+
+def check_3d_interpretations(liTexts):
+    """
+    turtle3d.segments against turtle3d.iter_segments, the 3D interpreter's own reference.
+    :return: List. Descriptions of the mismatches.
+    """
+    liFailures = []
+    for sName, sText, dctInstructions, lDimensions, npaPos, npaFac in liTexts:
+        if lDimensions != 3:
+            continue
+        objExpected = outcome(lambda: collect(turtle3d.iter_segments(sText, dctInstructions, npaPos, npaFac), 3))
+        objActual = outcome(lambda: turtle3d.segments(sText, dctInstructions, npaPos, npaFac))
+        sLabel = "vectorised 3D interpretation of {}".format(sName)
+        if isinstance(objExpected, str) or isinstance(objActual, str):
+            if str(objActual) != str(objExpected):
+                liFailures.append("{} gives {} instead of {}".format(sLabel, str(objActual)[:80],
+                                                                     str(objExpected)[:80]))
+            continue
+        sFailure = compare_segments(sLabel, objActual, objExpected)
+        if sFailure is not None:
+            liFailures.append(sFailure)
+    return liFailures
+
+
+def interpretation_texts(liCases, lSeed=0):
+    """
+    Texts to interpret: each case's rewrite, drawn with the instructions it's meant for (random rules with the
+    standard 2D and 3D ones), plus random strings with stack underflows and unknown characters.
+    :return: List. Tuples for check_interpretations.
+    """
+    objRandom = random.Random(lSeed)
+    dct2d = rulesandinstructions.std_2d_instructions(np.pi * 0.125)
+    dct3d = rulesandinstructions.std_3d_instructions(np.pi / 8)
+    # Pushes and pops on either side of the move, for the 3D interpreter's stack matching
+    dct3d["<"] = dict(dct3d["["], **{"pop-push": [0, 0, 0, 0, 0, 0, 1, 1], "movement": 1, "draw": True})
+    dct3d[">"] = dict(dct3d["]"], **{"pop-push": [1, 1, 1, 1, 0, 0, 0, 0], "movement": .5, "draw": True})
+    liOut = []
+    for sName, liRules, sAxiom, lIterations in liCases:
+        random.seed(lSeed)
+        sText = outcome(lambda: kernels.reference.fncLindenate(liRules, sAxiom, lIterations))
+        if not isinstance(sText, str):
+            continue
+        if sName == "koch":
+            liOut.append((sName, sText, rulesandinstructions.dct2dStdInstructions, 2, None, np.array([1, 0])))
+        elif "3d" in sName:
+            liOut.append((sName, sText, dict(rulesandinstructions.std_3d_instructions(
+                np.pi / 2 if sName.startswith("hilbert") else np.pi / 8)), 3, None, None))
+        else:
+            liOut.append((sName, sText, dct2d, 2, np.array([.5, 0]), np.array([0, 1])))
+            liOut.append((sName, sText, dct3d, 3, None, np.array([1., 2., .5])))
+    for i in range(20):
+        sText = "".join(objRandom.choice("FGf+-&^/|[]<>Xé") for _j in range(objRandom.randint(0, 200)))
+        liOut.append(("random string {}".format(i), sText, dct2d, 2, None, None))
+        liOut.append(("random string {}".format(i), sText, dct3d, 3, np.array([1., 0, 0]), None))
+    return liOut
+
+
+def check(lRandomCases=200, lSeed=0, liBackends=None):
+    """
+    Run every backend against the reference on the odd cases, the shipped rule sets and lRandomCases random rule
+    sets, and the vectorised 3D interpreter against its sequential one.
+    :param liBackends: List. Names of the backends to check. Defaults to all of kernels.dctBackends.
+    :return: List. Descriptions of the mismatches.
+    """
+    liCases = odd_cases() + random_cases(lRandomCases, lSeed)
+    liSeeds = [lSeed, lSeed + 1, lSeed + 2]
+    liTexts = interpretation_texts(liCases, lSeed)
+    liFailures = []
+    for sName in liBackends or kernels.dctBackends:
+        objBackend = kernels.dctBackends[sName]
+        if objBackend is kernels.reference:
+            continue
+        liBackendFailures = check_rewrites(objBackend, liCases, liSeeds) + \
+            check_interpretations(objBackend, liTexts)
+        print("{:>10}: {} rewrites, {} interpretations, {} mismatches".format(
+            sName, len(liCases) * len(liSeeds), len([t for t in liTexts if t[3] == 2]), len(liBackendFailures)))
+        liFailures.extend(liBackendFailures)
+    li3dFailures = check_3d_interpretations(liTexts)
+    print("{:>10}: {} interpretations, {} mismatches".format("turtle3d", len([t for t in liTexts if t[3] == 3]),
+                                                             len(li3dFailures)))
+    return liFailures + li3dFailures
+
+
+def time_backend(objBackend, liCaseNames=None, lSeed=0, lRepeats=3):
+    """
+    Time a backend's rewrite and interpret stages on the benchmark cases at their largest generation count, as
+    benchmark.run_case does, recording results in benchmark.run's format.
+    :return: Dictionary. A benchmark run of just those stages.
+    """
+    # The benchmark pulls in matplotlib and the renderer, so it's only imported to time
+    import benchmark
+    liResults = []
+    for dctCase in benchmark.std_cases():
+        if liCaseNames and dctCase["name"] not in liCaseNames:
+            continue
+        lGenerations = max(dctCase["liGenerations"])
+
+        def rewrite():
+            random.seed(lSeed)
+            return objBackend.fncLindenate(dctCase["liRules"], dctCase["sAxiom"], lGenerations)
+
+        def interpret():
+            return collect(objBackend.fncSegmentBlocks(sText, dctCase["dctInstructions"], 2, dctCase["npaStartPos"],
+                                                       dctCase["npaStartFac"]), 2)
+
+        dctBase = {"case": dctCase["name"], "generations": lGenerations, "seed": lSeed}
+        with open(os.devnull, 'w') as fNull, redirect_stdout(fNull):
+            sText, fRewrite, _lPeak = benchmark.measure(rewrite, lRepeats)
+            _npaSegments, fInterpret, _lPeak = benchmark.measure(interpret, lRepeats)
+        liResults.append(dict(dctBase, stage="rewrite", seconds=fRewrite))
+        liResults.append(dict(dctBase, stage="interpret", seconds=fInterpret))
+    return {"meta": {"backend": objBackend.sName, "seed": lSeed, "repeats": lRepeats}, "results": liResults}
+
+
+def speedups(dctReference, dctCurrent):
+    """
+    Speedup of each stage between two benchmark runs, over the cases and generation counts both have.
+    :param dctReference: Dictionary. A benchmark run on the python backend, e.g. from benchmark.py run with
+        FRACTAL_BACKEND=python, or time_backend.
+    :param dctCurrent: Dictionary. A run on the backend being gated.
+    :return: Dictionary. Stage to (reference seconds, current seconds), summed.
+    """
+    dctOld = {(r["case"], r["generations"], r["stage"]): r["seconds"] for r in dctReference["results"]}
+    dctOut = {}
+    for dctResult in dctCurrent["results"]:
+        tKey = (dctResult["case"], dctResult["generations"], dctResult["stage"])
+        if tKey not in dctOld:
+            continue
+        fOld, fNew = dctOut.get(dctResult["stage"], (0., 0.))
+        dctOut[dctResult["stage"]] = (fOld + dctOld[tKey], fNew + dctResult["seconds"])
+    return dctOut
+
+
+def gate(dctReference, dctCurrent):
+    """
+    Hold a benchmark run to its backend's dctMinSpeedups over the reference run.
+    :return: List. Descriptions of the stages that are too slow.
+    """
+    sBackend = dctCurrent["meta"].get("backend")
+    dctMinimums = dctMinSpeedups.get(sBackend, {})
+    liFailures = []
+    for sStage, (fOld, fNew) in sorted(speedups(dctReference, dctCurrent).items()):
+        fSpeedup = fOld / fNew if fNew else float('inf')
+        fMinimum = dctMinimums.get(sStage)
+        bSkipped = fMinimum is None or fOld < fMinSeconds
+        print("{:>10} {:>10}: {:9.4f}s -> {:9.4f}s ({:.2f}x{})".format(
+            sBackend, sStage, fOld, fNew, fSpeedup, "" if bSkipped else ", needs {:.2f}x".format(fMinimum)))
+        if not bSkipped and fSpeedup < fMinimum:
+            liFailures.append("{} {} is only {:.2f}x faster than the reference, below {:.2f}x".format(
+                sBackend, sStage, fSpeedup, fMinimum))
+    return liFailures
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Check the kernels backends against the reference "
+                                                    "implementations, failing on any difference or slowdown.")
+    objSubparsers = objParser.add_subparsers(dest="command", required=True)
+    objCheck = objSubparsers.add_parser("check", help="compare every backend's output with the reference's")
+    objCheck.add_argument("--random", type=int, default=200, help="number of random rule sets")
+    objCheck.add_argument("--seed", type=int, default=0)
+    objCheck.add_argument("--backends", nargs="*", help="backends to check (default: all)")
+    objSpeed = objSubparsers.add_parser("speed", help="time every backend on the benchmark cases and gate speedups")
+    objSpeed.add_argument("--cases", nargs="*", help="benchmark cases to time (default: all)")
+    objSpeed.add_argument("--repeats", type=int, default=3)
+    objGate = objSubparsers.add_parser("gate", help="gate saved benchmark runs against a reference run")
+    objGate.add_argument("reference", help="results of benchmark.py run with FRACTAL_BACKEND=python")
+    objGate.add_argument("current", nargs="+", help="results of benchmark.py run on other backends")
+    objArgs = objParser.parse_args()
+
+    if objArgs.command == "check":
+        liFailures = check(objArgs.random, objArgs.seed, objArgs.backends)
+    elif objArgs.command == "speed":
+        dctReference = time_backend(kernels.reference, objArgs.cases, lRepeats=objArgs.repeats)
+        liFailures = []
+        for objBackend in kernels.dctBackends.values():
+            if objBackend is not kernels.reference:
+                liFailures.extend(gate(dctReference, time_backend(objBackend, objArgs.cases,
+                                                                  lRepeats=objArgs.repeats)))
+    else:
+        with open(objArgs.reference, 'r') as f:
+            dctReference = json.load(f)
+        liFailures = []
+        for sCurrent in objArgs.current:
+            with open(sCurrent, 'r') as f:
+                liFailures.extend(gate(dctReference, json.load(f)))
+    for sFailure in liFailures:
+        print("FAILED " + sFailure)
+    sys.exit(1 if liFailures else 0)
+
+
+if __name__ == "__main__":
+    main()
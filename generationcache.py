@@ -0,0 +1,248 @@
+from itertools import islice
+import argparse
+import hashlib
+import random
+import json
+import mmap
+import os
+
+import junkdrawer
+import lindenmayer
+import kernels
+import animationindex
+
+lDefaultMaxBytes = 1024 ** 3
+
+
+def state_from_json(liState):
+    """
+    :param liState: List. A random state as stored in json, or None.
+    :return: Tuple. The state as random.setstate takes it, or None.
+    """
+    return None if liState is None else (liState[0], tuple(liState[1]), liState[2])
+
+
+def is_deterministic(liRules):
+    """
+    Whether a rule set rewrites every string the same way whatever the random state, i.e. every enabled rule always
+    picks its first successor.
+    """
+    return all(not dctRule["enabled"] or float(dctRule["successor"][0][0]) >= 1 for dctRule in liRules)
+
+
+def cache_key(liRules, sAxiom, lSeed=None):
+    """
+    Key of the generations of a rule set from an axiom. The seed only matters for stochastic rules.
+    :return: String. Hex digest, or None if the generations can't be reproduced (stochastic rules without a seed).
+    """
+    if is_deterministic(liRules):
+        lSeed = None
+    elif lSeed is None:
+        return None
+    sKey = json.dumps([animationindex.rules_hash(liRules), sAxiom, lSeed])
+    return hashlib.sha256(sKey.encode('utf-8')).hexdigest()[:32]
+
+
+class GenerationCache:
+    """
+    Generation strings on disk, keyed on (rules hash, axiom, seed, generation).
+    Each generation is a plain file of its utf-8 text, so it can be memory mapped instead of read, next to the random
+    state that rewriting it further starts from. Reading a generation marks it as recently used, and once the cache
+    holds more than lMaxBytes the least recently used generations are deleted.
+    """
+    def __init__(self, sFolder=None, lMaxBytes=lDefaultMaxBytes):
+        """
+        :param sFolder: String. Folder of the cache. Defaults to junkdrawer.sGenerationCacheFolder.
+        :param lMaxBytes: Integer. Size the cache is trimmed to.
+        """
+        self.sFolder = sFolder or junkdrawer.sGenerationCacheFolder
+        self.lMaxBytes = lMaxBytes
+
+    def path(self, sKey, lGeneration):
+        """
+        :return: String. Path of the text of a generation; its random state is the same path ending in .rng.
+        """
+        return os.path.join(self.sFolder, sKey, "{}.gen".format(lGeneration))
+
+    def open_generation(self, sKey, lGeneration):
+        """
+        Memory map a cached generation.
+        :return: mmap, or None if it isn't cached. The caller closes it.
+        """
+        sPath = self.path(sKey, lGeneration)
+        try:
+            with open(sPath, 'rb') as f:
+                os.utime(sPath)
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def get(self, sKey, lGeneration):
+        """
+        :return: Tuple. (text, random state) of a cached generation, or (None, None).
+        """
+        mmText = self.open_generation(sKey, lGeneration)
+        if mmText is None:
+            return None, None
+        try:
+            sText = bytes(mmText).decode('utf-8')
+        finally:
+            if isinstance(mmText, mmap.mmap):
+                mmText.close()
+        try:
+            return sText, self.get_state(sKey, lGeneration)
+        except FileNotFoundError:
+            return None, None
+
+    def get_state(self, sKey, lGeneration):
+        """
+        :return: Tuple. The random state stored with a generation, or None for deterministic rules. Raises
+            FileNotFoundError if the generation isn't cached.
+        """
+        with open(self.path(sKey, lGeneration)[:-4] + '.rng', 'r') as f:
+            return state_from_json(json.load(f))
+
+    def put(self, sKey, lGeneration, sText, tState, bEvict=True):
+        """
+        Store a generation and the random state to rewrite it with, then trim the cache.
+        Files are written under temporary names and renamed, so concurrent renders never see half a generation.
+        :param bEvict: Boolean. Whether to trim the cache afterwards; the caller may want to map the generation first.
+        """
+        sPath = self.path(sKey, lGeneration)
+        os.makedirs(os.path.dirname(sPath), exist_ok=True)
+        sSuffix = ".{}.tmp".format(os.getpid())
+        with open(sPath[:-4] + '.rng' + sSuffix, 'w') as f:
+            json.dump(tState, f)
+        with open(sPath + sSuffix, 'wb') as f:
+            f.write(sText.encode('utf-8'))
+        # The state goes first: a .gen is only ever visible with its .rng beside it
+        os.replace(sPath[:-4] + '.rng' + sSuffix, sPath[:-4] + '.rng')
+        os.replace(sPath + sSuffix, sPath)
+        if bEvict:
+            self.evict()
+
+    def entries(self):
+        """
+        :return: List. (last used, bytes, path of the .gen) of every cached generation.
+        """
+        liOut = []
+        if not os.path.isdir(self.sFolder):
+            return liOut
+        for objKey in os.scandir(self.sFolder):
+            if not objKey.is_dir():
+                continue
+            for objFile in os.scandir(objKey.path):
+                if objFile.name.endswith('.gen'):
+                    try:
+                        objStat = objFile.stat()
+                        lRng = os.path.getsize(objFile.path[:-4] + '.rng')
+                    except FileNotFoundError:
+                        continue
+                    liOut.append((objStat.st_mtime, objStat.st_size + lRng, objFile.path))
+        return liOut
+
+    def evict(self, lMaxBytes=None):
+        """
+        Delete the least recently used generations until the cache fits in lMaxBytes.
+        :return: Integer. Number of generations deleted.
+        """
+        lMaxBytes = self.lMaxBytes if lMaxBytes is None else lMaxBytes
+        liEntries = self.entries()
+        lTotal = sum(tEntry[1] for tEntry in liEntries)
+        lDeleted = 0
+        for fUsed, lBytes, sPath in sorted(liEntries):
+            if lTotal <= lMaxBytes:
+                break
+            for sFile in (sPath, sPath[:-4] + '.rng'):
+                try:
+                    os.remove(sFile)
+                except FileNotFoundError:
+                    pass
+            lTotal -= lBytes
+            lDeleted += 1
+        if lDeleted:
+            for objKey in os.scandir(self.sFolder):
+                if objKey.is_dir() and not os.listdir(objKey.path):
+                    try:
+                        os.rmdir(objKey.path)
+                    except OSError:
+                        pass
+        return lDeleted
+
+
+cache = GenerationCache()
+
+
+def lindenator(liRules, sInput="", lSeed=None, lMaxReturns=None, fncCheckpoint=None, objCache=None, tResume=None):
+    """
+    lindenmayer.lindenator, reading generations from the generation cache and storing the ones it has to rewrite.
+    Seeds random with lSeed first, so a render that continues past the cached generations rewrites exactly as an
+    uncached one would. Stochastic rules without a seed can't be reproduced, and are simply rewritten.
+    Whenever a generation is yielded, random is left in the state rewriting it further starts from, cached or not.
+    :param objCache: GenerationCache. Defaults to cache.
+    :param tResume: Tuple. (generation number, text, random state) of a generation already in hand, e.g. from a
+        checkpoint (see checkpoints), to continue from rather than rewriting from sInput. Only the generations after
+        it are yielded, up to lMaxReturns counting from the axiom.
+    """
+    objCache = objCache or cache
+    sText, tState = sInput, None
+    i = 0
+    if tResume is not None:
+        i, sText, tState = tResume
+        i += 1
+    elif lSeed is not None:
+        random.seed(lSeed)
+    sKey = cache_key(liRules, sInput, lSeed)
+    if sKey is None:
+        if tResume is None:
+            yield from lindenmayer.lindenator(liRules, sInput, lMaxReturns=lMaxReturns, fncCheckpoint=fncCheckpoint,
+                                              fncLindenate=kernels.lindenate)
+            return
+        if tState is not None:
+            random.setstate(tState)
+        # lindenmayer.lindenator yields its input first, which a resumed generator already has
+        itGenerations = lindenmayer.lindenator(liRules, sText, lMaxReturns=None if lMaxReturns is None else
+                                               lMaxReturns - i + 1, fncCheckpoint=fncCheckpoint,
+                                               fncLindenate=kernels.lindenate)
+        yield from islice(itGenerations, 1, None)
+        return
+    bDeterministic = is_deterministic(liRules)
+    while lMaxReturns is None or i < lMaxReturns:
+        sCached, tCachedState = objCache.get(sKey, i)
+        if sCached is not None:
+            sText, tState = sCached, tCachedState
+            if tState is not None:
+                random.setstate(tState)
+        else:
+            if i > 0:
+                if fncCheckpoint is not None:
+                    fncCheckpoint()
+                if tState is not None:
+                    random.setstate(tState)
+                sText = kernels.lindenate(liRules, sText)
+            # Deterministic rules don't need the random state to continue
+            tState = None if bDeterministic else random.getstate()
+            objCache.put(sKey, i, sText, tState)
+        yield sText
+        i += 1
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Maintain the cache of rewritten generation strings.")
+    objParser.add_argument("command", choices=["stats", "trim", "clear"],
+                           help="stats: show the size; trim: evict down to --max-bytes; clear: empty the cache")
+    objParser.add_argument("--max-bytes", type=int, default=lDefaultMaxBytes)
+    objArgs = objParser.parse_args()
+    objCache = GenerationCache(lMaxBytes=objArgs.max_bytes)
+    if objArgs.command == "stats":
+        liEntries = objCache.entries()
+        print("{} generations, {} bytes".format(len(liEntries), sum(tEntry[1] for tEntry in liEntries)))
+    else:
+        lDeleted = objCache.evict(0 if objArgs.command == "clear" else None)
+        print("{} generations evicted".format(lDeleted))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import mmap
+import os
+import sys
+import timeit
+
+import junkdrawer
+
+
+class GifFormatError(ValueError):
+    """
+    Raised when a file doesn't follow the GIF block structure.
+    """
+    pass
+
+
+def skip_sub_blocks(buf, lPos):
+    """
+    Step over a chain of data sub-blocks.
+    :param buf: bytes-like. The gif.
+    :param lPos: Integer. Offset of the first sub-block's size byte.
+    :return: Integer. Offset just past the block terminator.
+    """
+    lSize = buf[lPos]
+    while lSize:
+        lPos += lSize + 1
+        lSize = buf[lPos]
+    return lPos + 1
+
+
+def read_sub_blocks(buf, lPos):
+    """
+    Collect the data of a chain of sub-blocks.
+    :return: Tuple. (bytes of data, offset just past the block terminator)
+    """
+    liData = []
+    lSize = buf[lPos]
+    while lSize:
+        liData.append(buf[lPos + 1:lPos + 1 + lSize])
+        lPos += lSize + 1
+        lSize = buf[lPos]
+    return b"".join(liData), lPos + 1
+
+
+def scan_gif(buf, bCountFrames=True):
+    """
+    Walk the block structure of a gif without decoding any image data.
+    Image data sub-blocks are stepped over by their size bytes, so the cost depends on the number of blocks rather than
+    on the number of pixels.
+    :param buf: bytes-like. The whole gif, e.g. an mmap.
+    :param bCountFrames: Boolean. If False, stop as soon as the first comment is found.
+    :return: Tuple. (bytes of the first comment extension or None, number of frames, (width, height))
+    """
+    if bytes(buf[:6]) not in (b"GIF87a", b"GIF89a"):
+        raise GifFormatError("Missing GIF header")
+    try:
+        tDimensions = (int.from_bytes(buf[6:8], 'little'), int.from_bytes(buf[8:10], 'little'))
+        lFlags = buf[10]
+        lPos = 13
+        if lFlags & 0x80:
+            lPos += 3 << ((lFlags & 0x07) + 1)
+        bComment = None
+        lFrames = 0
+        while True:
+            lIntroducer = buf[lPos]
+            if lIntroducer == 0x3B:  # Trailer
+                break
+            elif lIntroducer == 0x21:  # Extension
+                lLabel = buf[lPos + 1]
+                if lLabel == 0xFE and bComment is None:
+                    bComment, lPos = read_sub_blocks(buf, lPos + 2)
+                    if not bCountFrames:
+                        break
+                else:
+                    lPos = skip_sub_blocks(buf, lPos + 2)
+            elif lIntroducer == 0x2C:  # Image descriptor
+                lFrames += 1
+                lFlags = buf[lPos + 9]
+                lPos += 10
+                if lFlags & 0x80:
+                    lPos += 3 << ((lFlags & 0x07) + 1)
+                # LZW minimum code size, then the image data sub-blocks
+                lPos = skip_sub_blocks(buf, lPos + 1)
+            else:
+                raise GifFormatError("Unexpected block 0x{:02X} at offset {}".format(lIntroducer, lPos))
+    except IndexError:
+        # Truncated file; report what was found before the end
+        pass
+    return bComment, lFrames, tDimensions
+
+
+class GifScanner:
+    """
+    scan_gif for a gif that arrives in pieces, e.g. an upload being streamed to disk: feed it every chunk as it
+    comes and ask for the result at the end. Only the block currently being parsed is buffered; image data isn't
+    kept at all, just counted past.
+    """
+    def __init__(self):
+        self.bComment = None
+        self.lFrames = 0
+        self.tDimensions = None
+        self.bDone = False
+        self.itParser = self._parse()
+        # The parser asks for a number of bytes, and whether it wants them or only wants them skipped
+        self.lNeeded, self.bKeep = next(self.itParser)
+        self.baPending = bytearray()
+
+    def _parse(self):
+        bHeader = yield 13, True
+        if bHeader[:6] not in (b"GIF87a", b"GIF89a"):
+            raise GifFormatError("Missing GIF header")
+        self.tDimensions = (int.from_bytes(bHeader[6:8], 'little'), int.from_bytes(bHeader[8:10], 'little'))
+        if bHeader[10] & 0x80:
+            yield 3 << ((bHeader[10] & 0x07) + 1), False
+        while True:
+            lIntroducer = (yield 1, True)[0]
+            if lIntroducer == 0x3B:  # Trailer
+                return
+            elif lIntroducer == 0x21:  # Extension
+                bKeep = (yield 1, True)[0] == 0xFE and self.bComment is None
+                liData = []
+                lSize = (yield 1, True)[0]
+                while lSize:
+                    bData = yield lSize, bKeep
+                    if bKeep:
+                        liData.append(bData)
+                    lSize = (yield 1, True)[0]
+                if bKeep:
+                    self.bComment = b"".join(liData)
+            elif lIntroducer == 0x2C:  # Image descriptor
+                self.lFrames += 1
+                lFlags = (yield 9, True)[8]
+                if lFlags & 0x80:
+                    yield 3 << ((lFlags & 0x07) + 1), False
+                # LZW minimum code size, then the image data sub-blocks
+                yield 1, False
+                lSize = (yield 1, True)[0]
+                while lSize:
+                    yield lSize, False
+                    lSize = (yield 1, True)[0]
+            else:
+                raise GifFormatError("Unexpected block 0x{:02X}".format(lIntroducer))
+
+    def feed(self, bChunk):
+        """
+        :param bChunk: bytes-like. The next piece of the gif. Anything after the trailer is ignored.
+        """
+        lPos, lLength = 0, len(bChunk)
+        while not self.bDone and lPos < lLength:
+            lTake = min(self.lNeeded, lLength - lPos)
+            if self.bKeep:
+                self.baPending += bChunk[lPos:lPos + lTake]
+            lPos += lTake
+            self.lNeeded -= lTake
+            if self.lNeeded == 0:
+                bData = bytes(self.baPending)
+                self.baPending.clear()
+                try:
+                    self.lNeeded, self.bKeep = self.itParser.send(bData)
+                except StopIteration:
+                    self.bDone = True
+
+    def result(self):
+        """
+        :return: Tuple. As scan_gif: (bytes of the first comment extension or None, number of frames,
+            (width, height)). A truncated gif reports what was found before the end.
+        """
+        if self.tDimensions is None:
+            raise GifFormatError("Missing GIF header")
+        return self.bComment, self.lFrames, self.tDimensions
+
+
+def describe_gif_file(sFileName, bCountFrames=True):
+    """
+    Memory map a gif and scan it with scan_gif.
+    :param sFileName: String. Path of the gif.
+    :return: Tuple. (bytes of the first comment or None, number of frames, (width, height))
+    """
+    with open(sFileName, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise GifFormatError("Empty file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return scan_gif(mm, bCountFrames)
+
+
+def read_comment(sFileName):
+    """
+    Read the comment extension of a gif, which is where fractals keep their makerkey.
+    :param sFileName: String. Path of the gif.
+    :return: bytes. The comment, or None if the gif has none.
+    """
+    return describe_gif_file(sFileName, bCountFrames=False)[0]
+
+
+lTransparentIndex = 255
+# Longest delay a graphic control extension holds, in hundredths of a second
+lMaxDelay = 0xFFFF
+
+
+def shared_palette(liFrames):
+    """
+    Put frames on one palette, so that they can be compared pixel by pixel and share the global colour table.
+    The palette is built from the last frame, which has the most detail, and has at most 255 colours so that index
+    lTransparentIndex is free for transparency.
+    :param liFrames: List. PIL images.
+    :return: Tuple. (list of palettised PIL images, list of 768 palette values)
+    """
+    liRgb = [imgFrame.convert('RGB') for imgFrame in liFrames]
+    imgPalette = liRgb[-1].quantize(colors=lTransparentIndex, dither=0)
+    liPalette = imgPalette.getpalette()[:3 * lTransparentIndex]
+    liPalette += [0] * (3 * lTransparentIndex - len(liPalette))
+    imgPalette.putpalette(liPalette)
+    liPalettised = [imgFrame.quantize(palette=imgPalette, dither=0) for imgFrame in liRgb]
+    return liPalettised, liPalette + [0, 0, 0]
+
+
+def fixed_palette(liFrames):
+    """
+    The palette frames were drawn on, if they are all palettised on the same one and it leaves an index free for
+    transparency, e.g. the fixed black and white or grey palettes of lineart. Such frames need no quantising.
+    :param liFrames: List. PIL images.
+    :return: List. The palette's RGB values, or None if the frames have to be put on one with shared_palette.
+    """
+    liPalette = liFrames[0].getpalette() if liFrames[0].mode == 'P' else None
+    if liPalette is None or len(liPalette) >= 3 * lTransparentIndex:
+        return None
+    for imgFrame in liFrames[1:]:
+        if imgFrame.mode != 'P' or imgFrame.getpalette() != liPalette:
+            return None
+    return liPalette
+
+
+def difference_frames(liFrames, liDurations, lTransparent=lTransparentIndex):
+    """
+    Reduce each frame to the rectangle that changed since the previous one, with the pixels inside it that didn't
+    change made transparent, and fold frames identical to their predecessor into its duration.
+    :param liFrames: List. PIL images on one palette (see shared_palette) that doesn't use lTransparent.
+    :param liDurations: List. Milliseconds each frame is shown for.
+    :param lTransparent: Integer. Palette index for transparency.
+    :return: List. [numpy array of palette indices, (left, top), duration] per frame to write.
+    """
+    import numpy as np
+    liOut = []
+    npaPrevious = None
+    for imgFrame, lDuration in zip(liFrames, liDurations):
+        npaFrame = np.asarray(imgFrame)
+        if npaPrevious is None:
+            liOut.append([npaFrame, (0, 0), lDuration])
+        else:
+            npaChanged = npaFrame != npaPrevious
+            npaRows = np.flatnonzero(npaChanged.any(axis=1))
+            if len(npaRows) == 0:
+                liOut[-1][2] += lDuration
+                continue
+            npaColumns = np.flatnonzero(npaChanged.any(axis=0))
+            lTop, lBottom = npaRows[0], npaRows[-1] + 1
+            lLeft, lRight = npaColumns[0], npaColumns[-1] + 1
+            npaRegion = npaFrame[lTop:lBottom, lLeft:lRight].copy()
+            npaRegion[~npaChanged[lTop:lBottom, lLeft:lRight]] = lTransparent
+            liOut.append([npaRegion, (int(lLeft), int(lTop)), lDuration])
+        npaPrevious = npaFrame
+    return liOut
+
+
+def write_image(fOut, npaRegion, tOffset, lDuration, lTransparent, lCodeSize):
+    """
+    Write one frame: its graphic control extension, image descriptor and LZW compressed palette indices. PIL does
+    the compression, at the given code size rather than the 8 bits it always uses itself, through its private
+    ImageFile._save; the Pipfile pins the Pillow releases tests/test_gifblocks.py has round-tripped this through.
+    :param npaRegion: Numpy array. Palette indices, all below 2 ** lCodeSize.
+    :param tOffset: Tuple. (left, top) of the region in the animation.
+    :param lDuration: Integer. Milliseconds the frame is shown for. Past lMaxDelay hundredths of a second, the rest
+        is held by extra frames that change nothing.
+    :param lTransparent: Integer. Palette index for transparency.
+    :param lCodeSize: Integer. LZW minimum code size, at least 2.
+    """
+    from PIL import Image, ImageFile
+    lHeight, lWidth = npaRegion.shape
+    lDelay = lDuration // 10
+    # Disposal 1 leaves each frame in place, so the next one's transparent pixels show it through
+    fOut.write(b"!\xf9\x04\x05" + min(lDelay, lMaxDelay).to_bytes(2, 'little') + bytes((lTransparent, 0)))
+    fOut.write(b"," + tOffset[0].to_bytes(2, 'little') + tOffset[1].to_bytes(2, 'little')
+               + lWidth.to_bytes(2, 'little') + lHeight.to_bytes(2, 'little') + b"\x00" + bytes((lCodeSize,)))
+    # The indices are written as they are, so a plain greyscale image carries them
+    imgRegion = Image.fromarray(npaRegion)
+    ImageFile._save(imgRegion, fOut, [("gif", (0, 0, lWidth, lHeight), 0, ("L", lCodeSize, 0))])
+    fOut.write(b"\x00")
+    # Delays too long for one frame are carried on by transparent single pixel frames, with no disposal
+    for lStart in range(lMaxDelay, lDelay, lMaxDelay):
+        fOut.write(b"!\xf9\x04\x01" + min(lDelay - lStart, lMaxDelay).to_bytes(2, 'little') + bytes((lTransparent, 0)))
+        fOut.write(b",\x00\x00\x00\x00\x01\x00\x01\x00\x00" + bytes((lCodeSize,)))
+        ImageFile._save(Image.new("L", (1, 1), lTransparent), fOut, [("gif", (0, 0, 1, 1), 0, ("L", lCodeSize, 0))])
+        fOut.write(b"\x00")
+
+
+def write_animation(fOut, liFrames, liDurations, bComment=None, lLoop=0):
+    """
+    Write an animated gif block by block: one global colour table, the comment, and each frame as only the region
+    that changed from the previous frame (see difference_frames), each with its own duration. Holding a frame is
+    a longer duration rather than repeated frames. Frames already on a small shared palette (see fixed_palette) are
+    written as they are, with a colour table and LZW code size no bigger than the palette needs; any others are
+    quantised onto a 256 colour palette first.
+    :param fOut: File object opened for binary writing.
+    :param liFrames: List. PIL images, all the same size.
+    :param liDurations: List. Milliseconds each frame is shown for.
+    :param bComment: bytes. Comment extension, e.g. a makerkey.
+    :param lLoop: Integer. Number of loops, 0 for forever.
+    :return: Integer. Number of frames written.
+    """
+    liPalette = fixed_palette(liFrames)
+    if liPalette is None:
+        liPalettised, liPalette = shared_palette(liFrames)
+        lTransparent = lTransparentIndex
+    else:
+        liPalettised = liFrames
+        # Transparency takes the first index after the palette's colours
+        lTransparent = len(liPalette) // 3
+    lTableBits = max(lTransparent.bit_length(), 1)
+    liPalette = liPalette + [0] * (3 * (1 << lTableBits) - len(liPalette))
+    lWidth, lHeight = liFrames[0].size
+    fOut.write(b"GIF89a" + lWidth.to_bytes(2, 'little') + lHeight.to_bytes(2, 'little'))
+    # Global colour table of 2 ** lTableBits entries, 8 bits per primary; background index 0; square pixels
+    fOut.write(bytes((0xF0 | (lTableBits - 1), 0, 0)) + bytes(liPalette))
+    fOut.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + lLoop.to_bytes(2, 'little') + b"\x00")
+    if bComment:
+        fOut.write(b"!\xfe")
+        for lStart in range(0, len(bComment), 255):
+            bChunk = bComment[lStart:lStart + 255]
+            fOut.write(bytes((len(bChunk),)) + bChunk)
+        fOut.write(b"\x00")
+    liRegions = difference_frames(liPalettised, liDurations, lTransparent)
+    for npaRegion, tOffset, lDuration in liRegions:
+        write_image(fOut, npaRegion, tOffset, lDuration, lTransparent, max(lTableBits, 2))
+    fOut.write(b";")
+    return len(liRegions)
+
+
+def read_comment_pil(sFileName):
+    """
+    The PIL equivalent of read_comment, kept for comparison in benchmark.
+    """
+    from PIL import Image
+    with Image.open(sFileName) as imgGif:
+        return imgGif.info.get("comment")
+
+
+def describe_gif_file_pil(sFileName):
+    """
+    The PIL equivalent of describe_gif_file, kept for comparison in benchmark. Counting frames makes PIL seek
+    through every frame.
+    """
+    from PIL import Image
+    with Image.open(sFileName) as imgGif:
+        return imgGif.info.get("comment"), getattr(imgGif, "n_frames", 1), imgGif.size
+
+
+def benchmark(sFolder=None, lRepeats=20):
+    """
+    Time the block reader against PIL on every gif in a folder, checking they agree. Both reading just the comment
+    (read_comment) and reading comment, frame count and dimensions (describe_gif_file) are timed.
+    :param sFolder: String. Folder of gifs. Defaults to junkdrawer.sSavedAnimationsFolder.
+    :param lRepeats: Integer. Number of reads of each file per method.
+    :return: List. One dictionary per gif with its size and the mean seconds per read of each method.
+    """
+    sFolder = sFolder or junkdrawer.sSavedAnimationsFolder
+    liOut = []
+    for sBaseName in sorted(os.listdir(sFolder)):
+        if not sBaseName.lower().endswith('.gif'):
+            continue
+        sFileName = os.path.join(sFolder, sBaseName)
+        if read_comment(sFileName) != read_comment_pil(sFileName):
+            raise AssertionError("Comment mismatch for " + sBaseName)
+        if describe_gif_file(sFileName) != describe_gif_file_pil(sFileName):
+            raise AssertionError("Description mismatch for " + sBaseName)
+        liOut.append({"file": sBaseName,
+                      "bytes": os.path.getsize(sFileName),
+                      "comment_blocks_seconds": timeit.timeit(lambda: read_comment(sFileName),
+                                                              number=lRepeats) / lRepeats,
+                      "comment_pil_seconds": timeit.timeit(lambda: read_comment_pil(sFileName),
+                                                           number=lRepeats) / lRepeats,
+                      "describe_blocks_seconds": timeit.timeit(lambda: describe_gif_file(sFileName),
+                                                               number=lRepeats) / lRepeats,
+                      "describe_pil_seconds": timeit.timeit(lambda: describe_gif_file_pil(sFileName),
+                                                            number=lRepeats) / lRepeats})
+    return liOut
+
+
+def main():
+    sFolder = sys.argv[1] if len(sys.argv) > 1 else None
+    for dctResult in benchmark(sFolder):
+        print("{file}: {bytes} bytes".format(**dctResult))
+        for sTask in ("comment", "describe"):
+            fBlocks = dctResult[sTask + "_blocks_seconds"]
+            fPil = dctResult[sTask + "_pil_seconds"]
+            print("    {}: block reader {:.6f}s, PIL {:.6f}s ({:.1f}x)".format(sTask, fBlocks, fPil, fPil / fBlocks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,577 @@
+import collections as col
+import multiprocessing
+import contextlib
+import threading
+import cProfile
+import queue
+import shutil
+import signal
+import time
+import uuid
+import sys
+import os
+import re
+from functools import partial
+
+import junkdrawer
+import metrics
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class QueueWriter:
+    """
+    File-like object which forwards everything written to it onto a multiprocessing queue as
+    (sJobId, "log", text) events.
+    Used as sys.stdout inside render workers so their tqdm progress bars still reach the web app's console logs.
+    """
+    def __init__(self, qEvents):
+        self.qEvents = qEvents
+        self.sJobId = None
+
+    def write(self, sText):
+        if sText:
+            self.qEvents.put((self.sJobId, "log", sText))
+        return len(sText)
+
+    def flush(self):
+        pass
+
+
+def check_cancelled(evtCancel):
+    """
+    Cancellation checkpoint handed to the renderer as its fncCheckpoint.
+    :param evtCancel: multiprocessing.Event. Set by the supervisor when the job should stop.
+    """
+    if evtCancel.is_set():
+        raise junkdrawer.RenderCancelled()
+
+
+def preview_path(sWorkDir, lGeneration):
+    """
+    :return: String. Path of a job's preview of one generation, inside the job's work directory.
+    """
+    return os.path.join(sWorkDir, "preview_{}.png".format(lGeneration))
+
+
+def publish_preview(sJobId, sWorkDir, qEvents, lGeneration, imgFrame):
+    """
+    Preview hook handed to the renderer as its fncPreview. Writes the generation's frame as a png next to the partial
+    animation and reports it as (sJobId, "preview", generation number), so the loading page can show each generation
+    while later ones are still rendering. Previews go when the job's work directory does.
+    """
+    sPath = preview_path(sWorkDir, lGeneration)
+    # Fastest compression: previews are looked at once and thrown away, so the render shouldn't wait on them
+    imgFrame.save(sPath + ".tmp", format='PNG', compress_level=1)
+    os.replace(sPath + ".tmp", sPath)
+    qEvents.put((sJobId, "preview", lGeneration))
+
+
+def get_rss(lPid):
+    """
+    Resident set size of a process in bytes, or None if it can't be determined on this platform.
+    :param lPid: Integer. Process id.
+    """
+    try:
+        with open('/proc/{}/statm'.format(lPid), 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if psutil is not None:
+        try:
+            return psutil.Process(lPid).memory_info().rss
+        except psutil.Error:
+            pass
+    return None
+
+
+def warm_worker():
+    """
+    Pay the one-off costs of rendering before the first job arrives: import the plotting backends, draw and encode a
+    throwaway frame (loading fonts and the Agg renderer), compile the predecessors of the shipped rule sets into
+    the re module's cache and load the compiled rewrite and interpretation kernels.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from PIL import Image
+    import io
+    import renderer
+    import rulesandinstructions
+    import kernels
+
+    for liRules in (rulesandinstructions.liKochCurveRules, rulesandinstructions.liPlant1Rules,
+                    rulesandinstructions.LiPlant2Rules, rulesandinstructions.liTreeRules):
+        for dctRule in liRules:
+            re.compile(dctRule["predecessor"])
+    objFig, objAx = plt.subplots(figsize=(1, 1))
+    objAx.text(0, 0, "warm")
+    objFig.canvas.draw()
+    imgWarm = Image.frombuffer('RGBA', objFig.canvas.get_width_height(), objFig.canvas.buffer_rgba(), 'raw', 'RGBA',
+                               0, 1)
+    imgWarm.convert('RGB').quantize().save(io.BytesIO(), format='GIF')
+    plt.close(objFig)
+    with open(os.devnull, 'w') as fNull, contextlib.redirect_stdout(fNull):
+        kernels.warm()
+    return renderer
+
+
+def run_render_job(sJobId, dctMakerKey, sWorkDir, evtCancel, qEvents, sProfileFile=None):
+    """
+    Render one job inside a worker. Reports each generation's frame as it is drawn (see publish_preview) and its
+    metrics.RenderMetrics as (sJobId, "metrics", dictionary), then
+    finishes with one of (sJobId, "done", filename), (sJobId, "cancelled", None) or (sJobId, "failed", description).
+    If sProfileFile is given, the render runs under cProfile and its stats are dumped there.
+    """
+    import renderer
+    objMetrics = metrics.RenderMetrics()
+    objProfile = cProfile.Profile() if sProfileFile else None
+    try:
+        if objProfile is not None:
+            objProfile.enable()
+        sFileName = renderer.render_animation(**dctMakerKey,
+                                              fncCheckpoint=partial(check_cancelled, evtCancel),
+                                              sWorkDir=sWorkDir,
+                                              objMetrics=objMetrics,
+                                              fncPreview=partial(publish_preview, sJobId, sWorkDir, qEvents))
+    except junkdrawer.RenderCancelled:
+        sKind, objPayload = "cancelled", None
+    except Exception as e:
+        sKind, objPayload = "failed", "{}: {}".format(type(e).__name__, e)
+    else:
+        sKind, objPayload = "done", sFileName
+    finally:
+        if objProfile is not None:
+            objProfile.disable()
+            os.makedirs(os.path.dirname(sProfileFile), exist_ok=True)
+            objProfile.dump_stats(sProfileFile)
+    objMetrics.measure_peak_rss()
+    qEvents.put((sJobId, "metrics", objMetrics.as_dict()))
+    qEvents.put((sJobId, sKind, objPayload))
+
+
+def worker_main(qTasks, qEvents, evtCancel):
+    """
+    Target function of a render worker process. Warms up, announces itself with (None, "ready", pid), then runs
+    the jobs it is handed one at a time until it receives None, or its parent dies without sending one (e.g. a
+    render node that was killed).
+    """
+    lParentPid = os.getppid()
+    # terminate() has to work even if the parent (e.g. jobtable's render node) installed its own SIGTERM handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    objWriter = QueueWriter(qEvents)
+    sys.stdout = objWriter
+    sys.stderr = objWriter
+    warm_worker()
+    qEvents.put((None, "ready", os.getpid()))
+    while True:
+        try:
+            tTask = qTasks.get(timeout=1.)
+        except queue.Empty:
+            if os.getppid() != lParentPid:
+                return
+            continue
+        if tTask is None:
+            return
+        sJobId, dctMakerKey, sWorkDir, sProfileFile = tTask
+        objWriter.sJobId = sJobId
+        run_render_job(sJobId, dctMakerKey, sWorkDir, evtCancel, qEvents, sProfileFile)
+        objWriter.sJobId = None
+
+
+class RenderJob:
+    """
+    Book-keeping for a single render.
+    """
+    def __init__(self, sJobId, dctMakerKey, fTimeout, lMaxRss, sBlueprintId=None, sWorkDir=None):
+        self.sJobId = sJobId
+        self.dctMakerKey = dctMakerKey
+        self.sBlueprintId = sBlueprintId
+        self.fTimeout = fTimeout
+        self.lMaxRss = lMaxRss
+        self.sWorkDir = sWorkDir or os.path.join(junkdrawer.sPartialAnimationsFolder, sJobId)
+        self.sStatus = "queued"
+        self.sResult = None
+        self.sError = None
+        self.dctMetrics = None
+        self.lPreview = None
+        self.sProfileFile = None
+        self.lPeakRss = 0
+        self.fQueued = time.time()
+        self.fStarted = None
+        self.fFinished = None
+        self.fCancelRequested = None
+        self.objWorker = None
+        self.evtFinished = threading.Event()
+
+    def is_finished(self):
+        return self.evtFinished.is_set()
+
+    def as_dict(self):
+        return {"id": self.sJobId,
+                "blueprint": self.sBlueprintId,
+                "status": self.sStatus,
+                "result": self.sResult,
+                "error": self.sError,
+                "peak_rss": self.lPeakRss,
+                "queued": self.fQueued,
+                "started": self.fStarted,
+                "finished": self.fFinished,
+                "metrics": self.dctMetrics,
+                "preview": self.lPreview,
+                "profile": self.sProfileFile
+                }
+
+
+class RenderWorker:
+    """
+    A long-lived render process. It loads and warms the rendering backends once, then takes jobs one at a time.
+    """
+    def __init__(self, objContext):
+        self.qTasks = objContext.Queue()
+        self.qEvents = objContext.Queue()
+        self.evtCancel = objContext.Event()
+        self.objProcess = objContext.Process(target=worker_main,
+                                             args=(self.qTasks, self.qEvents, self.evtCancel),
+                                             name="RenderWorker",
+                                             daemon=True)
+        self.bReady = False
+        self.objJob = None
+        self.lJobsRun = 0
+
+    def start(self):
+        self.objProcess.start()
+
+    def is_idle(self):
+        return self.bReady and self.objJob is None and self.objProcess.is_alive()
+
+    def assign(self, objJob):
+        self.evtCancel.clear()
+        self.objJob = objJob
+        self.lJobsRun += 1
+        objJob.objWorker = self
+        self.qTasks.put((objJob.sJobId, objJob.dctMakerKey, objJob.sWorkDir, objJob.sProfileFile))
+
+    def stop(self, fTimeout=5.):
+        """
+        Ask the worker to exit after its current job, terminating it if it doesn't within fTimeout.
+        """
+        if self.objProcess.is_alive():
+            self.qTasks.put(None)
+            self.objProcess.join(fTimeout)
+        self.kill()
+
+    def kill(self):
+        if self.objProcess.is_alive():
+            self.objProcess.terminate()
+        self.objProcess.join()
+        self.qTasks.close()
+        self.qEvents.close()
+
+
+class JobSupervisor:
+    """
+    Runs render jobs on a pool of pre-warmed worker processes and supervises them from a monitor thread.
+    The web process itself never imports the rendering code; only the workers do, once each, at start-up.
+    Jobs wait in a queue until a worker is free. They are stopped when cancelled, when they run past their wall-clock
+    timeout, or when their worker's resident memory exceeds the job's limit. A cancelled job first gets the chance to
+    stop at its next checkpoint; if it hasn't within fGracePeriod its worker is terminated and replaced. Whatever a
+    stopped job had partially written is removed.
+    """
+    def __init__(self, lWorkers=None, fTimeout=600., lMaxRss=2 * 1024 ** 3, fGracePeriod=5., fPollInterval=.2,
+                 fncLog=None, lMaxFinished=100, lMaxJobsPerWorker=None):
+        """
+        :param lWorkers: Integer. Number of worker processes. Defaults to the number of CPUs, up to 4.
+        :param fTimeout: Float. Default wall-clock limit in seconds for a job. None for no limit.
+        :param lMaxRss: Integer. Default resident memory limit in bytes for a job. None for no limit.
+        :param fGracePeriod: Float. Seconds a cancelled job gets to reach a checkpoint before it is terminated.
+        :param fPollInterval: Float. Seconds between monitor passes.
+        :param fncLog: Function. Receives the console output of the workers.
+        :param lMaxFinished: Integer. Number of finished jobs to keep for status queries.
+        :param lMaxJobsPerWorker: Integer. Replace a worker after this many jobs, to hand back memory matplotlib
+            holds on to. None to keep workers indefinitely.
+        """
+        self.lWorkers = lWorkers or min(os.cpu_count() or 1, 4)
+        self.fTimeout = fTimeout
+        self.lMaxRss = lMaxRss
+        self.fGracePeriod = fGracePeriod
+        self.fPollInterval = fPollInterval
+        self.fncLog = fncLog
+        self.lMaxFinished = lMaxFinished
+        self.lMaxJobsPerWorker = lMaxJobsPerWorker
+        self.dctJobs = {}
+        self.deqPending = col.deque()
+        self.liWorkers = []
+        self.objLock = threading.Lock()
+        self.objContext = multiprocessing.get_context()
+        self.thrMonitor = None
+        self.bStopping = False
+        self.liListeners = []
+        # Job ids whose status changed since listeners were last called, None standing for worker output
+        self.setChanged = set()
+
+    def start(self):
+        """
+        Fork and warm the workers ahead of the first job. Called by submit if it hasn't been already.
+        """
+        with self.objLock:
+            if self.thrMonitor is not None:
+                return
+            self.bStopping = False
+            while len(self.liWorkers) < self.lWorkers:
+                self._spawn_worker()
+            self.thrMonitor = threading.Thread(target=self._monitor, name="JobSupervisor", daemon=True)
+            self.thrMonitor.start()
+
+    def submit(self, dctMakerKey, fTimeout=None, lMaxRss=None, sBlueprintId=None, bProfile=False, sJobId=None,
+               sWorkDir=None):
+        """
+        Queue a makerkey for rendering.
+        :param dctMakerKey: Dictionary. Keyword arguments for renderer.render_animation.
+        :param fTimeout: Float. Overrides the supervisor's default timeout for this job.
+        :param lMaxRss: Integer. Overrides the supervisor's default memory limit for this job.
+        :param sBlueprintId: String. Id of the blueprint the makerkey came from, reported in the job's status.
+        :param bProfile: Boolean. Run the render under cProfile, dumping its stats in junkdrawer.sProfilesFolder.
+        :param sJobId: String. Id for the job, e.g. its id in a jobtable.JobTable. Defaults to a fresh one.
+        :param sWorkDir: String. Folder for the job's partial animation and previews, removed when it finishes.
+            Defaults to one named after the job in junkdrawer.sPartialAnimationsFolder.
+        :return: String. Id of the new job.
+        """
+        self.start()
+        objJob = RenderJob(sJobId or uuid.uuid4().hex,
+                           dctMakerKey,
+                           self.fTimeout if fTimeout is None else fTimeout,
+                           self.lMaxRss if lMaxRss is None else lMaxRss,
+                           sBlueprintId,
+                           sWorkDir)
+        if bProfile:
+            objJob.sProfileFile = os.path.join(junkdrawer.sProfilesFolder, objJob.sJobId + '.prof')
+        with self.objLock:
+            self.dctJobs[objJob.sJobId] = objJob
+            self.deqPending.append(objJob)
+        return objJob.sJobId
+
+    def cancel(self, sJobId):
+        """
+        Ask a job to stop. Returns False if there is no such job or it has already finished.
+        """
+        with self.objLock:
+            objJob = self.dctJobs.get(sJobId)
+            if objJob is None or objJob.is_finished():
+                return False
+            if objJob.objWorker is None:
+                self.deqPending.remove(objJob)
+                objJob.sStatus = "cancelled"
+                self._finish(objJob)
+            else:
+                self._request_stop(objJob)
+        return True
+
+    def status(self, sJobId):
+        """
+        :return: Dictionary describing the job, or None if it is unknown.
+        """
+        objJob = self.dctJobs.get(sJobId)
+        if objJob is None:
+            return None
+        return objJob.as_dict()
+
+    def work_dir(self, sJobId):
+        """
+        :return: String. The job's work directory, which holds its partial animation and previews, or None if the
+            job is unknown.
+        """
+        objJob = self.dctJobs.get(sJobId)
+        return None if objJob is None else objJob.sWorkDir
+
+    def wait(self, sJobId, fTimeout=None):
+        """
+        Block until a job has finished.
+        :return: Dictionary describing the job, or None if it is unknown.
+        """
+        objJob = self.dctJobs.get(sJobId)
+        if objJob is None:
+            return None
+        objJob.evtFinished.wait(fTimeout)
+        return objJob.as_dict()
+
+    def add_listener(self, fncListener):
+        """
+        Have a function called whenever a job's status or preview changes, with the job's id, or with None when the
+        workers have written to the console. It is called from the monitor thread, at most once per id per pass, so
+        it should only hand the news on, e.g. to an event loop.
+        """
+        with self.objLock:
+            self.liListeners.append(fncListener)
+
+    def remove_listener(self, fncListener):
+        with self.objLock:
+            self.liListeners.remove(fncListener)
+
+    def running_count(self):
+        """
+        :return: Integer. Number of jobs that haven't finished yet, queued or running.
+        """
+        return sum(1 for objJob in list(self.dctJobs.values()) if not objJob.is_finished())
+
+    def shutdown(self):
+        """
+        Cancel all jobs, wait for them to be cleaned up and stop the workers.
+        """
+        for sJobId in list(self.dctJobs):
+            self.cancel(sJobId)
+        for objJob in list(self.dctJobs.values()):
+            objJob.evtFinished.wait()
+        with self.objLock:
+            self.bStopping = True
+            thrMonitor = self.thrMonitor
+        if thrMonitor is not None:
+            thrMonitor.join()
+        for objWorker in self.liWorkers:
+            objWorker.stop()
+        self.liWorkers = []
+        self.thrMonitor = None
+
+    def _spawn_worker(self):
+        objWorker = RenderWorker(self.objContext)
+        objWorker.start()
+        self.liWorkers.append(objWorker)
+        return objWorker
+
+    def _replace_worker(self, objWorker):
+        objWorker.kill()
+        self.liWorkers.remove(objWorker)
+        if not self.bStopping:
+            self._spawn_worker()
+
+    def _request_stop(self, objJob, sStatus="cancelled", sError=None):
+        if objJob.fCancelRequested is None:
+            objJob.fCancelRequested = time.time()
+            objJob.sStatus = sStatus
+            objJob.sError = sError
+            objJob.objWorker.evtCancel.set()
+
+    def _drain(self, objWorker):
+        """
+        Route a worker's events to its job. Returns True once the worker's current job has reported its outcome.
+        """
+        bFinished = False
+        while True:
+            try:
+                sJobId, sKind, objPayload = objWorker.qEvents.get_nowait()
+            except (queue.Empty, OSError, ValueError, EOFError):
+                return bFinished
+            objJob = objWorker.objJob
+            if sKind == "ready":
+                objWorker.bReady = True
+                continue
+            if sKind == "log":
+                if self.fncLog is not None:
+                    self.fncLog(objPayload)
+                self.setChanged.add(None)
+                continue
+            if objJob is None or objJob.sJobId != sJobId:
+                continue
+            self.setChanged.add(sJobId)
+            if sKind == "metrics":
+                objJob.dctMetrics = objPayload
+            elif sKind == "preview":
+                objJob.lPreview = objPayload
+            elif sKind == "done":
+                objJob.sResult = objPayload
+                objJob.sStatus = "done"
+                bFinished = True
+            elif sKind == "failed":
+                objJob.sError = objPayload
+                objJob.sStatus = "failed"
+                bFinished = True
+            elif sKind == "cancelled":
+                if objJob.sStatus == "running":
+                    objJob.sStatus = "cancelled"
+                bFinished = True
+
+    def _finish(self, objJob):
+        if objJob.sStatus in ("queued", "running"):
+            objJob.sStatus = "failed"
+            objJob.sError = objJob.sError or "Worker exited unexpectedly"
+        objWorker = objJob.objWorker
+        if objWorker is not None and objWorker.objJob is objJob:
+            objWorker.objJob = None
+        shutil.rmtree(objJob.sWorkDir, ignore_errors=True)
+        objJob.fFinished = time.time()
+        if objJob.dctMetrics is not None:
+            # The worker's own peak is exact where it could measure one for the job, and the monitor's samples stand
+            # in for it where it couldn't
+            objJob.lPeakRss = max(objJob.lPeakRss, objJob.dctMetrics["peak_rss"] or 0)
+            objJob.dctMetrics["peak_rss"] = objJob.lPeakRss or None
+        if objJob.sProfileFile is not None and not os.path.isfile(objJob.sProfileFile):
+            objJob.sProfileFile = None
+        metrics.registry.record_job(objJob.as_dict(), objJob.dctMetrics)
+        objJob.evtFinished.set()
+        self.setChanged.add(objJob.sJobId)
+
+    def _forget_old_jobs(self):
+        liFinished = sorted((objJob for objJob in self.dctJobs.values() if objJob.is_finished()),
+                            key=lambda objJob: objJob.fFinished)
+        for objJob in liFinished[:max(0, len(liFinished) - self.lMaxFinished)]:
+            del self.dctJobs[objJob.sJobId]
+
+    def _supervise(self, objWorker, fNow):
+        objJob = objWorker.objJob
+        if self._drain(objWorker):
+            self._finish(objJob)
+            if self.lMaxJobsPerWorker is not None and objWorker.lJobsRun >= self.lMaxJobsPerWorker:
+                self._replace_worker(objWorker)
+            return
+        if not objWorker.objProcess.is_alive():
+            if objJob is not None:
+                objJob.sError = objJob.sError or "Worker exited with code {}".format(objWorker.objProcess.exitcode)
+                self._finish(objJob)
+            self._replace_worker(objWorker)
+            return
+        if objJob is None:
+            return
+        if objJob.fCancelRequested is not None:
+            if fNow - objJob.fCancelRequested > self.fGracePeriod:
+                self._replace_worker(objWorker)
+                self._finish(objJob)
+            return
+        if objJob.fTimeout is not None and fNow - objJob.fStarted > objJob.fTimeout:
+            self._request_stop(objJob, "timeout", "Exceeded {} seconds".format(objJob.fTimeout))
+            return
+        lRss = get_rss(objWorker.objProcess.pid)
+        if lRss is not None:
+            objJob.lPeakRss = max(objJob.lPeakRss, lRss)
+            if objJob.lMaxRss is not None and lRss > objJob.lMaxRss:
+                # A job this far over budget can't be trusted to reach a checkpoint in time
+                self._request_stop(objJob, "memory", "Exceeded {} bytes resident".format(objJob.lMaxRss))
+                self._replace_worker(objWorker)
+                self._finish(objJob)
+
+    def _monitor(self):
+        while True:
+            with self.objLock:
+                if self.bStopping:
+                    return
+                fNow = time.time()
+                for objWorker in list(self.liWorkers):
+                    self._supervise(objWorker, fNow)
+                for objWorker in self.liWorkers:
+                    if not self.deqPending:
+                        break
+                    if objWorker.is_idle():
+                        objJob = self.deqPending.popleft()
+                        objJob.sStatus = "running"
+                        objJob.fStarted = time.time()
+                        objWorker.assign(objJob)
+                        self.setChanged.add(objJob.sJobId)
+                self._forget_old_jobs()
+                setChanged, self.setChanged = self.setChanged, set()
+                liListeners = list(self.liListeners)
+            for sJobId in setChanged:
+                for fncListener in liListeners:
+                    fncListener(sJobId)
+            time.sleep(self.fPollInterval)
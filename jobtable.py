@@ -0,0 +1,414 @@
+import threading
+import argparse
+import socket
+import sqlite3
+import signal
+import json
+import time
+import uuid
+import os
+from contextlib import closing
+
+import junkdrawer
+import animationindex
+import metrics
+import jobs
+
+sJobTableFile = 'jobs.sqlite3'
+
+sSchema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id              TEXT PRIMARY KEY,
+    makerkey        TEXT,
+    blueprint       TEXT,
+    profile_wanted  INTEGER,
+    status          TEXT,
+    result          TEXT,
+    error           TEXT,
+    metrics         TEXT,
+    profile         TEXT,
+    preview         INTEGER,
+    peak_rss        INTEGER,
+    worker          TEXT,
+    attempts        INTEGER,
+    lease_expires   REAL,
+    heartbeat       REAL,
+    cancel          INTEGER,
+    reported        INTEGER,
+    queued          REAL,
+    started         REAL,
+    finished        REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, queued);
+CREATE INDEX IF NOT EXISTS jobs_reported ON jobs (reported, status);
+"""
+
+tFinishedStatuses = ("done", "failed", "cancelled", "timeout", "memory")
+
+
+def work_dir(sJobId, lAttempt):
+    """
+    :return: String. Work directory of one lease of a job on the shared storage. Each lease gets its own, so a node
+        that was only slow to renew its lease doesn't write into, or clean up, the folder the new holder renders in.
+    """
+    return os.path.join(junkdrawer.sPartialAnimationsFolder, "{}_{}".format(sJobId, lAttempt))
+
+
+class JobTable:
+    """
+    Render jobs in a sqlite table shared by the web front end and any number of render nodes, e.g. on shared storage.
+    A node claims a queued job by taking out a lease on it, and keeps the lease alive with heartbeats while it
+    renders. A job whose lease runs out (its node died, or lost the shared storage) is queued again for another
+    node, up to lMaxAttempts times. Every change is a single transaction, so nodes never claim the same job twice.
+    Network filesystems don't support sqlite's write-ahead log, so the table keeps the default rollback journal.
+    """
+    def __init__(self, sPath=None, lMaxAttempts=3):
+        """
+        :param sPath: String. Path of the sqlite file. Defaults to sJobTableFile.
+        :param lMaxAttempts: Integer. Number of leases a job gets before it is failed.
+        """
+        self.sPath = sPath or sJobTableFile
+        self.lMaxAttempts = lMaxAttempts
+        with closing(self.connect()):
+            pass
+
+    def connect(self):
+        con = sqlite3.connect(self.sPath, timeout=30, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        con.executescript(sSchema)
+        return con
+
+    def submit(self, dctMakerKey, sBlueprintId=None, bProfile=False):
+        """
+        Queue a makerkey for the render nodes.
+        :return: String. Id of the new job.
+        """
+        sJobId = uuid.uuid4().hex
+        with closing(self.connect()) as con:
+            con.execute("INSERT INTO jobs (id, makerkey, blueprint, profile_wanted, status, attempts, cancel, reported,"
+                        " queued) VALUES (?, ?, ?, ?, 'queued', 0, 0, 0, ?)",
+                        (sJobId, json.dumps(dctMakerKey, cls=junkdrawer.JeffSONEncoder), sBlueprintId, int(bProfile),
+                         time.time()))
+        return sJobId
+
+    def claim(self, sWorker, fLease):
+        """
+        Lease the oldest job that is queued, or whose last lease ran out.
+        :param sWorker: String. Name of the claiming node.
+        :param fLease: Float. Seconds the lease lasts without a heartbeat.
+        :return: Tuple. (job id, makerkey dictionary, blueprint id, whether to profile, number of the lease), or None
+            if nothing is waiting.
+        """
+        fNow = time.time()
+        with closing(self.connect()) as con:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute("UPDATE jobs SET status = 'failed', finished = ?, "
+                            "error = 'Lease expired ' || attempts || ' times' "
+                            "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                            (fNow, fNow, self.lMaxAttempts))
+                rowJob = con.execute("SELECT id, makerkey, blueprint, profile_wanted, attempts FROM jobs "
+                                     "WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                                     "ORDER BY queued LIMIT 1", (fNow,)).fetchone()
+                if rowJob is not None:
+                    con.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                                "lease_expires = ?, heartbeat = ?, started = ?, preview = NULL WHERE id = ?",
+                                (sWorker, fNow + fLease, fNow, fNow, rowJob["id"]))
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+        if rowJob is None:
+            return None
+        return (rowJob["id"], json.loads(rowJob["makerkey"], cls=junkdrawer.JeffSONDecoder), rowJob["blueprint"],
+                bool(rowJob["profile_wanted"]), rowJob["attempts"] + 1)
+
+    def heartbeat(self, sJobId, sWorker, fLease, lPreview=None):
+        """
+        Extend a node's lease on a running job.
+        :param lPreview: Integer. Latest generation the node has a preview of.
+        :return: String. "ok", "cancel" if the front end has asked for the job to stop, or "lost" if the lease has
+            passed to another node or the job is no longer running.
+        """
+        fNow = time.time()
+        with closing(self.connect()) as con:
+            objCursor = con.execute("UPDATE jobs SET lease_expires = ?, heartbeat = ?, preview = ? "
+                                    "WHERE id = ? AND worker = ? AND status = 'running'",
+                                    (fNow + fLease, fNow, lPreview, sJobId, sWorker))
+            if objCursor.rowcount == 0:
+                return "lost"
+            rowJob = con.execute("SELECT cancel FROM jobs WHERE id = ?", (sJobId,)).fetchone()
+        return "cancel" if rowJob["cancel"] else "ok"
+
+    def complete(self, sJobId, sWorker, dctStatus):
+        """
+        Record how a job ended, if the node still holds its lease.
+        :param dctStatus: Dictionary. jobs.RenderJob.as_dict of the node's local job.
+        :return: Boolean. False if the lease had passed to another node, whose outcome counts instead.
+        """
+        with closing(self.connect()) as con:
+            objCursor = con.execute("UPDATE jobs SET status = ?, result = ?, error = ?, metrics = ?, profile = ?, "
+                                    "preview = ?, peak_rss = ?, finished = ? "
+                                    "WHERE id = ? AND worker = ? AND status = 'running'",
+                                    (dctStatus["status"], dctStatus["result"], dctStatus["error"],
+                                     json.dumps(dctStatus["metrics"]), dctStatus["profile"], dctStatus["preview"],
+                                     dctStatus["peak_rss"], time.time(), sJobId, sWorker))
+            return objCursor.rowcount == 1
+
+    def cancel(self, sJobId):
+        """
+        Cancel a queued job outright, or ask the node running it to stop at its next heartbeat.
+        :return: Boolean. False if there is no such job or it has already finished.
+        """
+        with closing(self.connect()) as con:
+            objCursor = con.execute("UPDATE jobs SET status = 'cancelled', finished = ? "
+                                    "WHERE id = ? AND status = 'queued'", (time.time(), sJobId))
+            if objCursor.rowcount == 0:
+                objCursor = con.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND status = 'running'", (sJobId,))
+            return objCursor.rowcount == 1
+
+    def status(self, sJobId):
+        """
+        :return: Dictionary describing the job, shaped like jobs.RenderJob.as_dict plus the node running it and the
+            number of leases it has had, or None if it is unknown.
+        """
+        with closing(self.connect()) as con:
+            rowJob = con.execute("SELECT * FROM jobs WHERE id = ?", (sJobId,)).fetchone()
+        return None if rowJob is None else row_status(rowJob)
+
+    def unfinished_count(self):
+        """
+        :return: Integer. Number of jobs queued or running, on any node.
+        """
+        with closing(self.connect()) as con:
+            return con.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def take_unreported(self):
+        """
+        Finished jobs the front end hasn't reported yet. Each is handed out once, even to several front ends.
+        :return: List. Status dictionaries, as from status.
+        """
+        with closing(self.connect()) as con:
+            liRows = con.execute("SELECT * FROM jobs WHERE reported = 0 AND status IN ({})"
+                                 .format(", ".join("?" * len(tFinishedStatuses))), tFinishedStatuses).fetchall()
+            liOut = []
+            for rowJob in liRows:
+                if con.execute("UPDATE jobs SET reported = 1 WHERE id = ? AND reported = 0",
+                               (rowJob["id"],)).rowcount == 1:
+                    liOut.append(row_status(rowJob))
+        return liOut
+
+    def counts(self):
+        """
+        :return: Dictionary. Number of jobs in each status.
+        """
+        with closing(self.connect()) as con:
+            return {row["status"]: row["n"]
+                    for row in con.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+
+
+def row_status(rowJob):
+    return {"id": rowJob["id"],
+            "blueprint": rowJob["blueprint"],
+            "status": rowJob["status"],
+            "result": rowJob["result"],
+            "error": rowJob["error"],
+            "peak_rss": rowJob["peak_rss"] or 0,
+            "queued": rowJob["queued"],
+            "started": rowJob["started"],
+            "finished": rowJob["finished"],
+            "metrics": json.loads(rowJob["metrics"]) if rowJob["metrics"] else None,
+            "profile": rowJob["profile"],
+            "preview": rowJob["preview"],
+            "worker": rowJob["worker"],
+            "attempts": rowJob["attempts"]
+            }
+
+
+class TableSupervisor:
+    """
+    Stands in for jobs.JobSupervisor in a web front end whose renders run on render nodes (see RenderNode): jobs go
+    into the shared JobTable instead of to local workers. A reporter thread picks up the jobs the nodes finish, adds
+    their animations to this front end's index and records them in metrics.registry.
+    The nodes write animations, thumbnails and previews under static/, which they share with the front end.
+    """
+    def __init__(self, sPath=None, fPollInterval=1.):
+        """
+        :param sPath: String. Path of the job table's sqlite file.
+        :param fPollInterval: Float. Seconds between checks for finished jobs.
+        """
+        self.objTable = JobTable(sPath)
+        self.fPollInterval = fPollInterval
+        self.evtStop = threading.Event()
+        self.thrReporter = None
+
+    def start(self):
+        if self.thrReporter is not None:
+            return
+        self.evtStop.clear()
+        self.thrReporter = threading.Thread(target=self._report, name="JobTableReporter", daemon=True)
+        self.thrReporter.start()
+
+    def submit(self, dctMakerKey, fTimeout=None, lMaxRss=None, sBlueprintId=None, bProfile=False):
+        """
+        Queue a makerkey for the render nodes. Time and memory limits are those of the node that runs it.
+        :return: String. Id of the new job.
+        """
+        self.start()
+        return self.objTable.submit(dctMakerKey, sBlueprintId, bProfile)
+
+    def cancel(self, sJobId):
+        return self.objTable.cancel(sJobId)
+
+    def status(self, sJobId):
+        return self.objTable.status(sJobId)
+
+    def work_dir(self, sJobId):
+        """
+        :return: String. The work directory of the job's current lease on the shared storage, or None if the job is
+            unknown or has never been claimed.
+        """
+        dctStatus = self.objTable.status(sJobId)
+        if dctStatus is None or not dctStatus["attempts"]:
+            return None
+        return work_dir(sJobId, dctStatus["attempts"])
+
+    def running_count(self):
+        return self.objTable.unfinished_count()
+
+    def shutdown(self):
+        """
+        Stop reporting. Jobs carry on on the nodes, and are reported by whichever front end runs next.
+        """
+        self.evtStop.set()
+        if self.thrReporter is not None:
+            self.thrReporter.join()
+        self.thrReporter = None
+
+    def report_finished(self):
+        """
+        Index the animations of newly finished jobs and add them to the metrics.
+        :return: Integer. Number of jobs reported.
+        """
+        liFinished = self.objTable.take_unreported()
+        for dctStatus in liFinished:
+            if dctStatus["status"] == "done" and os.path.isfile(dctStatus["result"]):
+                try:
+                    animationindex.add_animation(dctStatus["result"])
+                    if dctStatus["metrics"]:
+                        animationindex.add_metrics(os.path.basename(dctStatus["result"]),
+                                                   json.dumps(dctStatus["metrics"]))
+                except (OSError, SyntaxError, ValueError) as e:
+                    print("Couldn't index {}: {}".format(dctStatus["result"], e))
+            metrics.registry.record_job(dctStatus, dctStatus["metrics"])
+        return len(liFinished)
+
+    def _report(self):
+        while not self.evtStop.wait(self.fPollInterval):
+            try:
+                self.report_finished()
+            except sqlite3.Error as e:
+                print("Job table unavailable: {}".format(e))
+
+
+class RenderNode:
+    """
+    A render box: claims jobs from the shared JobTable whenever one of its local workers is free, and runs them on a
+    jobs.JobSupervisor, which enforces the time and memory limits and cleans up after cancelled jobs. While a job
+    runs its lease is renewed every fHeartbeat seconds; a cancel from the front end, or losing the lease, stops it.
+    Each node renders into the shared static/ folder, so throughput scales with the number of nodes.
+    """
+    def __init__(self, sPath=None, sName=None, lWorkers=None, fLease=30., fHeartbeat=5., fPollInterval=1.,
+                 **dctSupervisorArgs):
+        """
+        :param sPath: String. Path of the job table's sqlite file.
+        :param sName: String. Name of the node in the job table. Defaults to host name and process id.
+        :param lWorkers: Integer. Local render processes, and so the number of jobs claimed at once.
+        :param fLease: Float. Seconds without a heartbeat after which another node may take a job over.
+        :param fHeartbeat: Float. Seconds between heartbeats; well under fLease.
+        :param fPollInterval: Float. Seconds between looks for new jobs while idle.
+        :param dctSupervisorArgs: Passed on to jobs.JobSupervisor, e.g. fTimeout or lMaxRss.
+        """
+        self.objTable = JobTable(sPath)
+        self.sName = sName or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.fLease = fLease
+        self.fHeartbeat = fHeartbeat
+        self.fPollInterval = fPollInterval
+        self.objSupervisor = jobs.JobSupervisor(lWorkers, **dctSupervisorArgs)
+        self.dctRunning = {}
+        self.evtStop = threading.Event()
+
+    def step(self, fNow):
+        """
+        One pass of the node: hand back finished jobs, renew leases that are due and claim jobs for idle workers.
+        :return: Integer. Number of jobs claimed.
+        """
+        for sJobId, fLastBeat in list(self.dctRunning.items()):
+            dctStatus = self.objSupervisor.status(sJobId)
+            if dctStatus["finished"] is not None:
+                self.objSupervisor.wait(sJobId)
+                self.objTable.complete(sJobId, self.sName, self.objSupervisor.status(sJobId))
+                del self.dctRunning[sJobId]
+            elif fNow - fLastBeat >= self.fHeartbeat:
+                sBeat = self.objTable.heartbeat(sJobId, self.sName, self.fLease, dctStatus["preview"])
+                self.dctRunning[sJobId] = fNow
+                if sBeat != "ok":
+                    self.objSupervisor.cancel(sJobId)
+        lClaimed = 0
+        while len(self.dctRunning) < self.objSupervisor.lWorkers:
+            tJob = self.objTable.claim(self.sName, self.fLease)
+            if tJob is None:
+                break
+            sJobId, dctMakerKey, sBlueprintId, bProfile, lAttempt = tJob
+            self.objSupervisor.submit(dctMakerKey, sBlueprintId=sBlueprintId, bProfile=bProfile, sJobId=sJobId,
+                                      sWorkDir=work_dir(sJobId, lAttempt))
+            self.dctRunning[sJobId] = fNow
+            lClaimed += 1
+        return lClaimed
+
+    def run(self):
+        """
+        Claim and render jobs until stop is called. Jobs still running then are cancelled, and their leases left to
+        run out so another node picks them up.
+        """
+        self.objSupervisor.start()
+        try:
+            while not self.evtStop.is_set():
+                try:
+                    self.step(time.time())
+                except sqlite3.Error as e:
+                    # Shared storage hiccup; leases are long enough to ride it out
+                    print("Job table unavailable: {}".format(e))
+                self.evtStop.wait(self.fPollInterval)
+        finally:
+            self.objSupervisor.shutdown()
+
+    def stop(self):
+        self.evtStop.set()
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Render nodes sharing a job table with the web front end.")
+    objParser.add_argument("command", choices=["work", "status"],
+                           help="work: render jobs from the table until interrupted; status: count jobs by status")
+    objParser.add_argument("--table", default=sJobTableFile, help="sqlite file of the job table, on shared storage")
+    objParser.add_argument("--workers", type=int, help="local render processes (default: CPUs, up to 4)")
+    objParser.add_argument("--name", help="name of this node (default: host:pid)")
+    objParser.add_argument("--lease", type=float, default=30., help="seconds a job's lease lasts without a heartbeat")
+    objArgs = objParser.parse_args()
+    if objArgs.command == "status":
+        for sStatus, lCount in sorted(JobTable(objArgs.table).counts().items()):
+            print("{}: {}".format(sStatus, lCount))
+        return
+    objNode = RenderNode(objArgs.table, objArgs.name, objArgs.workers, objArgs.lease, min(5., objArgs.lease / 4),
+                         fncLog=print)
+    signal.signal(signal.SIGTERM, lambda lSignal, objFrame: objNode.stop())
+    print("Node {} rendering jobs from {}".format(objNode.sName, objNode.objTable.sPath))
+    try:
+        objNode.run()
+    except KeyboardInterrupt:
+        objNode.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,23 @@
 import numpy as np
 import json
+import os
+
+
+sSavedAnimationsFolder = os.path.join('static', 'Saved_Animations')
+sPartialAnimationsFolder = os.path.join('static', 'Partial_Animations')
+sThumbnailsFolder = os.path.join('static', 'Thumbnails')
+sDeepZoomFolder = os.path.join('static', 'Deep_Zoom')
+sProfilesFolder = 'profiles'
+sGenerationCacheFolder = 'generation_cache'
+sCheckpointsFolder = 'checkpoints'
+sKernelCacheFolder = 'kernel_cache'
+
+
+class RenderCancelled(Exception):
+    """
+    Raised from a cancellation checkpoint to stop a render job cooperatively.
+    """
+    pass
 
 
 def jeffson_numpy_ndarray_handler(obj, bEncoding):
@@ -49,6 +67,52 @@ class JeffSONDecoder(json.JSONDecoder):
         return obj
 
 
+def publish_file(sSource, sFolder, sBaseName):
+    """
+    Move a finished file into sFolder under a name nobody else is using. The name is claimed by hard linking the
+    file to it, which fails rather than overwrites if the name is taken, so the file appears whole under its name or
+    not at all: nothing is left behind in sFolder if the process dies first. Renders finishing within the same
+    second, or uploads with the same name, get _1, _2, ... appended instead of overwriting each other.
+    :param sSource: String. The finished file, on the same filesystem as sFolder. Gone once published.
+    :param sFolder: String. Folder, ending in a separator.
+    :param sBaseName: String. Preferred file name.
+    :return: String. sFolder joined with the claimed name.
+    """
+    sStem, sExtension = sBaseName.rsplit('.', 1)
+    lAttempt = 0
+    while True:
+        sCandidate = sFolder + (sBaseName if lAttempt == 0 else "{}_{}.{}".format(sStem, lAttempt, sExtension))
+        try:
+            os.link(sSource, sCandidate)
+            break
+        except FileExistsError:
+            lAttempt += 1
+    os.remove(sSource)
+    return sCandidate
+
+
+def list_pyramids():
+    """
+    :return: List. Descriptions (pyramid.json) of the finished pyramids, newest first.
+    """
+    liOut = []
+    if not os.path.isdir(sDeepZoomFolder):
+        return liOut
+    for objEntry in os.scandir(sDeepZoomFolder):
+        sDescription = os.path.join(objEntry.path, "pyramid.json")
+        if objEntry.is_dir() and os.path.isfile(sDescription):
+            with open(sDescription, 'r') as f:
+                liOut.append((os.path.getmtime(sDescription), json.load(f)))
+    return [dctPyramid for _fTime, dctPyramid in sorted(liOut, key=lambda tItem: tItem[0], reverse=True)]
+
+
+def pyramid_name(sFileName):
+    """
+    :return: String. Name of the pyramid of a saved animation: its file name without the extension.
+    """
+    return os.path.basename(sFileName).rsplit('.', 1)[0]
+
+
 def generator_looper(fncGeneratorPartial, lMaxLoops=None):
     """
     Loop a generator lMaxLoops number of times.  By default, will loop the generator indefinitely.
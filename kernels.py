@@ -0,0 +1,394 @@
+import collections as col
+import argparse
+import sys
+import os
+import re
+
+import numpy as np
+from tqdm import tqdm
+
+import junkdrawer
+import lindenmayer
+import stringparser
+import rulesandinstructions
+
+# Numba writes compiled kernels here and render workers load them back, rather than compiling on startup.
+# It reads the setting once, on import.
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.abspath(junkdrawer.sKernelCacheFolder))
+try:
+    import numba
+except ImportError:
+    numba = None
+
+lTextChunk = 1 << 20
+lSegmentChunk = 1 << 16
+
+# A backend rewrites and interprets generations. Each provides:
+# fncLindenate: as lindenmayer.lindenate, whose output it must match exactly.
+# fncSegmentBlocks: (bufText, dctInstructions, lDimensions, npaPos, npaFac) -> iterable of (n, 2, lDimensions)
+#   arrays, the segments stringparser.iter_segments would draw from the text, in order and in blocks.
+Backend = col.namedtuple("Backend", ("sName", "fncLindenate", "fncSegmentBlocks"))
+
+
+def jit(fncKernel):
+    """
+    Compile a kernel with numba, caching the machine code on disk. Without numba the kernel stays plain Python, which
+    is far too slow to render with but keeps it runnable for checking against the reference.
+    """
+    if numba is None:
+        return fncKernel
+    return numba.njit(cache=True, nogil=True)(fncKernel)
+
+
+def iter_text(bufText, lChunk=lTextChunk):
+    # outofcore imports this module to pick its backend, so its own iter_text is only imported when it's needed
+    import outofcore
+    return outofcore.iter_text(bufText, lChunk)
+
+
+def python_segment_blocks(bufText, dctInstructions, lDimensions, npaPos=None, npaFac=None, lChunk=lSegmentChunk):
+    """
+    stringparser.iter_segments, gathered into blocks of lChunk segments.
+    :param bufText: String or bytes-like (e.g. an mmap) of utf-8 text.
+    """
+    liBlock = []
+    for npaSegment in stringparser.iter_segments(iter_text(bufText), dctInstructions, lDimensions, npaPos, npaFac):
+        liBlock.append(npaSegment)
+        if len(liBlock) == lChunk:
+            yield np.array(liBlock, dtype=np.float64)
+            liBlock = []
+    if liBlock:
+        yield np.array(liBlock, dtype=np.float64)
+
+
+def instruction_table(dctInstructions, lDimensions):
+    """
+    Lay the instructions out as arrays indexed by opcode, for interpret_kernel. Characters map to opcodes by their
+    byte value, so a generation's utf-8 bytes can be interpreted directly; bytes of other characters map to -1.
+    :return: Tuple. (opcode of each byte value, rotation matrices, movements, draw flags, pop-push flags), or None if
+        an instruction's character isn't ASCII and so has no byte of its own.
+    """
+    npaOpcodes = np.full(256, -1, dtype=np.int64)
+    liInstructions = []
+    for sChar, dctInstruction in dctInstructions.items():
+        if len(sChar) != 1:
+            # Only single characters are ever looked up
+            continue
+        if ord(sChar) > 127:
+            return None
+        npaOpcodes[ord(sChar)] = len(liInstructions)
+        liInstructions.append(dctInstruction)
+    npaRotations = np.empty((len(liInstructions), lDimensions, lDimensions))
+    npaMovements = np.empty(len(liInstructions))
+    npaDraws = np.empty(len(liInstructions), dtype=np.bool_)
+    npaPopPush = np.empty((len(liInstructions), 8), dtype=np.bool_)
+    for i, dctInstruction in enumerate(liInstructions):
+        npaRotations[i] = dctInstruction["rotation"]
+        npaMovements[i] = dctInstruction["movement"]
+        npaDraws[i] = dctInstruction["draw"]
+        npaPopPush[i] = dctInstruction["pop-push"]
+    return npaOpcodes, npaRotations, npaMovements, npaDraws, npaPopPush
+
+
+@jit
+def interpret_kernel(npaSymbols, npaOpcodes, npaRotations, npaMovements, npaDraws, npaPopPush, npaPos, npaFac,
+                     npaPosStack, npaFacStack, npaDepths):
+    """
+    stringparser.iter_segments over a block of utf-8 bytes. The turtle's position, facing and stacks are updated in
+    place, so the next block carries on from where this one leaves off.
+    :param npaSymbols: Numpy array. uint8 bytes of the text.
+    :param npaPosStack: Numpy array. (capacity, dimensions) position stack, with room for every push in the block.
+    :param npaFacStack: Numpy array. The same for facings.
+    :param npaDepths: Numpy array. int64 depths of the two stacks.
+    :return: Numpy array. (n, 2, dimensions) segments drawn.
+    """
+    lDimensions = npaPos.shape[0]
+    lDrawn = 0
+    for i in range(npaSymbols.shape[0]):
+        lOpcode = npaOpcodes[npaSymbols[i]]
+        if lOpcode >= 0 and npaDraws[lOpcode]:
+            lDrawn += 1
+    npaOut = np.empty((lDrawn, 2, lDimensions))
+    npaTurned = np.empty(lDimensions)
+    lOut = 0
+    for i in range(npaSymbols.shape[0]):
+        lOpcode = npaOpcodes[npaSymbols[i]]
+        if lOpcode < 0:
+            continue
+        # Before moving: pop position, pop facing, push position, push facing
+        if npaPopPush[lOpcode, 0]:
+            if npaDepths[0] == 0:
+                raise IndexError("pop from an empty deque")
+            npaDepths[0] -= 1
+            npaPos[:] = npaPosStack[npaDepths[0]]
+        if npaPopPush[lOpcode, 1]:
+            if npaDepths[1] == 0:
+                raise IndexError("pop from an empty deque")
+            npaDepths[1] -= 1
+            npaFac[:] = npaFacStack[npaDepths[1]]
+        if npaPopPush[lOpcode, 2]:
+            npaPosStack[npaDepths[0]] = npaPos
+            npaDepths[0] += 1
+        if npaPopPush[lOpcode, 3]:
+            npaFacStack[npaDepths[1]] = npaFac
+            npaDepths[1] += 1
+        for j in range(lDimensions):
+            fSum = 0.
+            for k in range(lDimensions):
+                fSum += npaRotations[lOpcode, j, k] * npaFac[k]
+            npaTurned[j] = fSum
+        npaFac[:] = npaTurned
+        if npaDraws[lOpcode]:
+            npaOut[lOut, 0] = npaPos
+        for j in range(lDimensions):
+            npaPos[j] += npaMovements[lOpcode] * npaFac[j]
+        if npaDraws[lOpcode]:
+            npaOut[lOut, 1] = npaPos
+            lOut += 1
+        # After moving: the same four again
+        if npaPopPush[lOpcode, 4]:
+            if npaDepths[0] == 0:
+                raise IndexError("pop from an empty deque")
+            npaDepths[0] -= 1
+            npaPos[:] = npaPosStack[npaDepths[0]]
+        if npaPopPush[lOpcode, 5]:
+            if npaDepths[1] == 0:
+                raise IndexError("pop from an empty deque")
+            npaDepths[1] -= 1
+            npaFac[:] = npaFacStack[npaDepths[1]]
+        if npaPopPush[lOpcode, 6]:
+            npaPosStack[npaDepths[0]] = npaPos
+            npaDepths[0] += 1
+        if npaPopPush[lOpcode, 7]:
+            npaFacStack[npaDepths[1]] = npaFac
+            npaDepths[1] += 1
+    return npaOut
+
+
+def symbols(bufText):
+    """
+    :param bufText: String or bytes-like (e.g. an mmap) of utf-8 text.
+    :return: Numpy array. The text's bytes as uint8, without copying a bytes-like.
+    """
+    if isinstance(bufText, str):
+        bufText = bufText.encode('utf-8')
+    if len(bufText) == 0:
+        return np.empty(0, dtype=np.uint8)
+    return np.frombuffer(bufText, dtype=np.uint8)
+
+
+def grown_stack(npaStack, lNeeded):
+    if lNeeded <= len(npaStack):
+        return npaStack
+    npaGrown = np.empty((max(lNeeded, 2 * len(npaStack)), npaStack.shape[1]))
+    npaGrown[:len(npaStack)] = npaStack
+    return npaGrown
+
+
+def jit_segment_blocks(bufText, dctInstructions, lDimensions, npaPos=None, npaFac=None, lChunk=lTextChunk):
+    """
+    python_segment_blocks through interpret_kernel, lChunk bytes of text per block. Instructions on characters that
+    aren't ASCII are left to python_segment_blocks.
+    """
+    tTable = instruction_table(dctInstructions, lDimensions)
+    if tTable is None:
+        yield from python_segment_blocks(bufText, dctInstructions, lDimensions, npaPos, npaFac)
+        return
+    npaOpcodes, npaRotations, npaMovements, npaDraws, npaPopPush = tTable
+    # Pushes of each opcode onto the position and facing stacks, to size the stacks for a block up front
+    npaPosPushes = npaPopPush[:, 2].astype(np.int64) + npaPopPush[:, 6]
+    npaFacPushes = npaPopPush[:, 3].astype(np.int64) + npaPopPush[:, 7]
+    npaPos = np.zeros(lDimensions) if npaPos is None else np.array(npaPos, dtype=np.float64)
+    if npaFac is None:
+        npaFac = np.zeros(lDimensions)
+        npaFac[0] = 1
+    else:
+        npaFac = np.array(npaFac, dtype=np.float64)
+    npaPosStack = np.empty((0, lDimensions))
+    npaFacStack = np.empty((0, lDimensions))
+    npaDepths = np.zeros(2, dtype=np.int64)
+    npaSymbols = symbols(bufText)
+    for lStart in tqdm(range(0, len(npaSymbols), lChunk), desc="Interpreting string", file=sys.stdout):
+        npaBlock = npaSymbols[lStart:lStart + lChunk]
+        npaBlockOpcodes = npaOpcodes[npaBlock]
+        npaBlockOpcodes = npaBlockOpcodes[npaBlockOpcodes >= 0]
+        npaPosStack = grown_stack(npaPosStack, npaDepths[0] + npaPosPushes[npaBlockOpcodes].sum())
+        npaFacStack = grown_stack(npaFacStack, npaDepths[1] + npaFacPushes[npaBlockOpcodes].sum())
+        npaSegments = interpret_kernel(npaBlock, npaOpcodes, npaRotations, npaMovements, npaDraws, npaPopPush,
+                                       npaPos, npaFac, npaPosStack, npaFacStack, npaDepths)
+        if len(npaSegments):
+            yield npaSegments
+
+
+@jit
+def protection_kernel(npaProtect, npaStarts, npaEnds, npaLengths, lShield):
+    """
+    The protection left by one rule: npaProtect with each replaced match swapped for a run of lShield as long as its
+    successor.
+    :param npaProtect: Numpy array. uint8, 1 for each protected character of the text before the rule.
+    :param npaStarts: Numpy array. int64 starts of the replaced matches, in order and not overlapping.
+    :param npaEnds: Numpy array. Their ends.
+    :param npaLengths: Numpy array. Lengths of their successors.
+    :param lShield: Integer. 1 if the rule is protected, otherwise 0.
+    :return: Numpy array. uint8 protection of the text after the rule.
+    """
+    lTotal = npaProtect.shape[0]
+    for i in range(npaStarts.shape[0]):
+        lTotal += npaLengths[i] - (npaEnds[i] - npaStarts[i])
+    npaOut = np.empty(lTotal, dtype=np.uint8)
+    lIn = 0
+    lOut = 0
+    for i in range(npaStarts.shape[0]):
+        lKept = npaStarts[i] - lIn
+        npaOut[lOut:lOut + lKept] = npaProtect[lIn:npaStarts[i]]
+        lOut += lKept
+        npaOut[lOut:lOut + npaLengths[i]] = lShield
+        lOut += npaLengths[i]
+        lIn = npaEnds[i]
+    npaOut[lOut:] = npaProtect[lIn:]
+    return npaOut
+
+
+def numpy_protection(npaProtect, npaStarts, npaEnds, npaLengths, lShield):
+    """
+    protection_kernel in whole array operations: drop the replaced matches, then insert the successors' runs.
+    """
+    npaEdges = np.zeros(len(npaProtect) + 1, dtype=np.int64)
+    np.add.at(npaEdges, npaStarts, 1)
+    np.add.at(npaEdges, npaEnds, -1)
+    npaKept = npaProtect[np.cumsum(npaEdges[:-1]) == 0]
+    # Where each successor goes among the kept characters
+    npaAt = npaStarts - np.concatenate(([0], np.cumsum(npaEnds - npaStarts)[:-1]))
+    return np.insert(npaKept, np.repeat(npaAt, npaLengths), np.uint8(lShield))
+
+
+def fast_rewrite_rule(dctRule, sOut, npaProtect, fncProtection):
+    """
+    lindenmayer.rewrite_rule without rebuilding the text and its protection for every match. All matches are found
+    up front; those that only cover unprotected text are replaced and those that only cover protected text skipped,
+    exactly as rewrite_rule would, and the text is joined and its protection built once at the end.
+    A match covering both protected and unprotected text sends rewrite_rule searching the partly rewritten text
+    again, so a rule with any such match is handed to rewrite_rule whole. It is decided before any successor is
+    chosen, so random is drawn from in the same order either way.
+    :param npaProtect: Numpy array. uint8, 1 for each protected character of sOut.
+    :param fncProtection: Function. protection_kernel or numpy_protection.
+    :return: Tuple. (sOut, npaProtect) after the rule.
+    """
+    objRgx = re.compile(dctRule["predecessor"])
+    liMatches = list(objRgx.finditer(sOut))
+    if not liMatches:
+        return sOut, npaProtect
+    npaStarts = np.fromiter((objMatch.start() for objMatch in liMatches), dtype=np.int64, count=len(liMatches))
+    npaEnds = np.fromiter((objMatch.end() for objMatch in liMatches), dtype=np.int64, count=len(liMatches))
+    npaCounts = np.concatenate(([0], np.cumsum(npaProtect, dtype=np.int64)))
+    npaShielded = npaCounts[npaEnds] - npaCounts[npaStarts]
+    if np.any((npaShielded > 0) & (npaShielded < npaEnds - npaStarts)):
+        sProtect = (npaProtect + ord("0")).tobytes().decode('ascii')
+        sOut, sProtect = lindenmayer.rewrite_rule(dctRule, sOut, sProtect)
+        return sOut, np.frombuffer(sProtect.encode('ascii'), dtype=np.uint8) - ord("0")
+    npaReplaced = np.flatnonzero(npaShielded == 0)
+    liPieces = []
+    npaLengths = np.empty(len(npaReplaced), dtype=np.int64)
+    lPrevious = 0
+    for i, lMatch in enumerate(tqdm(npaReplaced, desc=dctRule["name"], file=sys.stdout)):
+        objMatch = liMatches[lMatch]
+        sSuccessor = lindenmayer.choose_successor(dctRule["successor"], objMatch)
+        liPieces.append(sOut[lPrevious:objMatch.start()])
+        liPieces.append(sSuccessor)
+        npaLengths[i] = len(sSuccessor)
+        lPrevious = objMatch.end()
+    liPieces.append(sOut[lPrevious:])
+    npaProtect = fncProtection(npaProtect, npaStarts[npaReplaced], npaEnds[npaReplaced], npaLengths,
+                               1 if dctRule["protected"] else 0)
+    return "".join(liPieces), npaProtect
+
+
+def fast_lindenate(liRules, sInput="", lIterations=1, fncProtection=numpy_protection):
+    """
+    lindenmayer.lindenate, one fast_rewrite_rule per rule. Output, and the random numbers drawn, are the same.
+    """
+    for _i in range(lIterations):
+        sOut = sInput
+        npaProtect = np.zeros(len(sInput), dtype=np.uint8)
+        for dctRule in liRules:
+            if not dctRule["enabled"]:
+                continue
+            sOut, npaProtect = fast_rewrite_rule(dctRule, sOut, npaProtect, fncProtection)
+        if sOut == sInput:
+            break
+        sInput = sOut
+    return sInput
+
+
+def numba_lindenate(liRules, sInput="", lIterations=1):
+    return fast_lindenate(liRules, sInput, lIterations, protection_kernel)
+
+
+# The reference implementations, which every other backend is checked against
+reference = Backend("python", lindenmayer.lindenate, python_segment_blocks)
+dctBackends = {
+    "python": reference,
+    "numpy": Backend("numpy", fast_lindenate, python_segment_blocks),
+}
+if numba is not None:
+    dctBackends["numba"] = Backend("numba", numba_lindenate, jit_segment_blocks)
+# The fastest backend available, unless FRACTAL_BACKEND names another
+backend = dctBackends[os.environ.get('FRACTAL_BACKEND') or ("numba" if numba is not None else "numpy")]
+
+
+def lindenate(liRules, sInput="", lIterations=1):
+    """
+    lindenmayer.lindenate on the selected backend.
+    """
+    return backend.fncLindenate(liRules, sInput, lIterations)
+
+
+def segment_blocks(bufText, dctInstructions, lDimensions, npaPos=None, npaFac=None):
+    """
+    stringparser.iter_segments on the selected backend, in blocks of segments.
+    :param bufText: String or bytes-like (e.g. an mmap) of utf-8 text.
+    :return: Iterable of (n, 2, lDimensions) arrays.
+    """
+    return backend.fncSegmentBlocks(bufText, dctInstructions, lDimensions, npaPos, npaFac)
+
+
+def string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaFac=None):
+    """
+    stringparser.string_to_collection on the selected backend.
+    :return: List. (2, lDimensions) array of each segment, or a single zero length segment for an empty drawing.
+    """
+    liOut = []
+    for npaBlock in segment_blocks(sInput, dctInstructions, lDimensions, npaPos, npaFac):
+        liOut.extend(npaBlock)
+    if not liOut:
+        liOut.append(np.zeros((lDimensions, 2)))
+    return liOut
+
+
+def warm():
+    """
+    Load the selected backend's compiled kernels (from the cache, or by compiling them the first time), so the first
+    render in a worker doesn't wait on them.
+    """
+    lindenate([{"name": "warm", "enabled": True, "protected": True, "predecessor": "F", "successor": [(1, "F+F")]}],
+              "F[F]F", 2)
+    for _npaBlock in segment_blocks("F+F[-F]F", rulesandinstructions.dct2dStdInstructions, 2, np.array([.5, 0]),
+                                    np.array([0, 1])):
+        pass
+
+
+def main():
+    objParser = argparse.ArgumentParser(description="Show the rewrite and interpretation backends, and warm them.")
+    objParser.add_argument("--warm", action="store_true", help="compile the selected backend's kernels into "
+                                                               + junkdrawer.sKernelCacheFolder)
+    objArgs = objParser.parse_args()
+    for sName in dctBackends:
+        print(("* " if dctBackends[sName] is backend else "  ") + sName)
+    if numba is None:
+        print("numba isn't installed, so the numba backend is unavailable")
+    if objArgs.warm:
+        warm()
+
+
+if __name__ == "__main__":
+    main()
@@ -58,65 +58,7 @@ def lindenate(liRules, sInput="", lIterations=1):
         if not dctRule["enabled"]:
             # ...skip it
             continue
-        # sTempProtect serves the purpose of sProtect within each rule, as a rule is never allowed to overwrite itself
-        sTempProtect = sProtect
-        objRgx = re.compile(dctRule["predecessor"])
-        liReplacements = dctRule["successor"]
-        itMatches = objRgx.finditer(sOut)
-        lOffset = 0
-        # Loop through all matches
-        for objMatch in tqdm(itMatches, desc=dctRule["name"], file=sys.stdout):
-            lStart = objMatch.span()[0] + lOffset
-            lEnd = objMatch.span()[1] + lOffset
-            sShieldCheck = sTempProtect[lStart:lEnd]
-            # Check whether the match overlaps any protected substrings
-            if "1" in sShieldCheck:
-                # If there are some zeros in here, this match could be eclipsing another match.
-                if "0" not in sShieldCheck:
-                    continue
-                # Find the next match.  This will either be the eclipsed match, or simply the next math in the iterable
-                objMatch = objRgx.search(sOut[lStart+1:])
-                # If there aren't any matches left at all in the string, we're done.
-                if objMatch is None:
-                    break
-                # Adjust lStart and lEnd to account for how we sliced the string in line 111
-                lStart += objMatch.span()[0] + 1
-                lEnd += objMatch.span()[0] + 1
-                # sPredecessor = objMatch.group(0)
-            # Choose a successor
-            fRand = random.random()
-            lChoice = -1
-            for i in range(len(liReplacements)):
-                if fRand > liReplacements[i][0]:
-                    continue
-                else:
-                    lChoice = i
-                    break
-            if lChoice == -1:
-                sSuccessor = ''
-            else:
-                # The rest of the string is used here in case there are lookahead groups that are referenced by the
-                # successor pattern (since they will not be captured in objMatch.group(0))
-                sSuccessor = liReplacements[lChoice][1]
-                # Manually swap out backreferences, checking for all notation types: \1, \g<1>, \g<name>
-                # Step backward so that \20 gets replaced by group 20, not group 2
-                for i in reversed(range(len(objMatch.groups())+1)):
-                    sSuccessor = sSuccessor.replace("\\" + str(i), objMatch.group(i))
-                    sSuccessor = sSuccessor.replace(r"\g<" + str(i) + ">", objMatch.group(i))
-                for sGroupName in objMatch.groupdict():
-                    sSuccessor = sSuccessor.replace(r"\g<" + sGroupName + ">", objMatch.group(sGroupName))
-            # Stitch things back together
-            sOut = sOut[:lStart] + sSuccessor + sOut[lEnd:]
-            # Protect the affected substring.
-            sShield = "1" * len(sSuccessor)
-            sTempProtect = sTempProtect[:lStart] + sShield + sTempProtect[lEnd:]
-            if dctRule["protected"]:
-                sProtect = sProtect[:lStart] + sShield + sProtect[lEnd:]
-            else:
-                sProtect = sProtect[:lStart] + "0"*len(sShield) + sProtect[lEnd:]
-            # The span of the remaining regex matches has already been set, so we need to accommodate for changing
-            # string lengths with the lOffset
-            lOffset += len(sSuccessor) - (lEnd - lStart)
+        sOut, sProtect = rewrite_rule(dctRule, sOut, sProtect)
     # If we're just spinning our wheels and not transforming the string...
     if sInput == sOut:
         # ...there's no need to run through future iterations.
@@ -126,21 +68,109 @@ def lindenate(liRules, sInput="", lIterations=1):
     return sOut
 
 
-def lindenator(liRules, sInput="", lIterations=1, lMaxReturns=None):
+def rewrite_rule(dctRule, sOut, sProtect):
+    """
+    Apply one enabled rule to the text, as a single step of lindenate.
+    :param dctRule: Dictionary. A rule, as described in lindenate.
+    :param sOut: String. The text so far in this iteration.
+    :param sProtect: String. "1" for each character of sOut that earlier rules protected, "0" for the rest.
+    :return: Tuple. (sOut, sProtect) after the rule.
+    """
+    # sTempProtect serves the purpose of sProtect within each rule, as a rule is never allowed to overwrite itself
+    sTempProtect = sProtect
+    objRgx = re.compile(dctRule["predecessor"])
+    liReplacements = dctRule["successor"]
+    itMatches = objRgx.finditer(sOut)
+    lOffset = 0
+    # Loop through all matches
+    for objMatch in tqdm(itMatches, desc=dctRule["name"], file=sys.stdout):
+        lStart = objMatch.span()[0] + lOffset
+        lEnd = objMatch.span()[1] + lOffset
+        sShieldCheck = sTempProtect[lStart:lEnd]
+        # Check whether the match overlaps any protected substrings
+        if "1" in sShieldCheck:
+            # If there are some zeros in here, this match could be eclipsing another match.
+            if "0" not in sShieldCheck:
+                continue
+            # Find the next match.  This will either be the eclipsed match, or simply the next math in the iterable
+            objMatch = objRgx.search(sOut[lStart+1:])
+            # If there aren't any matches left at all in the string, we're done.
+            if objMatch is None:
+                break
+            # Adjust lStart and lEnd to account for how we sliced the string a few lines up
+            lStart += objMatch.span()[0] + 1
+            lEnd += objMatch.span()[0] + 1
+            # sPredecessor = objMatch.group(0)
+        sSuccessor = choose_successor(liReplacements, objMatch)
+        # Stitch things back together
+        sOut = sOut[:lStart] + sSuccessor + sOut[lEnd:]
+        # Protect the affected substring.
+        sShield = "1" * len(sSuccessor)
+        sTempProtect = sTempProtect[:lStart] + sShield + sTempProtect[lEnd:]
+        if dctRule["protected"]:
+            sProtect = sProtect[:lStart] + sShield + sProtect[lEnd:]
+        else:
+            sProtect = sProtect[:lStart] + "0"*len(sShield) + sProtect[lEnd:]
+        # The span of the remaining regex matches has already been set, so we need to accommodate for changing
+        # string lengths with the lOffset
+        lOffset += len(sSuccessor) - (lEnd - lStart)
+    return sOut, sProtect
+
+
+def choose_successor(liReplacements, objMatch):
+    """
+    Pick a successor for a match at random, drawing random.random() once, and fill in its backreferences.
+    :param liReplacements: List. The rule's "successor" list of (threshold, pattern) tuples.
+    :param objMatch: re.Match. The predecessor's match.
+    :return: String. The text to replace the match with.
+    """
+    # Choose a successor
+    fRand = random.random()
+    lChoice = -1
+    for i in range(len(liReplacements)):
+        if fRand > liReplacements[i][0]:
+            continue
+        else:
+            lChoice = i
+            break
+    if lChoice == -1:
+        return ''
+    # The rest of the string is used here in case there are lookahead groups that are referenced by the
+    # successor pattern (since they will not be captured in objMatch.group(0))
+    sSuccessor = liReplacements[lChoice][1]
+    # Manually swap out backreferences, checking for all notation types: \1, \g<1>, \g<name>
+    # Step backward so that \20 gets replaced by group 20, not group 2
+    for i in reversed(range(len(objMatch.groups())+1)):
+        sSuccessor = sSuccessor.replace("\\" + str(i), objMatch.group(i))
+        sSuccessor = sSuccessor.replace(r"\g<" + str(i) + ">", objMatch.group(i))
+    for sGroupName in objMatch.groupdict():
+        sSuccessor = sSuccessor.replace(r"\g<" + sGroupName + ">", objMatch.group(sGroupName))
+    return sSuccessor
+
+
+def lindenator(liRules, sInput="", lIterations=1, lMaxReturns=None, fncCheckpoint=None, fncLindenate=None):
     """returns a generator object that returns lIterations additional iteration(s) (by default, 1) of lindenate from its
         previous return. First return is simply sInput. if specified, exhausts after lMaxReturns.
+        If supplied, fncCheckpoint is called before each new generation is computed, so that a render job can be
+        cancelled between generations (fncCheckpoint raises junkdrawer.RenderCancelled to stop).
+        fncLindenate stands in for lindenate, e.g. kernels.lindenate.
     """
+    fncLindenate = fncLindenate or lindenate
     # Are infinite loops better than recursion? I think so
     # yield sInput
     # yield from lindenator(liRules, lindenate(liRules, sInput, lIterations), lIterations)
     if lMaxReturns is None:
         while True:
             yield sInput
-            sInput = lindenate(liRules, sInput, lIterations)
+            if fncCheckpoint is not None:
+                fncCheckpoint()
+            sInput = fncLindenate(liRules, sInput, lIterations)
     elif lMaxReturns > 0:
         for _i in range(lMaxReturns):
             yield sInput
-            sInput = lindenate(liRules, sInput, lIterations)
+            if fncCheckpoint is not None:
+                fncCheckpoint()
+            sInput = fncLindenate(liRules, sInput, lIterations)
 
 
 def main():
@@ -0,0 +1,37 @@
+import numpy as np
+from PIL import Image
+
+# Frames are black lines and text on white, so they are put straight onto a fixed palette rather than quantised:
+# black and white, or with anti-aliasing a short ramp of greys from black to white.
+lGreyLevels = 4
+liMonochromePalette = [0, 0, 0, 255, 255, 255]
+liGreyPalette = [lLevel * 255 // (lGreyLevels - 1) for lLevel in range(lGreyLevels) for _ in range(3)]
+
+# Palette index of every 8 bit intensity
+npaMonochromeIndices = (np.arange(256) >= 128).astype(np.uint8)
+npaGreyIndices = ((np.arange(256) * (lGreyLevels - 1) + 127) // 255).astype(np.uint8)
+
+
+def palette(bAntialias=False):
+    """
+    :param bAntialias: Boolean. The grey ramp for anti-aliased frames rather than black and white.
+    :return: List. The palette's RGB values.
+    """
+    return liGreyPalette if bAntialias else liMonochromePalette
+
+
+def palettise(bufRgba, bAntialias=False):
+    """
+    Map a rasterised frame onto its fixed palette with a lookup table, skipping colour quantisation. Only the red
+    channel is read, which for black, white and grey is as good as any.
+    :param bufRgba: Numpy array or memoryview. (height, width, 4) RGBA pixels, e.g. an Agg canvas's buffer_rgba(),
+        or (height, width) grey levels.
+    :param bAntialias: Boolean. Map to the grey ramp rather than thresholding to black and white.
+    :return: PIL Image. The frame in mode P on palette(bAntialias).
+    """
+    npaPixels = np.asarray(bufRgba)
+    npaRed = npaPixels[:, :, 0] if npaPixels.ndim == 3 else npaPixels
+    npaIndices = (npaGreyIndices if bAntialias else npaMonochromeIndices)[npaRed]
+    imgFrame = Image.frombuffer('P', (npaIndices.shape[1], npaIndices.shape[0]), npaIndices, 'raw', 'P', 0, 1)
+    imgFrame.putpalette(palette(bAntialias))
+    return imgFrame
@@ -0,0 +1,225 @@
+import collections as col
+import contextlib
+import threading
+import time
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def reset_peak_rss():
+    """
+    Start the current process's peak resident set size afresh, so get_peak_rss reports the peak since now rather than
+    the peak of the process's whole life, e.g. per render in a long-lived worker. Only Linux can do this.
+    :return: Boolean. Whether the peak was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of the current process in bytes since it started, or since reset_peak_rss was last called,
+    or None where the platform doesn't report it.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for sLine in f:
+                if sLine.startswith('VmHWM:'):
+                    return int(sLine.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is never reset
+    lMaxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return lMaxRss if sys.platform == 'darwin' else lMaxRss * 1024
+
+
+class RenderMetrics:
+    """
+    Measurements of a single render: seconds spent in each stage, the string length and segment count of every
+    generation, frames, output size and peak memory.
+    The peak memory is measured from when the metrics are made (see reset_peak_rss), and left None on platforms that
+    only know the peak of the whole process, which in a worker that has rendered before belongs to an earlier render.
+    Stage times are exclusive, so when a stage is entered inside another (e.g. rewriting happens while matplotlib is
+    saving the animation) the outer stage's clock stops until the inner one is done. The stage times therefore add up
+    to the time of the render, with no double counting.
+    """
+    def __init__(self):
+        self.dctStageSeconds = col.defaultdict(float)
+        self.liStack = []
+        self.liStringLengths = []
+        self.liSegmentCounts = []
+        self.lFrames = 0
+        self.lOutputBytes = 0
+        self.lPeakRss = None
+        self.bPeakRssReset = reset_peak_rss()
+
+    def start(self, sStage):
+        fNow = time.perf_counter()
+        if self.liStack:
+            sOuter, fOuterStart = self.liStack[-1]
+            self.dctStageSeconds[sOuter] += fNow - fOuterStart
+        self.liStack.append((sStage, fNow))
+
+    def stop(self):
+        fNow = time.perf_counter()
+        sStage, fStart = self.liStack.pop()
+        self.dctStageSeconds[sStage] += fNow - fStart
+        if self.liStack:
+            self.liStack[-1] = (self.liStack[-1][0], fNow)
+
+    def stage(self, sStage):
+        """
+        Context manager timing the enclosed block as sStage.
+        """
+        return _Stage(self, sStage)
+
+    def measure_peak_rss(self):
+        """
+        Record the peak resident memory since the metrics were made, where it can be told apart from earlier renders'.
+        """
+        if self.bPeakRssReset:
+            self.lPeakRss = get_peak_rss()
+
+    def add_generation(self, sText, liData):
+        self.liStringLengths.append(len(sText))
+        self.liSegmentCounts.append(len(liData))
+
+    def as_dict(self):
+        return {"stage_seconds": dict(self.dctStageSeconds),
+                "string_lengths": self.liStringLengths,
+                "segment_counts": self.liSegmentCounts,
+                "frames": self.lFrames,
+                "output_bytes": self.lOutputBytes,
+                "peak_rss": self.lPeakRss
+                }
+
+
+class _Stage:
+    def __init__(self, objMetrics, sStage):
+        self.objMetrics = objMetrics
+        self.sStage = sStage
+
+    def __enter__(self):
+        self.objMetrics.start(self.sStage)
+        return self
+
+    def __exit__(self, *args):
+        self.objMetrics.stop()
+        return False
+
+
+def timed(objMetrics, sStage):
+    """
+    objMetrics.stage(sStage), or a context manager doing nothing if objMetrics is None.
+    """
+    if objMetrics is None:
+        return contextlib.nullcontext()
+    return objMetrics.stage(sStage)
+
+
+class MetricsRegistry:
+    """
+    Totals over every render job seen by this process, rendered in the Prometheus text exposition format.
+    """
+    tDurationBuckets = (1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self):
+        self.objLock = threading.Lock()
+        self.dctRenders = col.Counter()
+        self.dctStageSeconds = col.Counter()
+        self.dctStageCount = col.Counter()
+        self.liDurationBuckets = [0] * len(self.tDurationBuckets)
+        self.fDurationSum = 0.
+        self.lDurationCount = 0
+        self.lFrames = 0
+        self.lSegments = 0
+        self.lStringBytes = 0
+        self.lOutputBytes = 0
+        self.lMaxPeakRss = 0
+        self.fncRunningJobs = None
+
+    def record_job(self, dctJob, dctMetrics=None):
+        """
+        Add a finished job to the totals.
+        :param dctJob: Dictionary. RenderJob.as_dict of the job.
+        :param dctMetrics: Dictionary. RenderMetrics.as_dict of its render, if it got far enough to report one.
+        """
+        with self.objLock:
+            self.dctRenders[dctJob["status"]] += 1
+            if dctJob["started"] is not None and dctJob["finished"] is not None:
+                fDuration = dctJob["finished"] - dctJob["started"]
+                self.fDurationSum += fDuration
+                self.lDurationCount += 1
+                for i, fBound in enumerate(self.tDurationBuckets):
+                    if fDuration <= fBound:
+                        self.liDurationBuckets[i] += 1
+            self.lMaxPeakRss = max(self.lMaxPeakRss, dctJob.get("peak_rss") or 0)
+            if dctMetrics:
+                for sStage, fSeconds in dctMetrics["stage_seconds"].items():
+                    self.dctStageSeconds[sStage] += fSeconds
+                    self.dctStageCount[sStage] += 1
+                self.lFrames += dctMetrics["frames"]
+                self.lSegments += sum(dctMetrics["segment_counts"])
+                self.lStringBytes += sum(dctMetrics["string_lengths"])
+                self.lOutputBytes += dctMetrics["output_bytes"]
+                self.lMaxPeakRss = max(self.lMaxPeakRss, dctMetrics["peak_rss"] or 0)
+
+    def exposition(self):
+        """
+        :return: String. All metrics in the Prometheus text format.
+        """
+        liOut = []
+
+        def metric(sName, sType, sHelp, liSamples):
+            liOut.append("# HELP {} {}".format(sName, sHelp))
+            liOut.append("# TYPE {} {}".format(sName, sType))
+            for sLabels, objValue in liSamples:
+                liOut.append("{}{} {}".format(sName, sLabels, objValue))
+
+        with self.objLock:
+            metric("lindenmayer_renders_total", "counter", "Render jobs finished, by final status.",
+                   [('{{status="{}"}}'.format(sStatus), lCount) for sStatus, lCount in sorted(self.dctRenders.items())])
+            # Each job is already counted in every bucket it fits, so the buckets are cumulative as Prometheus expects
+            liBuckets = [('_bucket{{le="{}"}}'.format(fBound), lCount)
+                         for fBound, lCount in zip(self.tDurationBuckets, self.liDurationBuckets)]
+            liBuckets.append(('_bucket{le="+Inf"}', self.lDurationCount))
+            liBuckets.append(('_sum', self.fDurationSum))
+            liBuckets.append(('_count', self.lDurationCount))
+            liOut.append("# HELP lindenmayer_render_duration_seconds Wall-clock time of render jobs.")
+            liOut.append("# TYPE lindenmayer_render_duration_seconds histogram")
+            for sSuffix, objValue in liBuckets:
+                liOut.append("lindenmayer_render_duration_seconds{} {}".format(sSuffix, objValue))
+            metric("lindenmayer_render_stage_seconds_total", "counter",
+                   "Time spent in each stage of rendering: rewrite, interpret, update, draw, encode, optimize, index.",
+                   [('{{stage="{}"}}'.format(sStage), fSeconds)
+                    for sStage, fSeconds in sorted(self.dctStageSeconds.items())])
+            metric("lindenmayer_render_stage_runs_total", "counter", "Renders that reported time in each stage.",
+                   [('{{stage="{}"}}'.format(sStage), lCount)
+                    for sStage, lCount in sorted(self.dctStageCount.items())])
+            metric("lindenmayer_render_frames_total", "counter", "Frames rendered.", [("", self.lFrames)])
+            metric("lindenmayer_render_segments_total", "counter", "Line segments interpreted.",
+                   [("", self.lSegments)])
+            metric("lindenmayer_render_string_bytes_total", "counter", "Characters of generation strings rewritten.",
+                   [("", self.lStringBytes)])
+            metric("lindenmayer_render_output_bytes_total", "counter", "Bytes of gifs written.",
+                   [("", self.lOutputBytes)])
+            metric("lindenmayer_render_peak_rss_bytes", "gauge", "Highest resident memory seen in a render.",
+                   [("", self.lMaxPeakRss)])
+            if self.fncRunningJobs is not None:
+                metric("lindenmayer_render_jobs_running", "gauge", "Render jobs currently running.",
+                       [("", self.fncRunningJobs())])
+        return "\n".join(liOut) + "\n"
+
+
+registry = MetricsRegistry()
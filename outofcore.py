@@ -0,0 +1,190 @@
+import codecs
+import random
+import os
+
+import numpy as np
+
+import kernels
+import generationcache
+import metrics
+import lineart
+
+lTextChunk = 1 << 20
+lSegmentChunk = 1 << 16
+
+
+def iter_text(bufText, lChunk=lTextChunk):
+    """
+    Characters of a generation held in a memory map, decoded lChunk bytes at a time so the whole string never has to
+    be in memory.
+    :param bufText: bytes-like (e.g. an mmap) of utf-8 text, or a string which is simply iterated.
+    """
+    if isinstance(bufText, str):
+        yield from bufText
+        return
+    objDecoder = codecs.getincrementaldecoder('utf-8')()
+    for lStart in range(0, len(bufText), lChunk):
+        yield from objDecoder.decode(bufText[lStart:lStart + lChunk])
+    yield from objDecoder.decode(b"", final=True)
+
+
+def spilled_generations(liRules, sAxiom, lSeed=None, lMaxReturns=1, sFolder=".", fncCheckpoint=None,
+                        objCache=None, tResume=None):
+    """
+    generationcache.lindenator for generations too large to keep around: each generation is written to disk as soon as
+    it is rewritten and yielded as a read-only memory map, so only the rewrite itself (previous and next generation)
+    ever needs the text in memory.
+    Reproducible generations go through the generation cache; stochastic rules without a seed are spilled to sFolder.
+    :param sFolder: String. Spill folder for generations that can't be cached, e.g. the render's work directory.
+    :param objCache: GenerationCache. Defaults to generationcache.cache.
+    :param tResume: Tuple. (generation number, memory map of its text, random state) to continue from, as
+        generationcache.lindenator takes it (see checkpoints.spill_checkpoint).
+    :return: Generator of mmaps (or b"" for empty generations).
+    """
+    objCache = objCache or generationcache.cache
+    sKey = generationcache.cache_key(liRules, sAxiom, lSeed)
+    if sKey is None:
+        objCache = generationcache.GenerationCache(os.path.join(sFolder, "generations"), lMaxBytes=float('inf'))
+        sKey = "spill"
+    bDeterministic = generationcache.is_deterministic(liRules)
+    bufPrevious, tState = None, None
+    lStart = 0
+    if tResume is not None:
+        lStart, bufPrevious, tState = tResume
+        lStart += 1
+    elif lSeed is not None:
+        random.seed(lSeed)
+    for i in range(lStart, lMaxReturns):
+        bufText = objCache.open_generation(sKey, i)
+        try:
+            if bufText is not None:
+                tState = objCache.get_state(sKey, i)
+                if tState is not None:
+                    random.setstate(tState)
+        except FileNotFoundError:
+            bufText = None
+        if bufText is None:
+            if i == 0:
+                sText = sAxiom
+            else:
+                if fncCheckpoint is not None:
+                    fncCheckpoint()
+                if tState is not None:
+                    random.setstate(tState)
+                sText = kernels.lindenate(liRules, bytes(bufPrevious).decode('utf-8'))
+            tState = None if bDeterministic else random.getstate()
+            objCache.put(sKey, i, sText, tState, bEvict=False)
+            del sText
+            bufText = objCache.open_generation(sKey, i)
+            # The map stays readable even if trimming the cache deletes its file
+            objCache.evict()
+        yield bufText
+        bufPrevious = bufText
+
+
+def spill_segments(itBlocks, sFileName):
+    """
+    Write line segments to a file a block at a time and map them back as one (N, 2, 2) array.
+    As with stringparser.string_to_collection, an empty drawing becomes a single zero length segment.
+    :param itBlocks: Iterable of (n, 2, 2) arrays, e.g. kernels.segment_blocks.
+    :param sFileName: String. File to write; the caller removes it when done with the array.
+    :return: numpy memmap. Read-only, float64, shape (N, 2, 2).
+    """
+    lTotal = 0
+    with open(sFileName, 'wb') as f:
+        for npaBlock in itBlocks:
+            f.write(np.ascontiguousarray(npaBlock, dtype=np.float64).tobytes())
+            lTotal += len(npaBlock)
+        if lTotal == 0:
+            f.write(np.zeros((1, 2, 2)).tobytes())
+            lTotal = 1
+    return np.memmap(sFileName, dtype=np.float64, mode='r', shape=(lTotal, 2, 2))
+
+
+def segment_bounds(npaSegments, lChunk=lSegmentChunk):
+    """
+    :return: Tuple. (x min, y min, x max, y max) over all points of the segments, reading lChunk segments at a time.
+    """
+    fXMin = fYMin = np.inf
+    fXMax = fYMax = -np.inf
+    for lStart in range(0, len(npaSegments), lChunk):
+        npaChunk = npaSegments[lStart:lStart + lChunk]
+        fXMin = min(fXMin, npaChunk[:, :, 0].min())
+        fYMin = min(fYMin, npaChunk[:, :, 1].min())
+        fXMax = max(fXMax, npaChunk[:, :, 0].max())
+        fYMax = max(fYMax, npaChunk[:, :, 1].max())
+    return fXMin, fYMin, fXMax, fYMax
+
+
+def frame_transform(tBounds, tAspectRatio=(1, 1)):
+    """
+    The translation and scaling renderer.scale_artists_2d applies to a frame, worked out from its bounds alone.
+    :return: Tuple. (translation to add to every point, matrix to then multiply every point by)
+    """
+    fXMin, fYMin, fXMax, fYMax = tBounds
+    fXMin, fYMin = min(fXMin, 0), min(fYMin, 0)
+    fXMax, fYMax = max(fXMax - fXMin, 1), max(fYMax - fYMin, 1)
+    fMax = max(fXMax, fYMax)
+    return np.array([-fXMin, -fYMin]), np.array([[tAspectRatio[0] / fXMax, 0], [0, tAspectRatio[1] / fMax]])
+
+
+def draw_frame(objFig, ntArtists, npaSegments, sTracker, tAspectRatio=(1, 1), lChunk=lSegmentChunk,
+               bAntialias=False):
+    """
+    Rasterise a frame onto the figure's Agg canvas lChunk segments at a time, so matplotlib only ever holds one chunk.
+    The figure is drawn once with an empty line collection, then the collection is given each chunk in turn and
+    drawn on top.
+    :param ntArtists: namedtuple. The artists of renderer.render_2d_frame_by_frame_animation.
+    :param bAntialias: Boolean. Palettise onto lineart's grey ramp rather than black and white.
+    :return: PIL Image. The frame, on lineart's fixed palette.
+    """
+    npaTranslation, npaScale = frame_transform(segment_bounds(npaSegments, lChunk), tAspectRatio)
+    ntArtists.objText.set_text(sTracker)
+    ntArtists.lcCoords.set_segments([])
+    objFig.canvas.draw()
+    objAx = ntArtists.lcCoords.axes
+    for lStart in range(0, len(npaSegments), lChunk):
+        ntArtists.lcCoords.set_segments((npaSegments[lStart:lStart + lChunk] + npaTranslation).dot(npaScale))
+        objAx.draw_artist(ntArtists.lcCoords)
+    ntArtists.lcCoords.set_segments([])
+    return lineart.palettise(objFig.canvas.buffer_rgba(), bAntialias)
+
+
+def render_frames(itGenerations, objFig, ntArtists, dctInstructions, npaStartPos=None, npaStartFac=None,
+                  tAspectRatio=(1, 1), sWorkDir=".", lChunk=lSegmentChunk, fncCheckpoint=None, objMetrics=None,
+                  fncPreview=None, bAntialias=False, lFirst=0):
+    """
+    The out-of-core counterpart of renderer.frame_iter_2d and update_artists_2d: interpret each generation straight
+    from its memory map into a memory mapped segment file, and rasterise that in chunks.
+    :param itGenerations: Iterable of generations, as memory maps (spilled_generations) or strings.
+    :param sWorkDir: String. Folder for the segment files, which are removed as soon as their frame is drawn.
+    :param fncPreview: Function. Called with (generation number, PIL Image) as each frame is drawn.
+    :param bAntialias: Boolean. See draw_frame.
+    :param lFirst: Integer. Generation number of the first generation, for renders continuing from a checkpoint.
+    :return: List. PIL Images of the frames, one per generation.
+    """
+    liFrames = []
+    sSegmentFile = os.path.join(sWorkDir, "segments.bin")
+    itGenerations = iter(itGenerations)
+    i = lFirst
+    while True:
+        if fncCheckpoint is not None:
+            fncCheckpoint()
+        with metrics.timed(objMetrics, "rewrite"):
+            bufText = next(itGenerations, None)
+        if bufText is None:
+            break
+        with metrics.timed(objMetrics, "interpret"):
+            npaSegments = spill_segments(kernels.segment_blocks(bufText, dctInstructions, 2, npaStartPos, npaStartFac),
+                                         sSegmentFile)
+        if objMetrics is not None:
+            objMetrics.add_generation(bufText, npaSegments)
+        # Drawing falls under the caller's "draw" stage, as matplotlib's drawing does in the in-memory path
+        liFrames.append(draw_frame(objFig, ntArtists, npaSegments, "Generation {}".format(i), tAspectRatio, lChunk,
+                                   bAntialias))
+        if fncPreview is not None:
+            fncPreview(i, liFrames[-1])
+        del npaSegments
+        os.remove(sSegmentFile)
+        i += 1
+    return liFrames
@@ -4,20 +4,30 @@ from matplotlib.collections import LineCollection
 from mpl_toolkits.mplot3d.art3d import Line3DCollection
 import matplotlib.animation as animation
 from functools import partial
+from itertools import islice
 # from itertools import count
 from collections import namedtuple
 from datetime import datetime
-from tqdm import tqdm
-from PIL import Image
 import json
 from pygifsicle import optimize
 import warnings
-import sys
+import os
+import shutil
+import tempfile
 
 import lindenmayer
+import generationcache
+import outofcore
+import encoders
+import checkpoints
+import lineart
 import rulesandinstructions
 import stringparser
+import kernels
 import junkdrawer
+import animationindex
+import thumbnails
+import metrics
 
 
 def render_2d_line_segments(liData, fLimScale=1.1, fLimOffset=1):
@@ -112,26 +122,48 @@ def init_fig_2d(objFig, objAx, ntArtists):
     return ntArtists
 
 
-def frame_iter_2d(itLoopedGenerator, fncInterpreter, lMod, lLastFrameHang=1):
+def frame_iter_2d(itLoopedGenerator, fncInterpreter, lMod, fncCheckpoint=None, objMetrics=None, lFirst=0):
     """
     Frames function for animation.FuncAnimation within render_2d_frame_by_frame_animation.
+    Every generation is yielded once; holding the last one is left to the frame durations of the gif.
+    fncCheckpoint, if supplied, is called before every frame so that the render can be cancelled between frames.
+    objMetrics, if supplied, records the rewrite and interpret time and the size of every generation.
+    lFirst is the generation number of the first generation, for renders continuing from a checkpoint.
     """
     i = 0
     for i in range(lMod-1):
+        if fncCheckpoint is not None:
+            fncCheckpoint()
+        with metrics.timed(objMetrics, "rewrite"):
+            sText = next(itLoopedGenerator)
+        with metrics.timed(objMetrics, "interpret"):
+            liData = fncInterpreter(sText)
+        if objMetrics is not None:
+            objMetrics.add_generation(sText, liData)
+        yield liData, "Generation {}".format(lFirst + i)
+    if fncCheckpoint is not None:
+        fncCheckpoint()
+    with metrics.timed(objMetrics, "rewrite"):
         sText = next(itLoopedGenerator)
+    with metrics.timed(objMetrics, "interpret"):
         liData = fncInterpreter(sText)
-        yield liData, "Generation {}".format(i)
-    sText = next(itLoopedGenerator)
-    liData = fncInterpreter(sText)
-    i += 1
-    for j in tqdm(range(lLastFrameHang), desc="Last Frame Repeat: ", file=sys.stdout):
-        yield liData, "Generation {}".format(i)
+    if objMetrics is not None:
+        objMetrics.add_generation(sText, liData)
+    yield liData, "Generation {}".format(lFirst + lMod - 1)
 
 
-def update_artists_2d(tFrameYield, ntArtists, tAspectRatio=(1, 1)):
+def update_artists_2d(tFrameYield, ntArtists, tAspectRatio=(1, 1), objMetrics=None):
     """
     Update function for animation.FuncAnimation within render_2d_frame_by_frame_animation.
     """
+    with metrics.timed(objMetrics, "update"):
+        scale_artists_2d(tFrameYield, ntArtists, tAspectRatio)
+
+
+def scale_artists_2d(tFrameYield, ntArtists, tAspectRatio=(1, 1)):
+    """
+    Fit a frame's line segments to the plot and hand them to the artists.
+    """
     liData, sTracker = tFrameYield
 
     lXMin = np.min(np.append(np.hstack([ra[:, 0] for ra in liData]), 0))
@@ -149,11 +181,42 @@ def update_artists_2d(tFrameYield, ntArtists, tAspectRatio=(1, 1)):
     ntArtists.lcCoords.set_segments(liData)
 
 
+class FrameWriter(animation.AbstractMovieWriter):
+    """
+    A movie writer that writes no movie: it keeps the frames matplotlib draws in liFrames, rasterised straight onto
+    lineart's fixed palette, for the renderer to encode. Each frame is also handed to fncPreview, if given, as soon
+    as it has been drawn, numbered from generation lFirst.
+    """
+    def __init__(self, bAntialias=False, fncPreview=None, lFirst=0, fps=2):
+        super().__init__(fps=fps)
+        self.bAntialias = bAntialias
+        self.fncPreview = fncPreview
+        self.lFirst = lFirst
+        self.liFrames = []
+
+    def setup(self, fig, outfile, dpi=None):
+        super().setup(fig, outfile, dpi=dpi)
+        self.liFrames = []
+
+    def grab_frame(self, **savefig_kwargs):
+        self.fig.canvas.draw()
+        self.liFrames.append(lineart.palettise(self.fig.canvas.buffer_rgba(), self.bAntialias))
+        if self.fncPreview is not None:
+            self.fncPreview(self.lFirst + len(self.liFrames) - 1, self.liFrames[-1])
+
+    def finish(self):
+        pass
+
+
 def render_2d_frame_by_frame_animation(sName, liRules, dctInstructions, sStartingString, lItPerLoop,
                                        npaStartPos=None, npaStartFac=None,
-                                       tAspectRatio=(1, 1), lLastFrameHang=1):
+                                       tAspectRatio=(1, 1), lLastFrameHang=1, lSeed=None, sFormat="gif",
+                                       bAntialias=False, fncCheckpoint=None, sWorkDir=None, objMetrics=None,
+                                       liGenerations=None, bOutOfCore=False, fncPreview=None, bCheckpoint=False,
+                                       sExtendFrom=None):
     """
-    Render a fractal as a gif, encoding as a comment the parameters used to make it (its 'makerkey').
+    Render a fractal as an animation, embedding in its metadata the parameters used to make it (its 'makerkey'); for
+    gifs that is the comment.
     :param sName: String. Name of gif. Will get appended with timestamp and file extension.
     :param liRules: List. Stochastic Lindenmayer rules for string replacement.
     :param dctInstructions: Dictionary. Instructions for interpreting characters in string as drawing directions
@@ -163,58 +226,127 @@ def render_2d_frame_by_frame_animation(sName, liRules, dctInstructions, sStartin
     :param npaStartFac: Numpy array.  The starting facing of the turtle which draws the fractal.
     :param tAspectRatio: Tuple.  The aspect ratio of the resulting plots and gif.
     :param lLastFrameHang: Integer. The number of frames to let the last frame "hang" on.
-    :return: String. File name of gif.
+    :param lSeed: Integer. Seed for the stochastic rules, making the render reproducible. None leaves random as is.
+    :param sFormat: String. Output format, a key of encoders.dctEncoders: gif, webp, apng or svg.
+    :param bAntialias: Boolean. Draw raster formats with anti-aliased lines on a small ramp of greys, rather than
+        aliased lines in black and white (see lineart). Either way no colour quantisation is needed.
+    :param fncCheckpoint: Function. Called between generations, frames and encoding steps. Raises
+        junkdrawer.RenderCancelled to abandon the render. Not part of the makerkey.
+    :param sWorkDir: String. Directory for the partially written gif. Defaults to a fresh directory inside
+        junkdrawer.sPartialAnimationsFolder. The gif is only moved into Saved_Animations once it is complete.
+    :param objMetrics: metrics.RenderMetrics. Receives stage timings and sizes. A fresh one is used if not supplied;
+        either way the measurements are stored with the render in the animation index.
+    :param liGenerations: List. The lItPerLoop generation strings, if they have already been rewritten (e.g. shared
+        between renders that only differ in their instructions). Must match liRules, sStartingString and lSeed.
+        Not part of the makerkey.
+    :param bOutOfCore: Boolean. Keep generation strings and line segments in memory mapped files and draw them in
+        chunks (see outofcore), for generations too large to fit in memory. Slower. Not part of the makerkey.
+    :param fncPreview: Function. Called with (generation number, PIL Image) as soon as each generation's frame is
+        rasterised, long before the animation is encoded. Vector formats have no frames and never call it. Not part
+        of the makerkey.
+    :param bCheckpoint: Boolean. Store the final generation and the random state to rewrite it with next to the
+        animation (see checkpoints), so that extend_2d_animation can continue it later. Raster formats only. Not
+        part of the makerkey.
+    :param sExtendFrom: String. Path of a checkpointed raster animation of the same makerkey with fewer generations.
+        Its frames are reused and rewriting resumes from its checkpoint, so only the new generations are rewritten
+        and drawn. See extend_2d_animation. Not part of the makerkey.
+    :return: String. File name of the animation.
     """
-    fncGeneratorMaker = partial(lindenmayer.lindenator,
-                                liRules,
-                                sInput=sStartingString,
-                                lMaxReturns=lItPerLoop
-                                )
-    itLoopedGenerator = lindenmayer.generator_looper(fncGeneratorMaker)
-
-    # string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaFac=None, deqPos=None, deqFac=None)
-    fncInterpreter = partial(stringparser.string_to_collection,
+    if fncCheckpoint is None:
+        def fncCheckpoint():
+            pass
+    if objMetrics is None:
+        objMetrics = metrics.RenderMetrics()
+    if sFormat not in encoders.dctEncoders:
+        raise ValueError("Unknown format {}, expected one of {}".format(sFormat, ", ".join(encoders.dctEncoders)))
+    objEncoder = encoders.dctEncoders[sFormat]
+    bDeterministic = generationcache.is_deterministic(liRules)
+    if bCheckpoint and liGenerations is not None and not bDeterministic:
+        raise ValueError("Can't checkpoint stochastic generations rewritten elsewhere: their random state is unknown")
+    # Generations (and frames) an animation being extended already has
+    lPrior, tResume, liPriorFrames = 0, None, []
+    if sExtendFrom is not None:
+        if objEncoder.bVector:
+            raise ValueError("Only raster animations can be extended, not " + sFormat)
+        sCheckpoint = checkpoints.checkpoint_path(os.path.basename(sExtendFrom))
+        lPrior = checkpoints.read_generation(sCheckpoint) + 1
+        if lPrior >= lItPerLoop:
+            raise ValueError("{} already has {} generations".format(sExtendFrom, lPrior))
+        if not bOutOfCore:
+            tResume = checkpoints.read_checkpoint(sCheckpoint)
+        liPriorFrames = generation_frames(sExtendFrom, lPrior, bAntialias)
+    if liGenerations is not None:
+        itLoopedGenerator = iter(liGenerations[lPrior:])
+    elif bOutOfCore:
+        itLoopedGenerator = None
+    else:
+        # Generations already rewritten by an earlier render of the same rules, axiom and seed come from the cache
+        fncGeneratorMaker = partial(generationcache.lindenator,
+                                    liRules,
+                                    sInput=sStartingString,
+                                    lSeed=lSeed,
+                                    lMaxReturns=lItPerLoop,
+                                    fncCheckpoint=fncCheckpoint,
+                                    tResume=tResume
+                                    )
+        # generator_looper starts a generator once to check it isn't empty, which for a resumed one would be a
+        # wasted rewrite of the first new generation; the frames only ever go through the generations once anyway
+        if tResume is not None:
+            itLoopedGenerator = fncGeneratorMaker()
+        else:
+            itLoopedGenerator = lindenmayer.generator_looper(fncGeneratorMaker)
+    objRecorder = None
+    if bCheckpoint and not objEncoder.bVector and itLoopedGenerator is not None:
+        itLoopedGenerator = objRecorder = checkpoints.GenerationRecorder(itLoopedGenerator, bDeterministic)
+
+    # string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaFac=None)
+    fncInterpreter = partial(kernels.string_to_collection,
                              dctInstructions=dctInstructions,
                              lDimensions=2,
                              npaPos=npaStartPos,
                              npaFac=npaStartFac
                              )
 
-    objFig, objAx = plt.subplots(figsize=(9, 9))
-    # objAx.set_xlabel('X axis')
-    # objAx.set_ylabel('Y axis')
-    objAx.set_xlim(-0.1, 1*tAspectRatio[0] + 0.1)
-    objAx.set_ylim(-0.1, 1*tAspectRatio[1] + 0.1)
-    plt.axis('off')
-    clsArtists = namedtuple("Artists", ("lcCoords", "objText"))
-    ntArtists = clsArtists(
-                           objAx.add_collection(LineCollection([],
-                                                               linewidths=0.5,
-                                                               linestyles='solid',
-                                                               colors=(0, 0, 0, 1)
-                                                               )
-                                               ),
-                           objAx.text(x=.05, y=.05, s="")
-                           )
-
-    #  init_fig_2d(ntArtists):
-    fncInit = partial(init_fig_2d, objFig=objFig, objAx=objAx, ntArtists=ntArtists)
-    #  frame_iter_2d(itGenerator, lCounter, lMod):
-    fncStep = partial(frame_iter_2d, itLoopedGenerator=itLoopedGenerator, fncInterpreter=fncInterpreter,
-                      lMod=lItPerLoop, lLastFrameHang=1)
-    # update_artists_2d(frames, objAx, fncInterpreter)
-    fncUpdate = partial(update_artists_2d, ntArtists=ntArtists, tAspectRatio=tAspectRatio)
-
-    objAnim = animation.FuncAnimation(
-        fig=objFig,
-        func=fncUpdate,
-        frames=fncStep,
-        init_func=fncInit,
-        cache_frame_data=False,
-        interval=500,
-        repeat_delay=2000,
-        # blit=True
-    )
+    # Vector formats are written straight from the generations and never touch matplotlib
+    objFig = objAnim = None
+    if not objEncoder.bVector:
+        objFig, objAx = plt.subplots(figsize=(9, 9))
+        # objAx.set_xlabel('X axis')
+        # objAx.set_ylabel('Y axis')
+        objAx.set_xlim(-0.1, 1*tAspectRatio[0] + 0.1)
+        objAx.set_ylim(-0.1, 1*tAspectRatio[1] + 0.1)
+        plt.axis('off')
+        clsArtists = namedtuple("Artists", ("lcCoords", "objText"))
+        ntArtists = clsArtists(
+                               objAx.add_collection(LineCollection([],
+                                                                   linewidths=0.5,
+                                                                   linestyles='solid',
+                                                                   colors=(0, 0, 0, 1),
+                                                                   antialiaseds=bAntialias
+                                                                   )
+                                                   ),
+                               objAx.text(x=.05, y=.05, s="")
+                               )
+
+        #  init_fig_2d(ntArtists):
+        fncInit = partial(init_fig_2d, objFig=objFig, objAx=objAx, ntArtists=ntArtists)
+        #  frame_iter_2d(itGenerator, lCounter, lMod):
+        fncStep = partial(frame_iter_2d, itLoopedGenerator=itLoopedGenerator, fncInterpreter=fncInterpreter,
+                          lMod=lItPerLoop - lPrior, fncCheckpoint=fncCheckpoint, objMetrics=objMetrics, lFirst=lPrior)
+        # update_artists_2d(frames, objAx, fncInterpreter)
+        fncUpdate = partial(update_artists_2d, ntArtists=ntArtists, tAspectRatio=tAspectRatio, objMetrics=objMetrics)
+
+        # The out-of-core path draws its frames itself; an animation would start drawing as soon as the canvas does
+        objAnim = None if bOutOfCore else animation.FuncAnimation(
+            fig=objFig,
+            func=fncUpdate,
+            frames=fncStep,
+            init_func=fncInit,
+            cache_frame_data=False,
+            interval=500,
+            repeat_delay=2000,
+            # blit=True
+        )
 
     # plt.show()
 
@@ -225,10 +357,174 @@ def render_2d_frame_by_frame_animation(sName, liRules, dctInstructions, sStartin
     # writer = clsWriter(fps=10, metadata=dict(artist='Jeff Maher'), bitrate=1800)
 
     objNow = datetime.now()
-    # TODO: un-hardcode this
-    sFileName = 'static/Saved_Animations/' + sName + objNow.strftime("_%Y-%m-%d_%H-%M-%S") + '.gif'
+    sBaseName = sName + objNow.strftime("_%Y-%m-%d_%H-%M-%S") + '.' + objEncoder.sExtension
+
+    # Everything is written in a work directory first, so a cancelled or failed render never leaves a partial gif
+    # behind in Saved_Animations.
+    bOwnWorkDir = sWorkDir is None
+    if bOwnWorkDir:
+        os.makedirs(junkdrawer.sPartialAnimationsFolder, exist_ok=True)
+        sWorkDir = tempfile.mkdtemp(dir=junkdrawer.sPartialAnimationsFolder)
+    else:
+        os.makedirs(sWorkDir, exist_ok=True)
+    sPartialName = os.path.join(sWorkDir, sBaseName)
+    sResumeName = os.path.join(sWorkDir, "resume.gen")
 
-    objAnim.save(sFileName)
+    sMakerKey = json.dumps({"sName": sName,
+                            "liRules": liRules,
+                            "dctInstructions": dctInstructions,
+                            "sStartingString": sStartingString,
+                            "lItPerLoop": lItPerLoop,
+                            "npaStartPos": npaStartPos,
+                            "npaStartFac": npaStartFac,
+                            "tAspectRatio": tAspectRatio,
+                            "lLastFrameHang": lLastFrameHang,
+                            "lSeed": lSeed,
+                            "sFormat": sFormat,
+                            "bAntialias": bAntialias
+                            }, cls=junkdrawer.JeffSONEncoder)
+
+    try:
+        if objEncoder.bVector:
+            liFrames = None
+            if itLoopedGenerator is None:
+                itLoopedGenerator = outofcore.spilled_generations(liRules, sStartingString, lSeed, lItPerLoop,
+                                                                  sWorkDir, fncCheckpoint)
+            with objMetrics.stage("encode"):
+                lFrames, tDimensions = encoders.write_svg(sPartialName, islice(itLoopedGenerator, lItPerLoop),
+                                                          dctInstructions, sMakerKey, npaStartPos, npaStartFac,
+                                                          tAspectRatio, lLastFrameHang=lLastFrameHang,
+                                                          sWorkDir=sWorkDir, fncCheckpoint=fncCheckpoint,
+                                                          objMetrics=objMetrics)
+        else:
+            # Rewriting, interpreting and updating happen inside the save and are timed as their own stages, which
+            # leaves matplotlib's drawing and palettising as "draw"
+            with objMetrics.stage("draw"):
+                if bOutOfCore:
+                    if itLoopedGenerator is None:
+                        if sExtendFrom is not None:
+                            tResume = checkpoints.spill_checkpoint(sCheckpoint, sResumeName)
+                        itLoopedGenerator = outofcore.spilled_generations(liRules, sStartingString, lSeed,
+                                                                          lItPerLoop, sWorkDir, fncCheckpoint,
+                                                                          tResume=tResume)
+                        if bCheckpoint:
+                            itLoopedGenerator = objRecorder = checkpoints.GenerationRecorder(itLoopedGenerator,
+                                                                                             bDeterministic)
+                    liFrames = outofcore.render_frames(itLoopedGenerator, objFig, ntArtists, dctInstructions,
+                                                       npaStartPos, npaStartFac, tAspectRatio, sWorkDir,
+                                                       fncCheckpoint=fncCheckpoint, objMetrics=objMetrics,
+                                                       fncPreview=fncPreview, bAntialias=bAntialias, lFirst=lPrior)
+                else:
+                    objWriter = FrameWriter(bAntialias, fncPreview, lPrior)
+                    objAnim.save(sPartialName, writer=objWriter)
+                    liFrames = objWriter.liFrames
+                liFrames = liPriorFrames + liFrames
+
+            with objMetrics.stage("encode"):
+                # The animation opens on the finished fractal, then grows from the axiom and holds on the final
+                # generation for lLastFrameHang frames' worth of time
+                liFrames = liFrames[-1:] + liFrames[:-1]
+                liDurations = [500] * len(liFrames)
+                if lLastFrameHang > 0 and len(liFrames) > 1:
+                    liFrames.append(liFrames[0])
+                    liDurations.append(500 * lLastFrameHang)
+                fncCheckpoint()
+                objEncoder.fncWrite(sPartialName, liFrames, liDurations, sMakerKey)
+            lFrames, tDimensions = len(liFrames), liFrames[0].size
+        fncCheckpoint()
+        if sFormat == "gif":
+            with objMetrics.stage("optimize"):
+                try:
+                    optimize(sPartialName)
+                except FileNotFoundError:
+                    warnings.warn("Failed to find gifsicle to optimize filesize.")
+        fncCheckpoint()
+        sFileName = junkdrawer.publish_file(sPartialName, 'static/Saved_Animations/', sBaseName)
+        sBaseName = sFileName.rsplit('/', 1)[1]
+        if objRecorder is not None:
+            # The checkpoint is named after the animation, so it follows it, but is in place before the animation is
+            # indexed. An animation that couldn't have the checkpoint it asked for isn't kept.
+            try:
+                with objMetrics.stage("checkpoint"):
+                    checkpoints.write_checkpoint(checkpoints.checkpoint_path(sBaseName), objRecorder.bufText,
+                                                 lItPerLoop - 1, objRecorder.tState)
+            except BaseException:
+                os.remove(sFileName)
+                raise
+        with objMetrics.stage("index"):
+            animationindex.add_animation(sFileName, sMakerKey, lFrames, tDimensions)
+            # Vector animations are their own thumbnails
+            if liFrames is not None:
+                thumbnails.make_thumbnails(sFileName, liFrames, liDurations)
+        objMetrics.lFrames = lFrames
+        objMetrics.lOutputBytes = os.path.getsize(sFileName)
+        objMetrics.measure_peak_rss()
+        animationindex.add_metrics(sBaseName, json.dumps(objMetrics.as_dict()))
+    finally:
+        if objFig is not None:
+            plt.close(objFig)
+        if bOwnWorkDir:
+            shutil.rmtree(sWorkDir, ignore_errors=True)
+        else:
+            for sLeftover in (sPartialName, sResumeName):
+                if os.path.exists(sLeftover):
+                    os.remove(sLeftover)
+    return sFileName
+
+
+def render_3d_frame_by_frame_animation(sName, liRules, dctInstructions, sStartingString, lItPerLoop,
+                                       npaStartPos=None, npaStartFac=None,
+                                       tAspectRatio=(1, 1), lLastFrameHang=1, lSeed=None, sFormat="gif",
+                                       bAntialias=False, lOrbitFrames=24, fElevation=np.pi / 6, fncCheckpoint=None,
+                                       sWorkDir=None, objMetrics=None, liGenerations=None, fncPreview=None):
+    """
+    Render a 3D fractal as an animation: the camera first circles the finished fractal once, then it grows from the
+    axiom seen from the front, and holds on the final generation. Generations are interpreted all at once by
+    turtle3d.segments and drawn by turtle3d's own rasteriser, with no matplotlib figure, nearer lines darker than
+    farther ones. The makerkey is embedded as for render_2d_frame_by_frame_animation, along with lDimensions=3.
+    :param dctInstructions: Dictionary. Instructions with 3x3 rotations, e.g. rulesandinstructions.std_3d_instructions.
+    :param npaStartPos: Numpy array. The starting position of the turtle, in 3D.
+    :param npaStartFac: Numpy array. The starting heading of the turtle, in 3D (see turtle3d.start_orientation).
+    :param tAspectRatio: Tuple. The aspect ratio of the frames.
+    :param sFormat: String. Output format, a raster key of encoders.dctEncoders: gif, webp or apng.
+    :param bAntialias: Boolean. Draw at twice the size and average down, onto lineart's grey ramp. Frames are on the
+        grey ramp either way, for the depth shading.
+    :param lOrbitFrames: Integer. Frames in the camera's turn around the finished fractal, 0 for none.
+    :param fElevation: Float. Radians the camera looks down on the fractal from.
+    :return: String. File name of the animation.
+    See render_2d_frame_by_frame_animation for the other parameters. Out-of-core rendering, checkpoints and
+    extending are 2D only.
+    """
+    from PIL import ImageDraw
+    import turtle3d
+    if fncCheckpoint is None:
+        def fncCheckpoint():
+            pass
+    if objMetrics is None:
+        objMetrics = metrics.RenderMetrics()
+    if sFormat not in encoders.dctEncoders:
+        raise ValueError("Unknown format {}, expected one of {}".format(sFormat, ", ".join(encoders.dctEncoders)))
+    objEncoder = encoders.dctEncoders[sFormat]
+    if objEncoder.bVector:
+        raise ValueError("3D fractals are rendered to raster formats only, not " + sFormat)
+    if liGenerations is not None:
+        itGenerations = iter(liGenerations)
+    else:
+        itGenerations = generationcache.lindenator(liRules, sInput=sStartingString, lSeed=lSeed,
+                                                   lMaxReturns=lItPerLoop, fncCheckpoint=fncCheckpoint)
+    fScale = 900 / max(tAspectRatio)
+    tSize = (int(round(tAspectRatio[0] * fScale)), int(round(tAspectRatio[1] * fScale)))
+
+    objNow = datetime.now()
+    sBaseName = sName + objNow.strftime("_%Y-%m-%d_%H-%M-%S") + '.' + objEncoder.sExtension
+
+    bOwnWorkDir = sWorkDir is None
+    if bOwnWorkDir:
+        os.makedirs(junkdrawer.sPartialAnimationsFolder, exist_ok=True)
+        sWorkDir = tempfile.mkdtemp(dir=junkdrawer.sPartialAnimationsFolder)
+    else:
+        os.makedirs(sWorkDir, exist_ok=True)
+    sPartialName = os.path.join(sWorkDir, sBaseName)
 
     sMakerKey = json.dumps({"sName": sName,
                             "liRules": liRules,
@@ -238,29 +534,90 @@ def render_2d_frame_by_frame_animation(sName, liRules, dctInstructions, sStartin
                             "npaStartPos": npaStartPos,
                             "npaStartFac": npaStartFac,
                             "tAspectRatio": tAspectRatio,
-                            "lLastFrameHang": lLastFrameHang
+                            "lLastFrameHang": lLastFrameHang,
+                            "lSeed": lSeed,
+                            "sFormat": sFormat,
+                            "bAntialias": bAntialias,
+                            "lDimensions": 3,
+                            "lOrbitFrames": lOrbitFrames,
+                            "fElevation": fElevation
                             }, cls=junkdrawer.JeffSONEncoder)
-    liFrames = []
-    with Image.open(sFileName) as imgNewGif:
-        for i in range(imgNewGif.n_frames):
-            imgNewGif.seek(i)
-            liFrames.append(imgNewGif.copy())
-    for i in range(lLastFrameHang):
-        liFrames.append(liFrames[-1])
-    liFrames[-1].save(sFileName,
-                      save_all=True,
-                      loop=0,
-                      duration=500,
-                      append_images=liFrames[:-1],
-                      optimize=True,
-                      include_color_table=False,
-                      comment=sMakerKey)
+
+    def draw(npaSegments, fAzimuth, tSphere, sTracker):
+        imgFrame = lineart.palettise(turtle3d.draw_frame(npaSegments, turtle3d.orbit_view(fAzimuth, fElevation),
+                                                         tSphere, tSize, bAntialias), True)
+        ImageDraw.Draw(imgFrame).text((tSize[0] * .05, tSize[1] * .95), sTracker, fill=0)
+        return imgFrame
+
     try:
-        optimize(sFileName)
-    except FileNotFoundError:
-        warnings.warn("Failed to find gifsicle to optimize filesize.")
+        liFrames = []
+        with objMetrics.stage("draw"):
+            for i in range(lItPerLoop):
+                fncCheckpoint()
+                with metrics.timed(objMetrics, "rewrite"):
+                    sText = next(itGenerations)
+                with metrics.timed(objMetrics, "interpret"):
+                    npaSegments = turtle3d.segments(sText, dctInstructions, npaStartPos, npaStartFac)
+                objMetrics.add_generation(sText, npaSegments)
+                # Each generation is framed on its own, as 2D frames are
+                liFrames.append(draw(npaSegments, 0., turtle3d.bounding_sphere(npaSegments),
+                                     "Generation {}".format(i)))
+                if fncPreview is not None:
+                    fncPreview(i, liFrames[-1])
+            tSphere = turtle3d.bounding_sphere(npaSegments)
+            liOrbit = []
+            for k in range(lOrbitFrames):
+                fncCheckpoint()
+                liOrbit.append(draw(npaSegments, 2 * np.pi * k / lOrbitFrames, tSphere,
+                                    "Generation {}".format(lItPerLoop - 1)))
+
+        with objMetrics.stage("encode"):
+            # As in 2D the animation opens on the finished fractal, here circling it, then grows from the axiom and
+            # holds on the final generation for lLastFrameHang frames' worth of time
+            liOpening = liOrbit or liFrames[-1:]
+            liDurations = [100 if liOrbit else 500] * len(liOpening) + [500] * (len(liFrames) - 1)
+            liFrames = liOpening + liFrames[:-1] + liFrames[-1:]
+            if lLastFrameHang > 0 and lItPerLoop > 1:
+                liDurations.append(500 * lLastFrameHang)
+            else:
+                liFrames.pop()
+            fncCheckpoint()
+            objEncoder.fncWrite(sPartialName, liFrames, liDurations, sMakerKey)
+        lFrames, tDimensions = len(liFrames), liFrames[0].size
+        fncCheckpoint()
+        if sFormat == "gif":
+            with objMetrics.stage("optimize"):
+                try:
+                    optimize(sPartialName)
+                except FileNotFoundError:
+                    warnings.warn("Failed to find gifsicle to optimize filesize.")
+        fncCheckpoint()
+        sFileName = junkdrawer.publish_file(sPartialName, 'static/Saved_Animations/', sBaseName)
+        sBaseName = sFileName.rsplit('/', 1)[1]
+        with objMetrics.stage("index"):
+            animationindex.add_animation(sFileName, sMakerKey, lFrames, tDimensions)
+            thumbnails.make_thumbnails(sFileName, liFrames, liDurations)
+        objMetrics.lFrames = lFrames
+        objMetrics.lOutputBytes = os.path.getsize(sFileName)
+        objMetrics.measure_peak_rss()
+        animationindex.add_metrics(sBaseName, json.dumps(objMetrics.as_dict()))
     finally:
-        return sFileName
+        if bOwnWorkDir:
+            shutil.rmtree(sWorkDir, ignore_errors=True)
+        elif os.path.exists(sPartialName):
+            os.remove(sPartialName)
+    return sFileName
+
+
+def render_animation(**kwargs):
+    """
+    Render an animation from the arguments of render_2d_frame_by_frame_animation or, for makerkeys with
+    lDimensions=3, render_3d_frame_by_frame_animation.
+    :return: String. File name of the animation.
+    """
+    if kwargs.pop("lDimensions", 2) == 3:
+        return render_3d_frame_by_frame_animation(**kwargs)
+    return render_2d_frame_by_frame_animation(**kwargs)
 
 
 def clone_2d_gif(sFile):
@@ -269,17 +626,59 @@ def clone_2d_gif(sFile):
     :param sFile: String. Filename of fractal gif, must contain makerkey as a comment.
     :return: String. File name of new gif.
     """
-    return render_2d_frame_by_frame_animation(**get_makerkey(sFile))
+    return render_animation(**get_makerkey(sFile))
+
+
+def extend_2d_animation(sFile, lGenerations, **kwargs):
+    """
+    Continue a fractal rendered with bCheckpoint=True for lGenerations more generations, from the checkpoint of its
+    final generation, so the cost is that of the new generations only: they are rewritten from the checkpointed
+    text and random state, and the frames of the old ones are read back from the animation. The result is a new
+    animation whose makerkey differs only in lItPerLoop. Stochastic rules carry on growing the same plant, and with
+    a seed the result is the animation a full render of that many generations gives.
+    :param sFile: String. Path of a raster animation with a checkpoint (see checkpoints).
+    :param lGenerations: Integer. Number of generations to add.
+    :param kwargs: Arguments of render_2d_frame_by_frame_animation that aren't part of the makerkey, e.g. bCheckpoint
+        to make the new animation extendable in turn, or bOutOfCore.
+    :return: String. File name of the new animation.
+    """
+    if lGenerations < 1:
+        raise ValueError("lGenerations must be a positive integer")
+    dctMakerKey = get_makerkey(sFile)
+    dctMakerKey["lItPerLoop"] = checkpoints.read_generation(checkpoints.checkpoint_path(os.path.basename(sFile))) \
+        + 1 + lGenerations
+    return render_2d_frame_by_frame_animation(**dctMakerKey, sExtendFrom=sFile, **kwargs)
+
+
+def generation_frames(sFile, lGenerations, bAntialias=False):
+    """
+    Read back the frames of each generation of a raster animation, undoing the order render_2d_frame_by_frame_animation
+    gives them: the final generation first, then each generation for 500ms (identical neighbours folded into one
+    longer frame), then the final one again for the hang.
+    :param sFile: String. Path of the animation.
+    :param lGenerations: Integer. Number of generations it has.
+    :param bAntialias: Boolean. Whether it was drawn on lineart's grey ramp, which the frames are put back on.
+    :return: List. PIL images, one per generation.
+    """
+    from PIL import Image, ImageSequence
+    liFrames = []
+    with Image.open(sFile) as imgAnimation:
+        for imgFrame in ImageSequence.Iterator(imgAnimation):
+            imgGeneration = lineart.palettise(np.asarray(imgFrame.convert('L')), bAntialias)
+            liFrames.extend([imgGeneration] * max(1, round(imgFrame.info.get("duration", 500) / 500)))
+    if len(liFrames) < lGenerations + 1:
+        raise ValueError("{} has fewer than {} generations".format(sFile, lGenerations))
+    return liFrames[1:1 + lGenerations]
 
 
 def get_makerkey(fileName):
     """
     Unpack the makerkey stored in a fractal.
-    :param sFile: String. Filename of fractal gif, must contain makerkey as a comment.
+    :param sFile: String. Filename of fractal animation in any of the formats of encoders, which must contain a
+        makerkey in its metadata.
     :return: Dictionary. Makerkey.
     """
-    with Image.open(fileName) as imgGif:
-        dctRenderParams = json.loads(imgGif.info["comment"], cls=junkdrawer.JeffSONDecoder)
+    dctRenderParams = json.loads(encoders.read_makerkey(fileName), cls=junkdrawer.JeffSONDecoder)
     return dctRenderParams
 
 
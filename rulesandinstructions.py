@@ -95,6 +95,64 @@ def std_2d_instructions(fTheta, fRTheta=None):
     return dctOut
 
 
+def rotation_matrix_3d(sAxis, theta):
+    """
+    Create a rotation matrix in 3D space about one of the turtle's own axes, for 3D instructions. A 3D turtle
+    carries its heading, left and up directions as the columns of an orientation matrix, which an instruction's
+    rotation multiplies from the right (see turtle3d), so these turn the turtle relative to where it faces.
+    :param sAxis: String. "up" to yaw, turning the heading towards left; "left" to pitch, turning the heading
+        down towards -up; "heading" to roll, turning left towards up.
+    :param theta: Float. Radians.
+    :return: numpy array. Rotation Matrix.
+    """
+    fSin = np.round(np.sin(theta), 10)
+    fCos = np.round(np.cos(theta), 10)
+    if sAxis == "up":
+        return np.array([[fCos, -fSin, 0],
+                         [fSin, fCos, 0],
+                         [0, 0, 1]])
+    if sAxis == "left":
+        return np.array([[fCos, 0, fSin],
+                         [0, 1, 0],
+                         [-fSin, 0, fCos]])
+    if sAxis == "heading":
+        return np.array([[1, 0, 0],
+                         [0, fCos, -fSin],
+                         [0, fSin, fCos]])
+    raise ValueError("Unknown axis " + sAxis)
+
+
+def std_3d_instructions(fTheta):
+    """
+    The 3D turtle commands of http://paulbourke.net/fractals/lsys/: + and - yaw left and right, & and ^ pitch down
+    and up, \\ and / roll left and right, | turns around, F and G draw forward, f moves forward, [ and ] push and pop.
+    :param fTheta: Float. Turning angle in radians.
+    """
+    npaIdentity = np.identity(3)
+    dctOut = {
+        "F": {"draw": True, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": npaIdentity, "movement": 1},
+        "G": {"draw": True, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": npaIdentity, "movement": 1},
+        "f": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": npaIdentity, "movement": 1},
+        "+": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": rotation_matrix_3d("up", fTheta),
+              "movement": 0},
+        "-": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": rotation_matrix_3d("up", -fTheta),
+              "movement": 0},
+        "&": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": rotation_matrix_3d("left", fTheta),
+              "movement": 0},
+        "^": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": rotation_matrix_3d("left", -fTheta),
+              "movement": 0},
+        "\\": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0],
+               "rotation": rotation_matrix_3d("heading", fTheta), "movement": 0},
+        "/": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": rotation_matrix_3d("heading", -fTheta),
+              "movement": 0},
+        "|": {"draw": False, "pop-push": [0, 0, 0, 0, 0, 0, 0, 0], "rotation": rotation_matrix_3d("up", np.pi),
+              "movement": 0},
+        "[": {"draw": False, "pop-push": [0, 0, 1, 1, 0, 0, 0, 0], "rotation": npaIdentity, "movement": 0},
+        "]": {"draw": False, "pop-push": [1, 1, 0, 0, 0, 0, 0, 0], "rotation": npaIdentity, "movement": 0},
+    }
+    return dctOut
+
+
 def new_rule(sPredecessor, liSuccessors, sName='', bEnabled=True, bProtected=True):
     return {
         "name": sName,
@@ -208,4 +266,16 @@ liTreeRules = [
      'protected': True,
      'predecessor': '(C)',
      'successor': [[0.4, 'F,[-\\1][\\1],F[+\\1][\\1],F'], [0.8, 'F,[+\\1][\\1],F[-\\1][\\1],F'],
-                   [0.9, 'F[-\\1][\\1]F[+\\1][\\1]F'], [1, 'F[+\\1][\\1]F[-\\1][\\1]F']]}]
\ No newline at end of file
+                   [0.9, 'F[-\\1][\\1]F[+\\1][\\1]F'], [1, 'F[+\\1][\\1]F[-\\1][\\1]F']]}]
+
+# Bourke's 3D Hilbert curve, drawn with std_3d_instructions(np.pi / 2)
+li3dHilbertRules = [new_rule(r"^$", [(1, "A")], sName="Axiom"),
+                    new_rule("A", [(1, "B-F+CFC+F-D&F^D-F+&&CFC+F+B//")], sName="A"),
+                    new_rule("B", [(1, "A&F^CFB^F^D^^-F-D^|F^B|FC^F^A//")], sName="B"),
+                    new_rule("C", [(1, "|D^|F^B-F+C^F^A&&FA&F^C+F+B^F^D//")], sName="C"),
+                    new_rule("D", [(1, "|CFB-F+B|FA&F^A&&FB-F+B|FC//")], sName="D")]
+
+# A bush branching in three dimensions, drawn with std_3d_instructions(np.pi / 8) from "A"
+li3dBushRules = [new_rule("A", [(1, "[&FL!A]/////[&FL!A]///////[&FL!A]")], sName="Branching"),
+                 new_rule("F", [(.5, "S/////F"), (1, "S//F")], sName="Growing"),
+                 new_rule("S", [(1, "FL")], sName="Stem")]
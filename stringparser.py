@@ -20,6 +20,18 @@ def string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaF
     :param deqFac: deque.  A deque of facings to and from which instructions may push and pop
     :return: List. Each element is a tuple of numpy arrays, which contain the coordinates of lines to be rendered.
     """
+    liOut = list(iter_segments(sInput, dctInstructions, lDimensions, npaPos, npaFac, deqPos, deqFac))
+    if not liOut:
+        liOut.append(np.zeros((lDimensions, 2)))
+    return liOut
+
+
+def iter_segments(itInput, dctInstructions, lDimensions, npaPos=None, npaFac=None, deqPos=None, deqFac=None):
+    """
+    Generator version of string_to_collection, yielding each line as it is drawn, so that the characters can be
+    streamed in and the lines streamed out without holding either in memory. Yields nothing for an empty drawing.
+    :param itInput: Iterable of characters, e.g. a string or outofcore.iter_text of a memory mapped generation.
+    """
     if npaPos is None:
         npaPos = np.array([0 for _i in range(lDimensions)])
     if npaFac is None:
@@ -29,8 +41,7 @@ def string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaF
         deqPos = col.deque()
     if deqFac is None:
         deqFac = col.deque()
-    liOut = []
-    for char in tqdm(sInput, desc="Interpreting string", file=sys.stdout):
+    for char in tqdm(itInput, desc="Interpreting string", file=sys.stdout):
         try:
             dctInstruction = dctInstructions[char]
         except KeyError:
@@ -46,7 +57,7 @@ def string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaF
         npaFac = dctInstruction["rotation"].dot(npaFac)
         npaDest = npaPos + dctInstruction["movement"] * npaFac
         if dctInstruction["draw"]:
-            liOut.append(np.vstack((npaPos, npaDest)))
+            yield np.vstack((npaPos, npaDest))
         npaPos = npaDest
         if dctInstruction["pop-push"][4]:
             npaPos = deqPos.pop()
@@ -56,9 +67,6 @@ def string_to_collection(sInput, dctInstructions, lDimensions, npaPos=None, npaF
             deqPos.append(npaPos)
         if dctInstruction["pop-push"][7]:
             deqFac.append(npaFac)
-    if not liOut:
-        liOut.append(np.zeros((lDimensions, 2)))
-    return liOut
 
 
 def main():
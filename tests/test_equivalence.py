@@ -0,0 +1,45 @@
+import pytest
+
+import equivalence
+import kernels
+
+# Shipped rule sets, and the corner cases most likely to split the backends from the reference
+tCaseNames = ("overlap axiom", "exposed axiom", "koch", "plant1", "tree", "hilbert 3d", "bush 3d")
+
+
+@pytest.fixture(scope="module")
+def liCases():
+    return [tCase for tCase in equivalence.odd_cases() if tCase[0] in tCaseNames] + equivalence.random_cases(10)
+
+
+@pytest.fixture(scope="module")
+def liTexts(liCases):
+    return equivalence.interpretation_texts(liCases)
+
+
+def backend(sName):
+    if sName not in kernels.dctBackends:
+        pytest.skip(sName + " backend unavailable (numba isn't installed)")
+    return kernels.dctBackends[sName]
+
+
+# The python backend's rewrite is the reference itself; its interpretation still chunks through python_segment_blocks
+@pytest.mark.parametrize("sName", ["numpy", "numba"])
+def test_rewrites_match_reference(sName, liCases):
+    assert equivalence.check_rewrites(backend(sName), liCases, [0, 1]) == []
+
+
+@pytest.mark.parametrize("sName", ["python", "numpy", "numba"])
+def test_interpretations_match_reference(sName, liTexts):
+    assert equivalence.check_interpretations(backend(sName), liTexts) == []
+
+
+def test_3d_interpretations_match_reference(liTexts):
+    assert equivalence.check_3d_interpretations(liTexts) == []
+
+
+def test_mismatches_are_reported(liCases):
+    def fncUnchanged(liRules, sInput="", lIterations=1):
+        return sInput
+    objBroken = kernels.Backend("broken", fncUnchanged, kernels.python_segment_blocks)
+    assert equivalence.check_rewrites(objBroken, liCases, [0])
@@ -0,0 +1,76 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+import gifblocks
+
+
+def frames(lCount=4, tSize=(37, 23), lColours=5, lSeed=0):
+    """
+    Frames on one small palette, each changing a few pixels of the last, as a growing fractal does.
+    """
+    objRandom = np.random.default_rng(lSeed)
+    npaFrame = np.zeros(tSize[::-1], dtype=np.uint8)
+    liOut = []
+    for _i in range(lCount):
+        npaFrame = npaFrame.copy()
+        npaFrame[objRandom.integers(0, tSize[1], 20), objRandom.integers(0, tSize[0], 20)] = \
+            objRandom.integers(1, lColours, 20)
+        imgFrame = Image.fromarray(npaFrame, 'P')
+        imgFrame.putpalette([i * 255 // lColours for i in range(lColours) for _j in range(3)])
+        liOut.append(imgFrame)
+    return liOut
+
+
+def read_back(bGif):
+    """
+    :return: Tuple. (pixel arrays of each composited frame, durations, comment) as PIL reads them.
+    """
+    with Image.open(io.BytesIO(bGif)) as imgGif:
+        liPixels, liDurations = [], []
+        for imgFrame in ImageSequence.Iterator(imgGif):
+            liPixels.append(np.asarray(imgFrame.convert('L')))
+            liDurations.append(imgFrame.info["duration"])
+        return liPixels, liDurations, imgGif.info.get("comment")
+
+
+def write(liFrames, liDurations, bComment=None):
+    objBuffer = io.BytesIO()
+    gifblocks.write_animation(objBuffer, liFrames, liDurations, bComment)
+    return objBuffer.getvalue()
+
+
+@pytest.mark.parametrize("lColours", [2, 5, 17, 200])
+def test_frames_round_trip(lColours):
+    liFrames = frames(lColours=lColours)
+    liPixels, liDurations, bComment = read_back(write(liFrames, [100, 200, 300, 400], b'{"sName": "x"}'))
+    assert [npaPixels.tolist() for npaPixels in liPixels] == \
+        [np.asarray(imgFrame.convert('L')).tolist() for imgFrame in liFrames]
+    assert liDurations == [100, 200, 300, 400]
+    assert bComment == b'{"sName": "x"}'
+
+
+def test_repeated_frames_become_durations():
+    liFrames = frames(2)
+    liPixels, liDurations, _bComment = read_back(write([liFrames[0], liFrames[0], liFrames[1]], [500, 500, 500]))
+    assert len(liPixels) == 2
+    assert liDurations == [1000, 500]
+
+
+def test_long_hangs_are_split():
+    liFrames = frames(2)
+    liPixels, liDurations, _bComment = read_back(write(liFrames, [500, 500 * 2000]))
+    assert sum(liDurations) == 500 * 2001
+    assert all(lDuration <= gifblocks.lMaxDelay * 10 for lDuration in liDurations)
+    assert liPixels[-1].tolist() == np.asarray(liFrames[1].convert('L')).tolist()
+
+
+def test_comment_and_frames_are_described():
+    liFrames = frames(3)
+    bGif = write(liFrames, [500] * 3, b"makerkey")
+    objScanner = gifblocks.GifScanner()
+    objScanner.feed(bGif)
+    bComment, lFrames, tDimensions = objScanner.result()
+    assert (bComment, lFrames, tDimensions) == (b"makerkey", 3, liFrames[0].size)
@@ -0,0 +1,80 @@
+import os
+
+import junkdrawer
+
+
+lThumbnailSize = 240
+
+
+def poster_name(sBaseName):
+    """
+    :param sBaseName: String. File name of a gif in Saved_Animations.
+    :return: String. File name of its static poster frame within junkdrawer.sThumbnailsFolder.
+    """
+    return sBaseName.rsplit('.', 1)[0] + '.png'
+
+
+def preview_name(sBaseName):
+    """
+    :param sBaseName: String. File name of a gif in Saved_Animations.
+    :return: String. File name of its small looping preview within junkdrawer.sThumbnailsFolder.
+    """
+    return sBaseName.rsplit('.', 1)[0] + '.preview.gif'
+
+
+def has_thumbnails(sBaseName):
+    return all(os.path.isfile(os.path.join(junkdrawer.sThumbnailsFolder, sName))
+               for sName in (poster_name(sBaseName), preview_name(sBaseName)))
+
+
+def make_thumbnails(sFileName, liFrames=None, lDuration=500, lMaxSide=lThumbnailSize):
+    """
+    Write the poster frame and looping preview used by the gallery for a saved gif.
+    The poster is the final generation, as that's the one people recognise a fractal by.
+    :param sFileName: String. Path of the gif.
+    :param liFrames: List. PIL images of the gif's frames, if the caller already has them decoded.
+    :param lDuration: Integer or list. Milliseconds per frame of the preview, or of each frame.
+    :param lMaxSide: Integer. Size in pixels of the longest side of the thumbnails.
+    :return: Tuple. Paths of the poster and the preview.
+    """
+    # PIL is only needed here, so the web tier doesn't load it just to look up thumbnail names
+    from PIL import Image, ImageSequence
+    if liFrames is None:
+        with Image.open(sFileName) as imgGif:
+            liSmall = [shrink_frame(imgFrame, lMaxSide) for imgFrame in ImageSequence.Iterator(imgGif)]
+    else:
+        liSmall = [shrink_frame(imgFrame, lMaxSide) for imgFrame in liFrames]
+    os.makedirs(junkdrawer.sThumbnailsFolder, exist_ok=True)
+    sBaseName = os.path.basename(sFileName)
+    sPoster = os.path.join(junkdrawer.sThumbnailsFolder, poster_name(sBaseName))
+    sPreview = os.path.join(junkdrawer.sThumbnailsFolder, preview_name(sBaseName))
+    liSmall[-1].save(sPoster, optimize=True)
+    liSmall[0].save(sPreview,
+                    save_all=True,
+                    append_images=liSmall[1:],
+                    loop=0,
+                    duration=lDuration,
+                    optimize=True)
+    return sPoster, sPreview
+
+
+def shrink_frame(imgFrame, lMaxSide=lThumbnailSize):
+    """
+    Greyscale copy of a frame scaled down to fit within lMaxSide pixels. The fractals are black on white, so grey
+    keeps the anti-aliasing of the thin lines without paying for colour.
+    """
+    from PIL import Image
+    imgSmall = imgFrame.convert('L')
+    imgSmall.thumbnail((lMaxSide, lMaxSide), Image.LANCZOS)
+    return imgSmall
+
+
+def remove_thumbnails(sBaseName):
+    """
+    Delete the thumbnails of a gif, if it has any.
+    """
+    for sName in (poster_name(sBaseName), preview_name(sBaseName)):
+        try:
+            os.remove(os.path.join(junkdrawer.sThumbnailsFolder, sName))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,264 @@
+import collections as col
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+import kernels
+
+lDimensions = 3
+# Share of the frame's shorter side the fractal's bounding sphere spans
+fFill = .9
+# Grey of the farthest lines, the nearest being black; frames are put on lineart's grey ramp
+lFarthestGrey = 170
+
+
+def start_orientation(npaFac=None):
+    """
+    The orientation a 3D turtle starts with: a matrix whose columns are its heading, left and up directions.
+    :param npaFac: numpy array. Starting heading. Its length scales every move, as a 2D turtle's facing does.
+        Defaults to straight up the z axis.
+    :return: numpy array. (3, 3) orientation.
+    """
+    npaHeading = np.array([0., 0., 1.]) if npaFac is None else np.asarray(npaFac, dtype=np.float64)
+    fLength = np.linalg.norm(npaHeading)
+    if fLength == 0:
+        raise ValueError("The starting facing can't be zero")
+    npaHeading = npaHeading / fLength
+    # Left is level where it can be, so trees start upright
+    npaReference = np.array([0., 0., 1.]) if abs(npaHeading[2]) < .9 else np.array([1., 0., 0.])
+    npaLeft = np.cross(npaReference, npaHeading)
+    npaLeft /= np.linalg.norm(npaLeft)
+    npaUp = np.cross(npaHeading, npaLeft)
+    return np.column_stack((npaHeading, npaLeft, npaUp)) * fLength
+
+
+def iter_segments(itInput, dctInstructions, npaPos=None, npaFac=None):
+    """
+    Interpret a string as 3D turtle graphics one character at a time, yielding each line as it is drawn. The reference
+    for segments: as stringparser.iter_segments, but the turtle carries a full orientation (see start_orientation),
+    which each instruction's rotation turns relative to itself, so yaw, pitch and roll all behave however the turtle
+    is facing. The pop-push flags are those of the 2D instructions, the facing stack holding orientations.
+    :param itInput: Iterable of characters.
+    :param dctInstructions: Dictionary. Maps characters to instructions with 3x3 rotations, e.g.
+        rulesandinstructions.std_3d_instructions.
+    :param npaPos: numpy array. Starting position. Defaults to the origin.
+    :param npaFac: numpy array. Starting heading, see start_orientation.
+    :return: Generator of (2, 3) arrays.
+    """
+    npaPos = np.zeros(lDimensions) if npaPos is None else np.asarray(npaPos, dtype=np.float64)
+    npaOrientation = start_orientation(npaFac)
+    deqPos = col.deque()
+    deqOrientation = col.deque()
+    for char in tqdm(itInput, desc="Interpreting string", file=sys.stdout):
+        try:
+            dctInstruction = dctInstructions[char]
+        except KeyError:
+            continue
+        if dctInstruction["pop-push"][0]:
+            npaPos = deqPos.pop()
+        if dctInstruction["pop-push"][1]:
+            npaOrientation = deqOrientation.pop()
+        if dctInstruction["pop-push"][2]:
+            deqPos.append(npaPos)
+        if dctInstruction["pop-push"][3]:
+            deqOrientation.append(npaOrientation)
+        npaOrientation = npaOrientation.dot(dctInstruction["rotation"])
+        npaDest = npaPos + dctInstruction["movement"] * npaOrientation[:, 0]
+        if dctInstruction["draw"]:
+            yield np.vstack((npaPos, npaDest))
+        npaPos = npaDest
+        if dctInstruction["pop-push"][4]:
+            npaPos = deqPos.pop()
+        if dctInstruction["pop-push"][5]:
+            npaOrientation = deqOrientation.pop()
+        if dctInstruction["pop-push"][6]:
+            deqPos.append(npaPos)
+        if dctInstruction["pop-push"][7]:
+            deqOrientation.append(npaOrientation)
+
+
+def tree_parents(npaPops, npaPushesBefore, npaPushesAfter):
+    """
+    Work out which earlier instruction each instruction carries on from, i.e. whose resulting state it starts in:
+    the one before it, unless it pops, in which case it's the state its matching push stored.
+    Stack pushes and pops are matched in bulk: a pop takes the latest push before it that left the stack as deep as
+    the pop finds it.
+    :param npaPops: Numpy array. Boolean, whether each instruction pops before it moves.
+    :param npaPushesBefore: Numpy array. Boolean, whether it pushes before it moves (after any pop).
+    :param npaPushesAfter: Numpy array. Boolean, whether it pushes after it moves.
+    :return: Numpy array. int64 index of the instruction whose result each instruction starts from, -1 for the start.
+    """
+    lCount = len(npaPops)
+    npaParents = np.arange(lCount, dtype=np.int64) - 1
+    if not npaPops.any():
+        return npaParents
+    # Each instruction's stack events in the order they happen: pop, push before, push after
+    npaEvents = np.stack((-npaPops.astype(np.int64), npaPushesBefore, npaPushesAfter), axis=1).ravel()
+    npaDepth = np.cumsum(npaEvents)
+    npaOrder = np.flatnonzero(npaEvents)
+    npaKinds = npaEvents[npaOrder]
+    npaPushOrder = npaOrder[npaKinds > 0]
+    npaPopOrder = npaOrder[npaKinds < 0]
+    # Depth a push leaves the stack at, and a pop finds it at
+    npaPushDepth = npaDepth[npaPushOrder]
+    npaPopDepth = npaDepth[npaPopOrder] + 1
+    if npaPopDepth.min() < 1:
+        raise IndexError("pop from an empty deque")
+    lStride = 3 * lCount + 1
+    npaPushKeys = npaPushDepth * lStride + npaPushOrder
+    npaSorted = np.argsort(npaPushKeys, kind='stable')
+    npaMatches = npaPushOrder[npaSorted[np.searchsorted(npaPushKeys[npaSorted],
+                                                        npaPopDepth * lStride + npaPopOrder) - 1]]
+    npaPopping = npaPopOrder // 3
+    npaPushers = npaMatches // 3
+    # A push after moving stores the pusher's result. A push before moving stores what the pusher started from,
+    # which for a pusher that popped too is only known once its own pop is resolved, so they are copied until settled.
+    npaAfter = npaMatches % 3 == 2
+    npaParents[npaPopping[npaAfter]] = npaPushers[npaAfter]
+    npaPopping, npaPushers = npaPopping[~npaAfter], npaPushers[~npaAfter]
+    bChanged = len(npaPopping) > 0
+    while bChanged:
+        npaStored = npaParents[npaPushers]
+        bChanged = (npaParents[npaPopping] != npaStored).any()
+        npaParents[npaPopping] = npaStored
+    return npaParents
+
+
+def segments(bufText, dctInstructions, npaPos=None, npaFac=None):
+    """
+    iter_segments for a whole generation at once, in numpy. Each instruction turns and moves the turtle by a fixed
+    transform of the state it starts from, the state left by the instruction tree_parents picks for it, so every
+    state is the starting state composed with the transforms along its path through that tree. Those compositions
+    are done for all instructions together by pointer jumping, doubling the length of path covered each round.
+    Instructions that pop after moving, or treat the position and orientation stacks differently, don't make a tree,
+    and are left to iter_segments, as are instructions on characters that aren't ASCII.
+    Compositions are associated differently from iter_segments, so coordinates match it to rounding, not bit for bit.
+    :param bufText: String or bytes-like (e.g. an mmap) of utf-8 text.
+    :return: Numpy array. (N, 2, 3) segments, or (0, 2, 3) for an empty drawing.
+    """
+    tTable = kernels.instruction_table(dctInstructions, lDimensions)
+    npaPopPush = None if tTable is None else tTable[4]
+    if npaPopPush is None or (npaPopPush[:, 0] != npaPopPush[:, 1]).any() or \
+            (npaPopPush[:, 2] != npaPopPush[:, 3]).any() or npaPopPush[:, 4:6].any() or \
+            (npaPopPush[:, 6] != npaPopPush[:, 7]).any():
+        liSegments = list(iter_segments(kernels.iter_text(bufText), dctInstructions, npaPos, npaFac))
+        return np.array(liSegments).reshape(-1, 2, lDimensions)
+    npaOpcodes, npaRotations, npaMovements, npaDraws, npaPopPush = tTable
+    npaCodes = npaOpcodes[kernels.symbols(bufText)]
+    npaCodes = npaCodes[npaCodes >= 0]
+    npaParents = tree_parents(npaPopPush[npaCodes, 0], npaPopPush[npaCodes, 2], npaPopPush[npaCodes, 6])
+
+    # Each instruction as the transform (R, t) taking its starting state (O, p) to (O R, p + O t)
+    npaTurns = npaRotations[npaCodes]
+    npaSteps = npaMovements[npaCodes, None] * npaTurns[:, :, 0]
+    # Pointer jumping: npaTurns and npaSteps cover the path from just after npaReach to each instruction
+    npaReach = npaParents.copy()
+    npaOpen = np.flatnonzero(npaReach >= 0)
+    while len(npaOpen):
+        npaVia = npaReach[npaOpen]
+        npaSteps[npaOpen] = np.einsum('nij,nj->ni', npaTurns[npaVia], npaSteps[npaOpen]) + npaSteps[npaVia]
+        npaTurns[npaOpen] = npaTurns[npaVia] @ npaTurns[npaOpen]
+        npaReach[npaOpen] = npaReach[npaVia]
+        npaOpen = npaOpen[npaReach[npaOpen] >= 0]
+
+    npaStartPos = np.zeros(lDimensions) if npaPos is None else np.asarray(npaPos, dtype=np.float64)
+    npaEnds = npaStartPos + npaSteps.dot(start_orientation(npaFac).T)
+    npaDrawn = np.flatnonzero(npaDraws[npaCodes])
+    npaFrom = npaParents[npaDrawn]
+    npaStarts = np.where(npaFrom[:, None] >= 0, npaEnds[np.maximum(npaFrom, 0)], npaStartPos)
+    return np.stack((npaStarts, npaEnds[npaDrawn]), axis=1)
+
+
+def orbit_view(fAzimuth, fElevation):
+    """
+    Camera for a frame of an orbit around the z axis.
+    :param fAzimuth: Float. Radians the camera has circled anticlockwise, seen from above.
+    :param fElevation: Float. Radians the camera looks down from level.
+    :return: numpy array. (3, 3) matrix taking world coordinates to screen right, screen up and towards the viewer.
+    """
+    fSin, fCos = np.sin(fAzimuth), np.cos(fAzimuth)
+    npaSpin = np.array([[fCos, fSin, 0], [-fSin, fCos, 0], [0, 0, 1]])
+    # Level, the camera looks along +y with z up
+    npaLevel = np.array([[1, 0, 0], [0, 0, 1], [0, -1, 0]])
+    fSin, fCos = np.sin(fElevation), np.cos(fElevation)
+    npaTilt = np.array([[1, 0, 0], [0, fCos, -fSin], [0, fSin, fCos]])
+    return npaTilt @ npaLevel @ npaSpin
+
+
+def bounding_sphere(npaSegments):
+    """
+    :return: Tuple. (centre, radius) of a sphere around every point of the segments, for framing them the same way
+        from every side.
+    """
+    npaPoints = npaSegments.reshape(-1, lDimensions)
+    if len(npaPoints) == 0:
+        return np.zeros(lDimensions), 1.
+    npaCentre = (npaPoints.min(axis=0) + npaPoints.max(axis=0)) / 2
+    fRadius = np.sqrt(((npaPoints - npaCentre) ** 2).sum(axis=1).max())
+    return npaCentre, fRadius or 1.
+
+
+def project(npaSegments, npaView, tSphere, tSize):
+    """
+    Orthographic projection of segments onto a frame.
+    :param npaView: numpy array. Camera, see orbit_view.
+    :param tSphere: Tuple. (centre, radius) to fit in the frame, see bounding_sphere.
+    :param tSize: Tuple. (width, height) of the frame in pixels.
+    :return: Tuple. ((N, 2, 2) pixel coordinates, (N, 2) depths from 0 nearest to 1 farthest)
+    """
+    npaCentre, fRadius = tSphere
+    npaCamera = (npaSegments - npaCentre).dot(npaView.T) / fRadius
+    fScale = fFill * min(tSize) / 2
+    npaPixels = np.empty(npaCamera.shape[:2] + (2,))
+    npaPixels[:, :, 0] = tSize[0] / 2 + npaCamera[:, :, 0] * fScale
+    npaPixels[:, :, 1] = tSize[1] / 2 - npaCamera[:, :, 1] * fScale
+    return npaPixels, (1 - npaCamera[:, :, 2]) / 2
+
+
+def rasterise(npaPixels, npaDepths, tSize, lWidth=1):
+    """
+    Draw projected segments as lines lWidth pixels wide, shaded from black for the nearest to lFarthestGrey for the
+    farthest. Every segment is sampled about once per pixel along its length, all at once, and where lines cross the
+    nearest one is kept, as a depth buffer would: shades only darken with nearness, so that's the darkest.
+    :param npaPixels: numpy array. (N, 2, 2) pixel coordinates, see project.
+    :param npaDepths: numpy array. (N, 2) depths of the segments' ends, from 0 to 1.
+    :param tSize: Tuple. (width, height) of the frame.
+    :param lWidth: Integer. Line width in pixels, lines thickening to the right and down.
+    :return: numpy array. (height, width) uint8 grey levels on white.
+    """
+    lImageWidth, lImageHeight = tSize
+    npaImage = np.full(lImageWidth * lImageHeight, 255, dtype=np.uint8)
+    if len(npaPixels) == 0:
+        return npaImage.reshape(lImageHeight, lImageWidth)
+    npaDelta = npaPixels[:, 1] - npaPixels[:, 0]
+    npaSamples = np.ceil(np.abs(npaDelta).max(axis=1)).astype(np.int64) + 1
+    npaOwner = np.repeat(np.arange(len(npaPixels)), npaSamples)
+    npaFirst = np.repeat(np.cumsum(npaSamples) - npaSamples, npaSamples)
+    npaAlong = (np.arange(len(npaOwner)) - npaFirst) / np.maximum(npaSamples - 1, 1)[npaOwner]
+    npaX = np.rint(npaPixels[npaOwner, 0, 0] + npaAlong * npaDelta[npaOwner, 0]).astype(np.int64)
+    npaY = np.rint(npaPixels[npaOwner, 0, 1] + npaAlong * npaDelta[npaOwner, 1]).astype(np.int64)
+    npaDepth = npaDepths[npaOwner, 0] + npaAlong * (npaDepths[npaOwner, 1] - npaDepths[npaOwner, 0])
+    npaShade = np.rint(np.clip(npaDepth, 0, 1) * lFarthestGrey).astype(np.uint8)
+    for lDx in range(lWidth):
+        for lDy in range(lWidth):
+            npaInside = (npaX + lDx >= 0) & (npaX + lDx < lImageWidth) & (npaY + lDy >= 0) & \
+                (npaY + lDy < lImageHeight)
+            np.minimum.at(npaImage, (npaY[npaInside] + lDy) * lImageWidth + npaX[npaInside] + lDx,
+                          npaShade[npaInside])
+    return npaImage.reshape(lImageHeight, lImageWidth)
+
+
+def draw_frame(npaSegments, npaView, tSphere, tSize, bAntialias=False):
+    """
+    Project and rasterise a frame, onto lineart's grey ramp.
+    :param bAntialias: Boolean. Rasterise at twice the size, with lines twice as wide, and average each 2x2 block of
+        pixels down.
+    :return: numpy array. (height, width) uint8 grey levels, for lineart.palettise.
+    """
+    if not bAntialias:
+        return rasterise(*project(npaSegments, npaView, tSphere, tSize), tSize)
+    tLarge = (tSize[0] * 2, tSize[1] * 2)
+    npaLarge = rasterise(*project(npaSegments, npaView, tSphere, tLarge), tLarge, 2).astype(np.uint16)
+    npaBlocks = npaLarge.reshape(tSize[1], 2, tSize[0], 2).sum(axis=(1, 3))
+    return ((npaBlocks + 2) // 4).astype(np.uint8)
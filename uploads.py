@@ -0,0 +1,169 @@
+import tempfile
+import hashlib
+import shutil
+import os
+
+import junkdrawer
+import animationindex
+import thumbnails
+import encoders
+
+lMaxUploadBytes = 64 * 1024 ** 2
+lChunk = 1 << 16
+
+
+class UploadError(ValueError):
+    """
+    Raised when an upload can't be stored: an unknown type, a file that isn't what its extension says, or one with no
+    makerkey.
+    """
+    pass
+
+
+class UploadTooLarge(UploadError):
+    """
+    Raised when an upload is bigger than its writer's lMaxBytes.
+    """
+    pass
+
+
+class UploadWriter:
+    """
+    A file an uploaded animation is streamed into chunk by chunk, e.g. by werkzeug's form parser (see
+    app.FractalRequest). Every chunk is hashed, counted against lMaxBytes and fed to its format's scanner (see
+    encoders.Encoder) on its way to a temporary file in junkdrawer.sPartialAnimationsFolder, so once the upload is
+    in, its content hash and makerkey are known without reading it again. commit then moves it into
+    Saved_Animations, unless an identical animation is already there.
+    Chunks past lMaxBytes are dropped rather than raising, since form parsers swallow errors; commit raises instead.
+    """
+    def __init__(self, sFileName, lMaxBytes=lMaxUploadBytes):
+        """
+        :param sFileName: String. Name the client gave the file, which decides its format.
+        :param lMaxBytes: Integer. Size above which the upload is refused.
+        """
+        self.sFileName = sFileName or ""
+        self.lMaxBytes = lMaxBytes
+        try:
+            self.objEncoder = encoders.encoder_for_file(self.sFileName)
+        except ValueError:
+            self.objEncoder = None
+        self.objScanner = None
+        if self.objEncoder is not None and self.objEncoder.clsScanner is not None:
+            self.objScanner = self.objEncoder.clsScanner()
+        self.objScanError = None
+        self.objHash = hashlib.sha256()
+        self.lBytes = 0
+        os.makedirs(junkdrawer.sPartialAnimationsFolder, exist_ok=True)
+        lHandle, self.sTempName = tempfile.mkstemp(dir=junkdrawer.sPartialAnimationsFolder, suffix='.upload')
+        self.f = os.fdopen(lHandle, 'w+b')
+
+    def write(self, bChunk):
+        self.lBytes += len(bChunk)
+        if self.lBytes > self.lMaxBytes:
+            return len(bChunk)
+        self.objHash.update(bChunk)
+        if self.objScanner is not None and self.objScanError is None:
+            try:
+                self.objScanner.feed(bChunk)
+            except (SyntaxError, ValueError) as e:
+                self.objScanError = e
+        return self.f.write(bChunk)
+
+    def read(self, lSize=-1):
+        return self.f.read(lSize)
+
+    def readline(self, lSize=-1):
+        return self.f.readline(lSize)
+
+    def seek(self, lOffset, lWhence=0):
+        return self.f.seek(lOffset, lWhence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        """
+        Close the file, deleting it unless commit has moved it into place.
+        """
+        self.f.close()
+        try:
+            os.remove(self.sTempName)
+        except FileNotFoundError:
+            pass
+
+    def commit(self, sFolder=None, sIndex=None):
+        """
+        Store the upload, content addressed: if an animation with the same bytes is already saved, that one is the
+        upload's entry and nothing is written. Otherwise the upload is moved into sFolder under its own name, with
+        _1, _2, ... appended rather than overwriting a different animation of the same name, and indexed from what
+        was read while it streamed in.
+        :param sFolder: String. Folder of animations. Defaults to junkdrawer.sSavedAnimationsFolder.
+        :param sIndex: String. Path of the animation index sqlite file.
+        :return: Tuple. (file name of the saved animation, whether it is new)
+        """
+        sFolder = sFolder or junkdrawer.sSavedAnimationsFolder
+        try:
+            if self.objEncoder is None:
+                raise UploadError("Unexpected file type")
+            if self.lBytes > self.lMaxBytes:
+                raise UploadTooLarge("Uploads are limited to {} bytes".format(self.lMaxBytes))
+            sContentHash = self.objHash.hexdigest()
+            for sExisting in animationindex.find_by_hash(sContentHash, sIndex):
+                if os.path.isfile(os.path.join(sFolder, sExisting)):
+                    return sExisting, False
+            self.f.flush()
+            try:
+                if self.objScanError is not None:
+                    raise self.objScanError
+                if self.objScanner is not None:
+                    sMakerKey, lFrames, tDimensions = self.objScanner.describe()
+                else:
+                    # Formats without a scanner are described from the file itself
+                    sMakerKey, lFrames, tDimensions = self.objEncoder.fncDescribe(self.sTempName)
+            except (OSError, SyntaxError, ValueError) as e:
+                raise UploadError("Not a readable {}: {}".format(self.objEncoder.sExtension, e))
+            if tDimensions is None:
+                raise UploadError("Not a readable " + self.objEncoder.sExtension)
+            if sMakerKey is None:
+                # Without one it can't be cloned or shown as json
+                raise UploadError("No makerkey in this {}; only fractals made here can be uploaded".format(
+                    self.objEncoder.sExtension))
+            sPath = junkdrawer.publish_file(self.sTempName, os.path.join(sFolder, ''), os.path.basename(self.sFileName))
+            animationindex.add_animation(sPath, sMakerKey, lFrames, tDimensions, sIndex=sIndex,
+                                         sContentHash=sContentHash)
+            return os.path.basename(sPath), True
+        finally:
+            self.close()
+
+
+def store_upload(fStream, sFileName, lMaxBytes=lMaxUploadBytes, sFolder=None, sIndex=None):
+    """
+    Stream an uploaded animation from a file object through an UploadWriter and commit it, for uploads that didn't
+    arrive through app.FractalRequest.
+    :param fStream: File object opened for binary reading.
+    :param sFileName: String. Name the client gave the file, already passed through secure_filename.
+    :return: Tuple. As UploadWriter.commit.
+    """
+    objWriter = UploadWriter(sFileName, lMaxBytes)
+    try:
+        shutil.copyfileobj(fStream, objWriter, lChunk)
+    except BaseException:
+        objWriter.close()
+        raise
+    return objWriter.commit(sFolder, sIndex)
+
+
+def discard_upload(sBaseName, sFolder=None, sIndex=None):
+    """
+    Remove a committed upload that turned out not to be usable, e.g. one PIL can't decode: its file, index entry and
+    any thumbnails.
+    """
+    try:
+        os.remove(os.path.join(sFolder or junkdrawer.sSavedAnimationsFolder, sBaseName))
+    except FileNotFoundError:
+        pass
+    animationindex.remove_animation(sBaseName, sIndex)
+    thumbnails.remove_thumbnails(sBaseName)
@@ -1,30 +1,31 @@
-import tkinter as tk
-from tkinter import filedialog
-from renderer import render_2d_frame_by_frame_animation
-from renderer import get_makerkey
+# tkinter and the renderer are imported where they're used, so importing this module stays cheap
 # import junkdrawer
 # import json
-from PIL import Image
+import gifblocks
 
 def prompt_2d_clone():
+    from tkinter import filedialog
+    from renderer import render_animation, get_makerkey
     sFile = filedialog.askopenfilename()
-    render_2d_frame_by_frame_animation(**get_makerkey(sFile))
+    render_animation(**get_makerkey(sFile))
 
 
 def prompt_makerkey():
+    from tkinter import filedialog
+    from renderer import get_makerkey
     sFile = filedialog.askopenfilename()
     print(get_makerkey(sFile))
 
 
 def prompt_makerjson():
+    from tkinter import filedialog
     sFile = filedialog.askopenfilename()
-    with Image.open(sFile) as imgGif:
-        # jsonBlueprint = json.loads(imgGif.info["comment"], cls=junkdrawer.JeffSONDecoder)
-        jsonBlueprint = imgGif.info["comment"].decode('ASCII')
+    jsonBlueprint = gifblocks.read_comment(sFile).decode('ASCII')
     print(jsonBlueprint)
 
 
 def main():
+    import tkinter as tk
     root = tk.Tk()
     root.withdraw()
     prompt_makerjson()